@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Benchmark the multiprocessing pool against the single process asyncio engine.
+
+Each engine is started as its own process on an empty watched directory. `--dumps` dumps of every size are then
+written into the directory and the engine uploads them. The time from the first write until the last dump is deleted
+is reported together with the resident memory of the engine's whole process tree, idle after startup and at its peak.
+PSS splits pages shared between the forked pool workers and the parent, so it is the fairer memory figure for the
+pool. One JSON line per size and engine.
+
+Usage:
+    python benchmarks/bench_engines.py --sizes 1MB 50MB 500MB --dumps 8 --worker-mode ephemeral persistent
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import common
+
+HANDLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core_dump_handler")
+# Run an engine with its startup check file in the benchmark's directory instead of /core_dump_handler.
+LAUNCHER = """
+import functools, sys
+import main
+main.i_am_started = functools.partial(main.i_am_started, sys.argv[2])
+main.i_am_dead = functools.partial(main.i_am_dead, sys.argv[2])
+if sys.argv[1] == "asyncio":
+    import async_engine
+    async_engine.run(sys.argv[3])
+else:
+    main.watch_directory(sys.argv[3])
+"""
+
+
+def process_tree(pid: int) -> list:
+    """PIDs of a process and all of its descendants."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r", encoding="utf-8") as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree, todo = [], [pid]
+    while todo:
+        tree.append(todo.pop())
+        todo.extend(children.get(tree[-1], []))
+    return tree
+
+
+def memory(pid: int) -> tuple:
+    """RSS and PSS of a process tree.
+
+    Returns:
+        tuple: `(rss, pss)` in bytes.
+    """
+    rss = pss = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/smaps_rollup", "r", encoding="utf-8") as rollup:
+                for line in rollup:
+                    if line.startswith("Rss:"):
+                        rss += int(line.split()[1]) * 1024
+                    elif line.startswith("Pss:"):
+                        pss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return rss, pss
+
+
+def run(engine: str, directory: str, size: int, dumps: int, env: dict) -> dict:
+    """Start an engine, feed it dumps and wait until they are all uploaded.
+
+    Returns:
+        dict: Seconds and memory figures.
+    """
+    watched = os.path.join(directory, engine)
+    os.mkdir(watched)
+    check = os.path.join(directory, f"{engine}.check")
+    env = dict(env, HEARTBEAT_FILE=os.path.join(directory, f"{engine}.heartbeat"))
+    process = subprocess.Popen(  # pylint: disable=R1732
+        [sys.executable, "-c", LAUNCHER, engine, check, watched], cwd=HANDLER_DIR, env=env
+    )
+    try:
+        for _ in range(600):
+            if os.path.exists(check):
+                break
+            time.sleep(0.05)
+        time.sleep(1)
+        idle_rss, idle_pss = memory(process.pid)
+        peak = [idle_rss, idle_pss]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.1):
+                rss, pss = memory(process.pid)
+                peak[0], peak[1] = max(peak[0], rss), max(peak[1], pss)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        started = time.monotonic()
+        block = os.urandom(min(size, 1024 * 1024))
+        for dump in range(dumps):
+            with open(os.path.join(watched, f"core-bench-{int(time.time())}-{dump}-11"), "wb") as core_dump:
+                for offset in range(0, size, len(block)):
+                    core_dump.write(block[: size - offset])
+        while any(name.startswith("core") for name in os.listdir(watched)):
+            time.sleep(0.05)
+        elapsed = time.monotonic() - started
+        done.set()
+        sampler.join()
+    finally:
+        process.terminate()
+        process.wait(timeout=60)
+    return {
+        "seconds": round(elapsed, 3),
+        "mb_per_second": round(size * dumps / elapsed / 1000**2, 1),
+        "idle_rss_mb": round(idle_rss / 1024**2, 1),
+        "idle_pss_mb": round(idle_pss / 1024**2, 1),
+        "peak_rss_mb": round(peak[0] / 1024**2, 1),
+        "peak_pss_mb": round(peak[1] / 1024**2, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["1MB", "50MB", "500MB"], help="Dump sizes.")
+    parser.add_argument("--dumps", type=int, default=8, help="Dumps written per size.")
+    parser.add_argument(
+        "--worker-mode", nargs="+", default=["ephemeral"], help="WORKER_MODE values to run the pool with."
+    )
+    parser.add_argument("--endpoint-url", help="Existing S3 compatible endpoint instead of a moto server.")
+    args = parser.parse_args()
+    with common.local_s3(endpoint_url=args.endpoint_url):
+        for size in map(common.parse_size, args.sizes):
+            engines = [("pool", mode) for mode in args.worker_mode] + [("asyncio", None)]
+            for engine, worker_mode in engines:
+                env = dict(os.environ, LOGLEVEL="WARNING", METRICS_PORT="-1", BACKLOG_MIN_AGE="3600")
+                if worker_mode:
+                    env["WORKER_MODE"] = worker_mode
+                with tempfile.TemporaryDirectory() as directory:
+                    result = run(engine, directory, size, args.dumps, env)
+                print(
+                    json.dumps(
+                        {
+                            "benchmark": "engines",
+                            "engine": engine if worker_mode is None else f"pool-{worker_mode}",
+                            "size": size,
+                            "dumps": args.dumps,
+                            **result,
+                        }
+                    ),
+                    flush=True,
+                )
+
+
+if __name__ == "__main__":
+    main()
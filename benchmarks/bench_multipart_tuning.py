@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark size-adaptive multipart settings against the fixed settings used before.
+
+"fixed" is the old `TransferConfig(multipart_threshold=104857600, max_concurrency=20)` with 8MiB parts, "adaptive" is
+`transfer_tuning.plan_transfer()`. Every size is uploaded `--repeat` times per mode through `upload_file()` and the
+best wall clock time is reported as one JSON line per size and mode.
+
+Usage:
+    python benchmarks/bench_multipart_tuning.py --sizes 10MB 50MB 200MB 1GB 20GB --concurrent 1 4
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+
+MODES = {
+    "fixed": {"multipart_threshold": 104857600, "part_size": 8 * 1024 * 1024, "max_concurrency": 20},
+    "adaptive": {},
+}
+
+
+def run(file_name: str, copies: int, mode: str) -> float:
+    """Upload `copies` hard links of `file_name` at the same time.
+
+    Returns:
+        float: Wall clock seconds.
+    """
+    import transfer_budget  # pylint: disable=C0415
+    import upload_file_2_s3  # pylint: disable=C0415
+
+    upload_file_2_s3.init_worker(
+        transfer_budget.TransferBudget(int(os.environ.get("TRANSFER_BUDGET_BYTES", str(64 * 1024 * 1024))))
+    )
+    links = []
+    for copy in range(copies):
+        links.append(f"{file_name}.{mode}.{copy}")
+        os.link(file_name, links[-1])
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=copies) as executor:
+        for result in [
+            executor.submit(
+                upload_file_2_s3.upload_file, file_name=link, bucket=os.environ["BUCKET_NAME"], **MODES[mode]
+            )
+            for link in links
+        ]:
+            result.result()
+    return time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=["10MB", "50MB", "200MB", "1GB"], help="Dump sizes.")
+    parser.add_argument("--concurrent", nargs="+", type=int, default=[1, 4], help="Dumps uploaded at the same time.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size and mode, the best one is reported.")
+    parser.add_argument("--endpoint-url", help="Existing S3 compatible endpoint instead of a moto server.")
+    args = parser.parse_args()
+    os.environ.setdefault("LOGLEVEL", "WARNING")
+    with common.local_s3(endpoint_url=args.endpoint_url), tempfile.TemporaryDirectory() as directory:
+        for size in map(common.parse_size, args.sizes):
+            file_name = common.make_file(os.path.join(directory, f"core-bench-{size}"), size)
+            for copies in args.concurrent:
+                seconds = {mode: min(run(file_name, copies, mode) for _ in range(args.repeat)) for mode in MODES}
+                for mode, elapsed in seconds.items():
+                    print(
+                        json.dumps(
+                            {
+                                "benchmark": "multipart_tuning",
+                                "size": size,
+                                "concurrent": copies,
+                                "mode": mode,
+                                "seconds": round(elapsed, 3),
+                                "mb_per_second": round(size * copies / elapsed / 1000**2, 1),
+                                "speedup": round(seconds["fixed"] / elapsed, 2),
+                            }
+                        ),
+                        flush=True,
+                    )
+            os.remove(file_name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Benchmark the startup of the pool engine and the memory of its workers, by worker start method and preloading.
+
+The handler is started as its own process on an empty watched directory. As soon as its startup check file appears a
+small dump is written, so the benchmark also shows that a dump written during boot is picked up. Reported are the
+seconds from launch to the startup check, and to the first dump being uploaded. Once every worker has started, the
+handler's own RSS is reported, and for each worker the median RSS and its PSS. PSS splits the pages a worker shares
+with its siblings and with the process it was forked from. The multiprocessing helper processes are not counted as
+workers. One JSON line per start method, preload setting and worker mode.
+
+Usage:
+    python benchmarks/bench_startup.py --start-method fork forkserver --preload true false --worker-mode ephemeral
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+from bench_engines import HANDLER_DIR, LAUNCHER, process_tree
+
+
+def rollup(pid: int) -> tuple:
+    """RSS and PSS of one process, without its children.
+
+    Returns:
+        tuple: `(rss, pss)` in bytes, zeros if the process is gone.
+    """
+    rss = pss = 0
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r", encoding="utf-8") as smaps:
+            for line in smaps:
+                if line.startswith("Rss:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("Pss:"):
+                    pss = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return rss, pss
+
+
+def workers(pid: int) -> list:
+    """PIDs of the upload workers of a handler.
+
+    The forkserver and the resource tracker are children of the handler started from a `multiprocessing` command
+    line. Workers forked from the forkserver inherit its command line, so only the handler's children are checked.
+    """
+    found = []
+    for member in process_tree(pid):
+        if member == pid:
+            continue
+        try:
+            with open(f"/proc/{member}/stat", "r", encoding="utf-8") as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{member}/cmdline", "rb") as cmdline:
+                helper = parent == pid and b"multiprocessing" in cmdline.read()
+        except (OSError, IndexError, ValueError):
+            continue
+        if not helper:
+            found.append(member)
+    return found
+
+
+def run(directory: str, processes: int, env: dict) -> dict:
+    """Start the handler, write one dump once it is up and wait until it is uploaded.
+
+    Returns:
+        dict: Seconds and memory figures.
+    """
+    watched = os.path.join(directory, "watched")
+    os.mkdir(watched)
+    check = os.path.join(directory, "check")
+    env = dict(env, HEARTBEAT_FILE=os.path.join(directory, "heartbeat"))
+    launched = time.monotonic()
+    process = subprocess.Popen(  # pylint: disable=R1732
+        [sys.executable, "-c", LAUNCHER, "pool", check, watched], cwd=HANDLER_DIR, env=env
+    )
+    try:
+        while not os.path.exists(check):
+            if time.monotonic() - launched > 60:
+                raise TimeoutError("The handler did not start within 60 seconds.")
+            time.sleep(0.005)
+        ready = time.monotonic() - launched
+        with open(os.path.join(watched, f"core-bench-{int(time.time())}-1-11"), "wb") as core_dump:
+            core_dump.write(os.urandom(1024 * 1024))
+        while any(name.startswith("core") for name in os.listdir(watched)):
+            if time.monotonic() - launched > 120:
+                raise TimeoutError("The first dump was not uploaded within 120 seconds.")
+            time.sleep(0.005)
+        first_upload = time.monotonic() - launched
+        # Ephemeral workers are replaced after every dump, wait until the pool is full again.
+        for _ in range(200):
+            pids = workers(process.pid)
+            if len(pids) >= processes:
+                break
+            time.sleep(0.05)
+        time.sleep(1)
+        handler_rss, _ = rollup(process.pid)
+        sizes = [rollup(pid) for pid in workers(process.pid)]
+    finally:
+        process.terminate()
+        process.wait(timeout=60)
+    return {
+        "ready_seconds": round(ready, 3),
+        "first_upload_seconds": round(first_upload, 3),
+        "handler_rss_mb": round(handler_rss / 1024**2, 1),
+        "workers": len(sizes),
+        "worker_rss_mb": round(statistics.median(rss for rss, _ in sizes) / 1024**2, 1) if sizes else None,
+        "worker_pss_mb": round(statistics.median(pss for _, pss in sizes) / 1024**2, 1) if sizes else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--start-method", nargs="+", default=["fork", "forkserver"], help="WORKER_START_METHOD values to run."
+    )
+    parser.add_argument("--preload", nargs="+", default=["true", "false"], help="WORKER_PRELOAD values to run.")
+    parser.add_argument(
+        "--worker-mode", nargs="+", default=["ephemeral"], help="WORKER_MODE values to run the pool with."
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per combination, the median is reported.")
+    parser.add_argument("--endpoint-url", help="Existing S3 compatible endpoint instead of a moto server.")
+    args = parser.parse_args()
+    with common.local_s3(endpoint_url=args.endpoint_url):
+        for start_method in args.start_method:
+            for preload in args.preload:
+                for worker_mode in args.worker_mode:
+                    env = dict(
+                        os.environ,
+                        LOGLEVEL="WARNING",
+                        METRICS_PORT="-1",
+                        BACKLOG_MIN_AGE="3600",
+                        WORKER_START_METHOD=start_method,
+                        WORKER_PRELOAD=preload,
+                        WORKER_MODE=worker_mode,
+                    )
+                    results = []
+                    for _ in range(args.repeat):
+                        with tempfile.TemporaryDirectory() as directory:
+                            results.append(run(directory, 4, env))
+                    print(
+                        json.dumps(
+                            {
+                                "benchmark": "startup",
+                                "start_method": start_method,
+                                "preload": preload == "true",
+                                "worker_mode": worker_mode,
+                                **{
+                                    key: statistics.median(result[key] for result in results)
+                                    if results[0][key] is not None
+                                    else None
+                                    for key in results[0]
+                                },
+                            }
+                        ),
+                        flush=True,
+                    )
+
+
+if __name__ == "__main__":
+    main()
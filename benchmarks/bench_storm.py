@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Load test the handler pipeline with synthetic dump storms.
+
+The handler is started as its own process on an empty watched directory, with `main.watch_directory()` or the asyncio
+engine, and a storm of dumps is written into the directory as fast as the disk takes them:
+
+- `small`: many small dumps of incompressible data.
+- `sparse`: a few huge sparse dumps, mostly holes with a little data spread over the address space.
+- `mixed`: uncompressed dumps, half zero pages, alternating with dumps gzipped by `core_pattern` already.
+
+Every dump is timed from being closed, which is when inotify reports it, until the handler deletes it. Reported are
+the percentiles of that latency, the seconds from the first write until the last dump is deleted, the dump bytes per
+second, the bytes that ended up in S3, the peak RSS and PSS of the handler's process tree and the CPU it used. Each run
+uploads to a bucket of its own. One JSON line per scenario, engine and configuration, with the commit and the host,
+so results can be compared across releases.
+
+Usage:
+    python benchmarks/bench_storm.py --scenarios small sparse mixed --engine pool asyncio \\
+        --config COMPRESSION=off --config COMPRESSION=zstd SPARSE_UPLOAD=false
+"""
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import common
+from bench_engines import HANDLER_DIR, LAUNCHER, memory, process_tree
+
+SCENARIOS = ("small", "sparse", "mixed")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def parse_storm(storm: str) -> tuple:
+    """Parse a storm like `200x64KB`, or `2x2GB:32MB` for sparse dumps with 32MB of data each.
+
+    Returns:
+        tuple: `(dumps, size, data)`, data is None without a `:`.
+    """
+    dumps, _, rest = storm.partition("x")
+    size, _, data = rest.partition(":")
+    return int(dumps), common.parse_size(size), common.parse_size(data) if data else None
+
+
+def cpu_seconds(pid: int) -> float:
+    """CPU seconds used by a process tree, including children that exited and were waited for."""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat", "r", encoding="utf-8") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # utime, stime, cutime and cstime, counted from the state field.
+        total += sum(int(field) for field in fields[11:15])
+    return total / CLOCK_TICKS
+
+
+def percentile(values: list, share: float) -> float:
+    """Nearest rank percentile of a list of values, None if it is empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered) + 0.5) - 1))]
+
+
+def commit() -> str:
+    """Commit the benchmark runs, None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HANDLER_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_storm(watched: str, scenario: str, storm: tuple, closed: dict, lock: threading.Lock) -> int:
+    """Write the dumps of a scenario, recording when each one is closed.
+
+    Returns:
+        int: Bytes written, holes not counted.
+    """
+    dumps, size, data = storm
+    block = os.urandom(min(size, 1024 * 1024))
+    # Half zero pages, about what an uncompressed dump of a real process compresses like.
+    compressible = block[: len(block) // 2] + bytes(len(block) - len(block) // 2)
+    gzipped = None
+    if scenario == "mixed":
+        gzipped = gzip.compress(compressible * max(1, size // len(compressible)), compresslevel=1)
+    written = 0
+    for dump in range(dumps):
+        name = f"core-{scenario}{dump}-{int(time.time())}-{dump}-11"
+        if scenario == "mixed" and dump % 2:
+            name += ".gz"
+        with open(os.path.join(watched, name), "wb") as core_dump:
+            if scenario == "sparse":
+                extents = 8
+                extent = (data or size // 100) // extents
+                for index in range(extents):
+                    core_dump.seek(size // extents * index)
+                    for offset in range(0, extent, len(block)):
+                        written += core_dump.write(block[: extent - offset])
+                core_dump.truncate(size)
+            elif name.endswith(".gz"):
+                written += core_dump.write(gzipped)
+            else:
+                source = compressible if scenario == "mixed" else block
+                for offset in range(0, size, len(source)):
+                    written += core_dump.write(source[: size - offset])
+        with lock:
+            closed[name] = time.monotonic()
+    return written
+
+
+def run(scenario: str, storm: tuple, engine: str, directory: str, env: dict, timeout: float) -> dict:
+    """Start an engine, write a storm into its directory and wait until every dump is uploaded or `timeout` passes.
+
+    Returns:
+        dict: Latency, throughput, memory and CPU figures.
+    """
+    watched = os.path.join(directory, "watched")
+    os.mkdir(watched)
+    check = os.path.join(directory, "check")
+    env = dict(env, HEARTBEAT_FILE=os.path.join(directory, "heartbeat"))
+    process = subprocess.Popen(  # pylint: disable=R1732
+        [sys.executable, "-c", LAUNCHER, engine, check, watched], cwd=HANDLER_DIR, env=env
+    )
+    closed, deleted = {}, {}
+    lock = threading.Lock()
+    done = threading.Event()
+    peak = [0, 0]
+
+    def watch():
+        while not done.wait(0.01):
+            with lock:
+                pending = [name for name in closed if name not in deleted]
+            if not pending:
+                continue
+            present = set(os.listdir(watched))
+            now = time.monotonic()
+            for name in pending:
+                if name not in present:
+                    deleted[name] = now
+            rss, pss = memory(process.pid)
+            peak[0], peak[1] = max(peak[0], rss), max(peak[1], pss)
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    try:
+        for _ in range(1200):
+            if os.path.exists(check):
+                break
+            time.sleep(0.05)
+        else:
+            raise TimeoutError("The handler did not start within 60 seconds.")
+        time.sleep(1)
+        cpu_before = cpu_seconds(process.pid)
+        watcher.start()
+        started = time.monotonic()
+        written = write_storm(watched, scenario, storm, closed, lock)
+        while len(deleted) < storm[0] and time.monotonic() - started < timeout:
+            time.sleep(0.05)
+        elapsed = (max(deleted.values()) if deleted else time.monotonic()) - started
+        cpu = cpu_seconds(process.pid) - cpu_before
+        done.set()
+        watcher.join()
+    finally:
+        done.set()
+        process.terminate()
+        process.wait(timeout=60)
+    latencies = [deleted[name] - closed[name] for name in deleted]
+    return {
+        "uploaded_dumps": len(deleted),
+        "timed_out": len(deleted) < storm[0],
+        "written_bytes": written,
+        "seconds": round(elapsed, 3),
+        "mb_per_second": round(written / elapsed / 1000**2, 1),
+        **{
+            f"latency_{name}_seconds": round(value, 3) if value is not None else None
+            for name, value in (
+                ("p50", percentile(latencies, 0.5)),
+                ("p90", percentile(latencies, 0.9)),
+                ("p99", percentile(latencies, 0.99)),
+                ("max", max(latencies, default=None)),
+            )
+        },
+        "peak_rss_mb": round(peak[0] / 1024**2, 1),
+        "peak_pss_mb": round(peak[1] / 1024**2, 1),
+        "cpu_seconds": round(cpu, 2),
+        "cpu_percent": round(cpu / elapsed * 100, 1),
+    }
+
+
+def bucket_bytes(s3: object, bucket: str) -> int:
+    """Empty a bucket, so a long suite does not pile up in the stand-in.
+
+    Returns:
+        int: Bytes the bucket held.
+    """
+    total = 0
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket):
+        objects = page.get("Contents", [])
+        total += sum(item["Size"] for item in objects)
+        if objects:
+            s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": item["Key"]} for item in objects]})
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS), help="Storms to run.")
+    parser.add_argument("--small", default="200x64KB", help="Dumps and size of the small storm.")
+    parser.add_argument("--sparse", default="2x2GB:32MB", help="Dumps, size and data of the sparse storm.")
+    parser.add_argument("--mixed", default="16x8MB", help="Dumps and size of the mixed storm.")
+    parser.add_argument("--engine", nargs="+", default=["pool"], help="Engines to run, `pool` and/or `asyncio`.")
+    parser.add_argument(
+        "--config",
+        nargs="*",
+        action="append",
+        metavar="KEY=VALUE",
+        help="Environment of one configuration, repeat for more. Defaults to the handler's defaults.",
+    )
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for a storm to be uploaded.")
+    parser.add_argument("--directory", help="Where to create the watched directories. Defaults to the temp dir.")
+    parser.add_argument("--endpoint-url", help="Existing S3 compatible endpoint instead of a moto server.")
+    args = parser.parse_args()
+    host = {"commit": commit(), "python": platform.python_version(), "cpus": os.cpu_count()}
+    runs = 0
+    with common.local_s3(endpoint_url=args.endpoint_url):
+        import boto3  # pylint: disable=C0415
+
+        s3 = boto3.client("s3", region_name=os.environ["REGION"])
+        for scenario in args.scenarios:
+            storm = parse_storm(getattr(args, scenario))
+            for engine in args.engine:
+                for config in args.config or [[]]:
+                    runs += 1
+                    bucket = f"bench-storm-{os.getpid()}-{runs}"
+                    s3.create_bucket(Bucket=bucket)
+                    overrides = dict(setting.split("=", 1) for setting in config)
+                    # Sampling would drop most of a storm, every dump is uploaded unless a configuration says not.
+                    env = dict(
+                        os.environ,
+                        LOGLEVEL="WARNING",
+                        METRICS_PORT="-1",
+                        BACKLOG_MIN_AGE="3600",
+                        SCHEDULER_KEEP_FIRST="0",
+                        SCHEDULER_MAX_QUEUE=str(storm[0]),
+                        BUCKET_NAME=bucket,
+                        **overrides,
+                    )
+                    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+                        result = run(scenario, storm, engine, directory, env, args.timeout)
+                    uploaded = bucket_bytes(s3, bucket)
+                    s3.delete_bucket(Bucket=bucket)
+                    print(
+                        json.dumps(
+                            {
+                                "benchmark": "storm",
+                                "scenario": scenario,
+                                "engine": engine,
+                                "config": overrides,
+                                "dumps": storm[0],
+                                "size": storm[1],
+                                **result,
+                                "s3_bytes": uploaded,
+                                **host,
+                            }
+                        ),
+                        flush=True,
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Shared helpers for the benchmarks: a local S3 stand-in and synthetic dump files.
+"""
+
+import contextlib
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+
+# Make the handler modules importable the same way main.py imports them.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core_dump_handler"))
+
+UNITS = {"": 1, "B": 1, "KB": 1000, "MB": 1000**2, "GB": 1000**3, "KIB": 1024, "MIB": 1024**2, "GIB": 1024**3}
+
+
+def parse_size(size: str) -> int:
+    """Parse a human readable size like `10MB` or `20GiB`.
+
+    Args:
+        size (str): Size with an optional unit.
+
+    Returns:
+        int: Size in bytes.
+    """
+    match = re.fullmatch(r"\s*([\d.]+)\s*([A-Za-z]*)\s*", size)
+    if not match or match.group(2).upper() not in UNITS:
+        raise ValueError(f"Cannot parse size {size!r}.")
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def local_s3(bucket: str = "bench-bucket", endpoint_url: str = None):
+    """Run against a local S3 stand-in.
+
+    Starts a moto server in its own process, so it does not compete with the benchmark for the GIL, unless
+    `endpoint_url` points at an S3 compatible store that is already running, e.g. MinIO. The handler picks the
+    endpoint up from `AWS_ENDPOINT_URL_S3`.
+
+    Args:
+        bucket (str, optional): Bucket to create. Defaults to "bench-bucket".
+        endpoint_url (str, optional): Existing S3 compatible endpoint. Defaults to None.
+
+    Yields:
+        str: Endpoint URL.
+    """
+    process = None
+    if endpoint_url is None:
+        port = _free_port()
+        endpoint_url = f"http://127.0.0.1:{port}"
+        process = subprocess.Popen(  # pylint: disable=R1732
+            [sys.executable, "-m", "moto.server", "-H", "127.0.0.1", "-p", str(port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for _ in range(100):
+            with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                break
+            time.sleep(0.1)
+    os.environ["AWS_ENDPOINT_URL_S3"] = endpoint_url
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("REGION", "us-east-1")
+    os.environ["BUCKET_NAME"] = bucket
+    import boto3  # pylint: disable=C0415
+
+    s3 = boto3.client("s3", region_name=os.environ["REGION"])
+    with contextlib.suppress(s3.exceptions.BucketAlreadyOwnedByYou, s3.exceptions.BucketAlreadyExists):
+        s3.create_bucket(Bucket=bucket)
+    try:
+        yield endpoint_url
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+def make_file(path: str, size: int, block_size: int = 1024 * 1024) -> str:
+    """Write a file of incompressible data by repeating one random block.
+
+    Args:
+        path (str): File to write.
+        size (int): Size in bytes.
+        block_size (int, optional): Size of the random block. Defaults to 1MiB.
+
+    Returns:
+        str: Path of the file.
+    """
+    block = os.urandom(block_size)
+    with open(path, "wb") as output:
+        for _ in range(size // block_size):
+            output.write(block)
+        output.write(block[: size % block_size])
+    return path
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Single process asyncio engine, an alternative to the multiprocessing pool of `main.watch_directory()`.
+
+Uploads only wait on the network and the disk, so they do not need a process each. This engine reads inotify from the
+event loop, the inotify file descriptor is pollable, and runs `main.s3_upload_wrapper()` in a bounded thread pool, with
+an `asyncio.Semaphore` capping the uploads that run at once. Dumps go through the same scheduler, journal, backlog scan
+and metrics as with the pool, and the workers share one cached S3 client. Select it with `ENGINE=asyncio`. The event
+loop itself refreshes the heartbeat, so a wedged loop fails the liveness probe.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from inotify_simple import INotify, flags
+import dedup
+import disk_watchdog
+import dump_index
+import heartbeat
+import main
+import metrics
+import scheduler
+import stall_watchdog
+import throttle
+import transfer_budget
+import upload_file_2_s3
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+
+class AsyncEngine:
+    """Watch a directory and upload its core dumps from one event loop."""
+
+    def __init__(
+        self,
+        path_to_directory: str,
+        concurrency: int = int(os.environ.get("ASYNC_CONCURRENCY", "4")),
+        rescan_seconds: int = int(os.environ.get("BACKLOG_RESCAN_SECONDS", "0")),
+        index_push_seconds: int = int(os.environ.get("INDEX_PUSH_SECONDS", "300")),
+    ):
+        """Create the engine. Nothing runs until `run()` is awaited.
+
+        Args:
+            path_to_directory (str): Directory to watch.
+            concurrency (int, optional): Uploads running at once, and threads running them.
+            Defaults to os.environ.get("ASYNC_CONCURRENCY", "4").
+            rescan_seconds (int, optional): Seconds between backlog scans, see `main.watch_directory()`.
+            Defaults to os.environ.get("BACKLOG_RESCAN_SECONDS", "0").
+            index_push_seconds (int, optional): Seconds between pushes of the dump index, see `main.watch_directory()`.
+            Defaults to os.environ.get("INDEX_PUSH_SECONDS", "300").
+        """
+        self.path_to_directory = path_to_directory
+        self.concurrency = concurrency
+        self.rescan_seconds = rescan_seconds
+        self.index_push_seconds = index_push_seconds
+        self.scheduler = scheduler.UploadScheduler(max_in_flight=concurrency)
+        self.budget = transfer_budget.TransferBudget(
+            max_bytes=int(os.environ.get("TRANSFER_BUDGET_BYTES", str(64 * 1024 * 1024)))
+        )
+        self.throttle = throttle.Throttle()
+        self.fingerprints = dedup.FingerprintCache() if os.environ.get("DEDUP", "false").lower() == "true" else None
+        self.watchdog = disk_watchdog.DiskWatchdog(path_to_directory)
+        self.stalls = stall_watchdog.StallWatchdog(stall_watchdog.ProgressTable(concurrency))
+        self.heartbeat = heartbeat.Heartbeat()
+        self.summaries = (
+            upload_file_2_s3.EarlySummaries() if os.environ.get("TRIAGE", "true").lower() == "true" else None
+        )
+        self.shutdown = threading.Event()
+        self._stopping = None
+        self._semaphore = None
+        self._executor = None
+        self._tasks = set()
+
+    def submit(self, file_name: str, backlog: bool = False) -> str:
+        """Offer a dump to the scheduler and start uploads if there is room.
+
+        Args:
+            file_name (str): Core dump file name.
+            backlog (bool, optional): The dump was found by a scan. Defaults to False.
+
+        Returns:
+            str: Scheduler outcome.
+        """
+        size = main.file_size(f"{self.path_to_directory}/{file_name}")
+        outcome = self.scheduler.submit(file_name, self.path_to_directory, size=size, backlog=backlog)
+        metrics.inc("dumps_total", outcome=outcome)
+        logger.debug("%s %s.", file_name, outcome)
+        if outcome == scheduler.SAMPLED:
+            main.discard(self.scheduler, self.summaries, file_name, self.path_to_directory)
+        return outcome
+
+    def dispatch(self) -> int:
+        """Start an upload task for every dump the scheduler hands out.
+
+        Nothing is started once `stop()` was called, `run()` only waits for the tasks that were running by then.
+
+        Returns:
+            int: Number of tasks started.
+        """
+        if self.shutdown.is_set():
+            return 0
+        dispatched = 0
+        while (item := self.scheduler.next()) is not None:
+            queued = self.scheduler.queued + self.scheduler.backlog
+            task = asyncio.get_running_loop().create_task(self.upload(*item, dispatched_at=time.time(), queued=queued))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            dispatched += 1
+        return dispatched
+
+    async def upload(self, file_name: str, path_to_directory: str, dispatched_at: float = None, queued: int = 0):
+        """Upload one dump through `main.s3_upload_wrapper()` in the thread pool.
+
+        Args:
+            file_name (str): Core dump file name.
+            path_to_directory (str): Directory of the dump.
+            dispatched_at (float, optional): `time.time()` the scheduler handed the dump out. Defaults to None.
+            queued (int, optional): Dumps still waiting at that time. Defaults to 0.
+        """
+        async with self._semaphore:
+            logger.info("Sending %s to S3.", file_name)
+            loop = asyncio.get_running_loop()
+            size = main.file_size(f"{path_to_directory}/{file_name}")
+            slot = self.stalls.track(file_name)
+            summarized = self.summaries.claim(f"{path_to_directory}/{file_name}") if self.summaries else False
+            try:
+                # Fingerprinting reads the dump, keep it off the event loop.
+                duplicate = await loop.run_in_executor(
+                    self._executor, main.deduplicate, self.fingerprints, f"{path_to_directory}/{file_name}"
+                )
+                value = await loop.run_in_executor(
+                    self._executor,
+                    functools.partial(
+                        main.s3_upload_wrapper,
+                        file_name,
+                        path_to_directory,
+                        dispatched_at=dispatched_at,
+                        queued=queued,
+                        progress_slot=slot,
+                        summarized=summarized,
+                        **duplicate,
+                    ),
+                )
+            except Exception as e:  # pylint: disable=W0718
+                main.task_error_callback(
+                    self.scheduler,
+                    file_name,
+                    e,
+                    path_to_directory=path_to_directory,
+                    size=size,
+                    stalls=self.stalls,
+                    slot=slot,
+                )
+            else:
+                main.task_callback(
+                    self.scheduler,
+                    file_name,
+                    value,
+                    fingerprints=self.fingerprints,
+                    stalls=self.stalls,
+                    slot=slot,
+                    **duplicate,
+                )
+        self.dispatch()
+
+    def on_inotify(self, inotify: INotify):
+        """Event loop reader callback: submit every closed `core` file."""
+        events = inotify.read(timeout=0)
+        if events:
+            metrics.inc("inotify_events_total", len(events))
+        for event in events:
+            if event.mask & flags.CLOSE_WRITE and event.name.startswith("core"):
+                if self.summaries is not None:
+                    self.summaries.submit(f"{self.path_to_directory}/{event.name}")
+                self.submit(event.name)
+        self.dispatch()
+
+    def rescan(self):
+        """Submit the settled dumps already in the directory as backlog."""
+        main.submit_backlog(self.scheduler, self.path_to_directory)
+        self.dispatch()
+
+    async def _rescan_later(self):
+        # One extra scan for dumps that were still settling at startup, then every `rescan_seconds` if set.
+        await asyncio.sleep(self.rescan_seconds or int(os.environ.get("BACKLOG_MIN_AGE", "60")))
+        self.rescan()
+        while self.rescan_seconds:
+            await asyncio.sleep(self.rescan_seconds)
+            self.rescan()
+
+    async def _push_index_later(self):
+        while True:
+            await asyncio.sleep(self.index_push_seconds)
+            await asyncio.get_running_loop().run_in_executor(self._executor, dump_index.push, self.path_to_directory)
+
+    async def _watch_disk(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # The default executor, the upload threads may all be busy while the disk fills up.
+            await loop.run_in_executor(None, self.watchdog.check, self.scheduler, self.fingerprints)
+            self.dispatch()
+            await asyncio.sleep(self.watchdog.check_seconds)
+
+    async def _watch_uploads(self):
+        while True:
+            self.stalls.check()
+            main.beat(self.heartbeat, self.scheduler, self.stalls)
+            # Retries become due without an event, hand them out from here.
+            self.dispatch()
+            await asyncio.sleep(1)
+
+    def stop(self):
+        """Checkpoint running uploads and leave `run()`. Safe to call from a signal handler of the loop."""
+        logger.info("Shutting down, checkpointing uploads.")
+        self.shutdown.set()
+        self._stopping.set()
+
+    async def run(self):
+        """Watch the directory until `stop()` is called, then wait for running uploads to checkpoint."""
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # Only the upload threads run at a lower priority, the event loop keeps reading inotify at full priority.
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="upload", initializer=throttle.lower_priority
+        )
+        upload_file_2_s3.configure(
+            budget=self.budget, shutdown=self.shutdown, upload_throttle=self.throttle, progress=self.stalls.progress
+        )
+        main.register_gauges(self.scheduler, self.concurrency, self.budget, self.path_to_directory, self.throttle)
+        inotify = INotify()
+        rescans = pushes = disk = uploads = None
+        try:
+            inotify.add_watch(self.path_to_directory, flags.CLOSE_WRITE)
+            loop.add_reader(inotify.fileno(), self.on_inotify, inotify)
+            loop.add_signal_handler(signal.SIGTERM, self.stop)
+            main.submit_resumes(self.scheduler, self.path_to_directory)
+            self.rescan()
+            rescans = loop.create_task(self._rescan_later())
+            if self.index_push_seconds:
+                pushes = loop.create_task(self._push_index_later())
+            if self.watchdog.enabled:
+                disk = loop.create_task(self._watch_disk())
+            uploads = loop.create_task(self._watch_uploads())
+            main.i_am_started()
+            await self._stopping.wait()
+        finally:
+            for task in (rescans, pushes, disk, uploads):
+                if task is not None:
+                    task.cancel()
+            loop.remove_reader(inotify.fileno())
+            inotify.close()
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._executor.shutdown(wait=True)
+            if self.summaries is not None:
+                self.summaries.close()
+            if self.index_push_seconds:
+                dump_index.push(self.path_to_directory)
+            main.i_am_dead()
+
+
+def run(path_to_directory: str = "./"):
+    """Run the asyncio engine on a directory until SIGTERM.
+
+    Args:
+        path_to_directory (str, optional): Directory to watch. Defaults to "./".
+    """
+    metrics.start()
+    asyncio.run(AsyncEngine(path_to_directory).run())
+
+
+if __name__ == "__main__":
+    logger.info("Watching `%s` for core dumps with the asyncio engine.", sys.argv[1])
+    run(path_to_directory=sys.argv[1])
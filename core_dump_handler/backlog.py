@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Find core dumps in the watched directory that were never uploaded.
+
+inotify only reports dumps written while the handler is running. Dumps written while it was down or restarting, and
+dumps whose upload failed, stay in the directory until a scan finds them. A dump is only picked up once it has
+settled: it has not been modified for a while and no process has it open.
+"""
+
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+
+def open_files(proc: str = "/proc") -> set:
+    """Paths of every file any visible process has open.
+
+    Processes that vanish or cannot be inspected while walking `/proc` are skipped. On the host PID namespace this
+    includes the kernel helper writing a dump through `core_pattern`.
+
+    Args:
+        proc (str, optional): Mount point of procfs. Defaults to "/proc".
+
+    Returns:
+        set: Absolute paths.
+    """
+    paths = set()
+    try:
+        pids = [pid for pid in os.listdir(proc) if pid.isdigit()]
+    except OSError:
+        return paths
+    for pid in pids:
+        fd_dir = os.path.join(proc, pid, "fd")
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                paths.add(os.readlink(os.path.join(fd_dir, fd)))
+            except OSError:
+                continue
+    return paths
+
+
+def scan(
+    path_to_directory: str,
+    min_age: int = int(os.environ.get("BACKLOG_MIN_AGE", "60")),
+    proc: str = "/proc",
+) -> list:
+    """List the settled `core` files in a directory.
+
+    Args:
+        path_to_directory (str): Watched directory.
+        min_age (int, optional): Seconds since the last modification before a file counts as settled.
+        Defaults to os.environ.get("BACKLOG_MIN_AGE", "60").
+        proc (str, optional): Mount point of procfs. Defaults to "/proc".
+
+    Returns:
+        list: `(file_name, size)` tuples, oldest first.
+    """
+    now = time.time()
+    candidates = []
+    with os.scandir(path_to_directory) as entries:
+        for entry in entries:
+            if not entry.name.startswith("core") or not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if now - stat.st_mtime < min_age:
+                logger.debug("Skipping %s, modified %.0f seconds ago.", entry.name, now - stat.st_mtime)
+                continue
+            candidates.append((stat.st_mtime, entry.name, stat.st_size))
+    if not candidates:
+        return []
+    in_use = open_files(proc)
+    settled = []
+    for _, file_name, size in sorted(candidates):
+        if os.path.abspath(os.path.join(path_to_directory, file_name)) in in_use:
+            logger.debug("Skipping %s, it is still open.", file_name)
+            continue
+        settled.append((file_name, size))
+    if settled:
+        logger.info("Found %s core dumps waiting in %s.", len(settled), path_to_directory)
+    return settled
+
+
+def pending_bytes(path_to_directory: str) -> int:
+    """Bytes of the `core` files in a directory that are waiting to be uploaded, settled or not.
+
+    Args:
+        path_to_directory (str): Watched directory.
+
+    Returns:
+        int: Total size in bytes.
+    """
+    total = 0
+    with os.scandir(path_to_directory) as entries:
+        for entry in entries:
+            if entry.name.startswith("core") and entry.is_file(follow_symlinks=False):
+                try:
+                    total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    return total
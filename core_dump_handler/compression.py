@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Compress core dumps in the handler while they are uploaded.
+
+The dump is read in chunks that are compressed in parallel by a small thread pool, zlib and zstd release the GIL, and
+handed to the upload in order. The chunks beyond the first one are charged to the transfer budget. Every chunk is a
+complete gzip member or zstd frame, concatenated they are a valid `.gz` or `.zst` file, so `gunzip` and `zstd -d`
+restore the dump as usual. Nothing is written to disk.
+
+zstd needs the optional `zstandard` package, gzip is used if it is not installed.
+"""
+
+import collections
+import gzip
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+CHUNK_SIZE = 4 * 1024 * 1024
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+# Fastest and strongest level picked by `pick_level()`. Stronger levels cost a lot of CPU for little gain on dumps.
+LEVELS = {"gzip": (1, 6), "zstd": (1, 9)}
+# Leading bytes of gzip, zstd, xz and bzip2 files.
+MAGIC = (b"\x1f\x8b", b"\x28\xb5\x2f\xfd", b"\xfd7zXZ\x00", b"BZh")
+# Suffix of the tail of a compressed stream `pipe_ingest.py` spilled after the head reached S3. The tail has no magic
+# of its own, it is uploaded byte for byte next to the object it continues.
+REST_SUFFIX = ".rest"
+
+
+def available_cpus(cgroup: str = "/sys/fs/cgroup") -> int:
+    """CPUs this process may use: the CPUs it may run on, capped by the CPU quota of its cgroup.
+
+    Args:
+        cgroup (str, optional): Mount point of the cgroup filesystem. Defaults to "/sys/fs/cgroup".
+
+    Returns:
+        int: CPUs, at least 1.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = cpu_quota(cgroup)
+    if quota is not None:
+        cpus = min(cpus, math.ceil(quota))
+    return max(cpus, 1)
+
+
+def cpu_quota(cgroup: str = "/sys/fs/cgroup") -> float:
+    """CPU limit of the container, from `cpu.max` of cgroup v2 or the CFS quota of cgroup v1.
+
+    Args:
+        cgroup (str, optional): Mount point of the cgroup filesystem. Defaults to "/sys/fs/cgroup".
+
+    Returns:
+        float: CPUs the quota allows, None without a quota.
+    """
+    try:
+        with open(os.path.join(cgroup, "cpu.max"), encoding="utf-8") as cpu_max:
+            quota, period = cpu_max.read().split()
+    except (OSError, ValueError):
+        try:
+            with open(os.path.join(cgroup, "cpu", "cpu.cfs_quota_us"), encoding="utf-8") as cfs_quota:
+                quota = cfs_quota.read().strip()
+            with open(os.path.join(cgroup, "cpu", "cpu.cfs_period_us"), encoding="utf-8") as cfs_period:
+                period = cfs_period.read().strip()
+        except OSError:
+            return None
+    if quota in ("max", "-1"):
+        return None
+    try:
+        return int(quota) / int(period)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def is_compressed(file_name: str) -> bool:
+    """Check the leading bytes of a file for a known compression format.
+
+    Args:
+        file_name (str): File to check.
+
+    Returns:
+        bool: True if the file is gzip, zstd, xz or bzip2 compressed.
+    """
+    with open(file_name, "rb") as dump:
+        head = dump.read(6)
+    return any(head.startswith(magic) for magic in MAGIC)
+
+
+def is_rest(file_name: str) -> bool:
+    """Check if a file is the spilled tail of a compressed stream, see `REST_SUFFIX`.
+
+    Args:
+        file_name (str): File name, with or without directory.
+
+    Returns:
+        bool: True if the file must be uploaded as it is.
+    """
+    return file_name.endswith(REST_SUFFIX)
+
+
+def codec(name: str) -> str:
+    """Resolve the `COMPRESSION` setting to a codec that is available.
+
+    Args:
+        name (str): "off", "gzip" or "zstd".
+
+    Returns:
+        str: Key of `EXTENSIONS`, None if compression is off.
+    """
+    name = name.lower()
+    if name in ("", "off", "false", "none"):
+        return None
+    if name not in EXTENSIONS:
+        raise ValueError(f"Unknown compression {name!r}, use one of {', '.join(EXTENSIONS)} or off.")
+    if name == "zstd" and zstandard is None:
+        logger.warning("zstandard is not installed, compressing with gzip.")
+        return "gzip"
+    return name
+
+
+def pick_level(name: str, queued: int = 0, load: float = None, cpus: int = None) -> int:
+    """Compression level for the next dump.
+
+    The fastest level is used while dumps are waiting for a worker or the CPUs are busy. The idler the CPUs, the
+    stronger the level. The load of the node is measured against the CPUs the handler may use, so a handler limited to
+    a few CPUs of a busy node compresses fast.
+
+    Args:
+        name (str): Codec, a key of `EXTENSIONS`.
+        queued (int, optional): Dumps waiting for a worker. Defaults to 0.
+        load (float, optional): 1 minute load average. Defaults to None, read from the system.
+        cpus (int, optional): CPUs available. Defaults to None, `available_cpus()`.
+
+    Returns:
+        int: Compression level.
+    """
+    fastest, strongest = LEVELS[name]
+    if queued:
+        return fastest
+    cpus = cpus or available_cpus()
+    load = os.getloadavg()[0] if load is None else load
+    idle = max(0.0, 1 - load / cpus)
+    return fastest + int((strongest - fastest) * idle)
+
+
+def _compressor(name: str, level: int) -> object:
+    if name == "zstd":
+        # Compressor objects are not thread safe, every chunk gets its own.
+        return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compressed_chunks(
+    source: object,
+    name: str = "gzip",
+    level: int = 1,
+    chunk_size: int = CHUNK_SIZE,
+    threads: int = int(os.environ.get("COMPRESSION_THREADS", "2")),
+    budget: object = None,
+) -> object:
+    """Compress a stream in independent chunks, in parallel.
+
+    At most `threads + 1` chunks are held in memory. With a budget, every chunk in flight but the first one is charged
+    to it. The charge is only taken if it is free right away, otherwise fewer chunks are compressed at once, so the
+    compression never waits for budget held by the part buffers it has to fill.
+
+    Args:
+        source (object): Binary file-like object to compress.
+        name (str, optional): Codec, a key of `EXTENSIONS`. Defaults to "gzip".
+        level (int, optional): Compression level. Defaults to 1.
+        chunk_size (int, optional): Uncompressed bytes per chunk. Defaults to 4MiB.
+        threads (int, optional): Chunks compressed at once, 0 for every CPU `available_cpus()` allows.
+        Defaults to os.environ.get("COMPRESSION_THREADS", "2").
+        budget (transfer_budget.TransferBudget, optional): In-flight byte budget shared by every worker.
+        Defaults to None (unlimited).
+
+    Yields:
+        bytes: Compressed chunks, in order.
+    """
+    compress = _compressor(name, level)
+    threads = threads or available_cpus()
+    # `(future, charged bytes)` of the chunks in flight, oldest first.
+    window = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="compress")
+
+    def oldest() -> bytes:
+        future, charged = window.popleft()
+        try:
+            return future.result()
+        finally:
+            if charged:
+                budget.release(charged)
+
+    try:
+        empty = True
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            empty = False
+            charged = 0
+            while window:
+                if len(window) < threads and (budget is None or budget.acquire(len(chunk), timeout=0)):
+                    charged = len(chunk) if budget is not None else 0
+                    break
+                yield oldest()
+            window.append((executor.submit(compress, chunk), charged))
+        if empty:
+            window.append((executor.submit(compress, b""), 0))
+        while window:
+            yield oldest()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        while window:
+            _, charged = window.popleft()
+            if charged:
+                budget.release(charged)
+
+
+class CompressedReader:
+    """Read-only file-like object with the compressed contents of a stream, for `multipart_upload.upload_parts()`."""
+
+    def __init__(self, source: object, name: str = "gzip", level: int = 1, **kwargs):
+        """Start compressing.
+
+        Args:
+            source (object): Binary file-like object to compress, closed with the reader.
+            name (str, optional): Codec, a key of `EXTENSIONS`. Defaults to "gzip".
+            level (int, optional): Compression level. Defaults to 1.
+            **kwargs: Passed on to `compressed_chunks()`.
+        """
+        self._source = source
+        self._chunks = compressed_chunks(source, name=name, level=level, **kwargs)
+        self._pending = b""
+        self._offset = 0
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._chunks.close()
+        self._source.close()
+
+    def readinto(self, buffer: object) -> int:
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        while filled < len(view):
+            if self._offset == len(self._pending):
+                self._pending = next(self._chunks, b"")
+                self._offset = 0
+                if not self._pending:
+                    break
+            count = min(len(view) - filled, len(self._pending) - self._offset)
+            view[filled : filled + count] = self._pending[self._offset : self._offset + count]
+            self._offset += count
+            filled += count
+        self._position += filled
+        return filled
+
+    def read(self, size: int = -1) -> bytes:
+        if size is not None and size >= 0:
+            buffer = bytearray(size)
+            return bytes(buffer[: self.readinto(buffer)])
+        data = bytearray(self._pending[self._offset :])
+        self._offset = len(self._pending)
+        for chunk in self._chunks:
+            data += chunk
+        self._position += len(data)
+        return bytes(data)
+
+    def tell(self) -> int:
+        """Compressed bytes read so far."""
+        return self._position
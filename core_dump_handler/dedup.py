@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Deduplication of repeated core dumps from crash loops.
+
+A crash looping pod dumps the same crash over and over. Its dumps differ in every byte that holds a PID, a time or an
+address randomized by ASLR, so they are matched on a fingerprint of what stays the same instead: the executable, the
+signal and the instruction that crashed, as a file and offset read from the ELF notes. `DEDUP_SAMPLED_BLOCKS` adds the
+dump size and hashes of blocks at fixed offsets, for a stricter match or for files that are not ELF core dumps.
+
+The parent keeps the fingerprints of recent full uploads in `FingerprintCache`, an LRU cache whose entries expire
+`DEDUP_TTL_SECONDS` after the upload, so every crash gets a fresh full dump now and then. A dump matching a cached
+fingerprint is not uploaded, only `<dump>.duplicate.json` pointing to the first full upload.
+"""
+
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+import scheduler
+import triage
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+DUPLICATE_SUFFIX = ".duplicate.json"
+BLOCK_SIZE = 4096
+
+
+def crash_signature(summary: dict) -> dict:
+    """Fields of a triage summary that are the same for every dump of one crash.
+
+    Args:
+        summary (dict): From `triage.summarize()`.
+
+    Returns:
+        dict: Signature, None if the crashing instruction is not in a mapped file, e.g. in JIT compiled code.
+    """
+    if "crash_location" not in summary:
+        return None
+    return {
+        "executable": summary.get("executable"),
+        "machine": summary.get("machine"),
+        "signal": summary.get("signal"),
+        "signal_code": summary.get("signal_code"),
+        "crash_location": summary["crash_location"],
+    }
+
+
+def fingerprint(
+    file_name: str, sampled_blocks: int = int(os.environ.get("DEDUP_SAMPLED_BLOCKS", "0")), block_size: int = BLOCK_SIZE
+) -> str:
+    """Fingerprint of a core dump. Reads the ELF notes and `sampled_blocks` blocks, never the whole dump.
+
+    Args:
+        file_name (str): Core dump, plain, gzip or zstd compressed.
+        sampled_blocks (int, optional): Also hash the size and this many blocks at fixed offsets. 0 only uses the
+        crash signature. Defaults to os.environ.get("DEDUP_SAMPLED_BLOCKS", "0").
+        block_size (int, optional): Bytes per sampled block. Defaults to 4KiB.
+
+    Returns:
+        str: Hex digest, None if the dump cannot be fingerprinted.
+    """
+    try:
+        signature = crash_signature(triage.summarize(file_name))
+    except triage.NotACore:
+        signature = None
+    except Exception as e:  # pylint: disable=W0718
+        logger.debug(f"Could not read the notes of {file_name}: {e!r}")
+        signature = None
+    if signature is None and not sampled_blocks:
+        return None
+    digest = hashlib.sha256(json.dumps(signature, sort_keys=True).encode("utf-8"))
+    if sampled_blocks:
+        size = os.path.getsize(file_name)
+        digest.update(str(size).encode("ascii"))
+        with open(file_name, "rb") as dump:
+            for index in range(sampled_blocks):
+                dump.seek(size * index // sampled_blocks)
+                digest.update(hashlib.sha256(dump.read(block_size)).digest())
+    return digest.hexdigest()
+
+
+class FingerprintCache:
+    """LRU cache of the fingerprints of recent full uploads, with entries that expire.
+
+    Only the parent process holds it. Engine threads and pool callbacks use it at once, so all methods are thread safe.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = int(os.environ.get("DEDUP_CACHE_SIZE", "512")),
+        ttl_seconds: int = int(os.environ.get("DEDUP_TTL_SECONDS", "3600")),
+        executables: str = os.environ.get("DEDUP_EXECUTABLES", "*"),
+        exclude: str = os.environ.get("DEDUP_EXCLUDE", ""),
+    ):
+        """Create an empty cache.
+
+        Args:
+            max_entries (int, optional): Fingerprints kept, the least recently matched go first.
+            Defaults to os.environ.get("DEDUP_CACHE_SIZE", "512").
+            ttl_seconds (int, optional): Seconds after its upload a dump stops being the original of duplicates.
+            Defaults to os.environ.get("DEDUP_TTL_SECONDS", "3600").
+            executables (str, optional): Comma separated patterns of the executables (`%e`) to deduplicate.
+            Defaults to os.environ.get("DEDUP_EXECUTABLES", "*").
+            exclude (str, optional): Comma separated patterns of executables always uploaded in full.
+            Defaults to os.environ.get("DEDUP_EXCLUDE", "").
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.executables = [pattern.strip() for pattern in executables.split(",") if pattern.strip()]
+        self.exclude = [pattern.strip() for pattern in exclude.split(",") if pattern.strip()]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def enabled_for(self, file_name: str) -> bool:
+        """Check if dumps of the executable in a `core-%e-%t-%p-%s` file name are deduplicated.
+
+        Args:
+            file_name (str): Core dump file name, with or without directory.
+
+        Returns:
+            bool: True if the executable matches `executables` and not `exclude`.
+        """
+        parts = scheduler.parse_core_file_name(os.path.basename(file_name))
+        executable = parts["exe"] if parts else ""
+        if any(fnmatch.fnmatchcase(executable, pattern) for pattern in self.exclude):
+            return False
+        return any(fnmatch.fnmatchcase(executable, pattern) for pattern in self.executables)
+
+    def get(self, key: str, now: float = None) -> str:
+        """Original upload of a fingerprint.
+
+        Args:
+            key (str): Fingerprint.
+            now (float, optional): Current `time.monotonic()`. Defaults to None.
+
+        Returns:
+            str: S3 URI of the original, None if the fingerprint is unknown or expired.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now - entry[1] > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def add(self, key: str, uri: str, now: float = None):
+        """Remember the full upload of a fingerprint.
+
+        Args:
+            key (str): Fingerprint.
+            uri (str): S3 URI of the upload.
+            now (float, optional): Current `time.monotonic()`. Defaults to None.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._entries[key] = (uri, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def check(self, file_name: str) -> tuple:
+        """Fingerprint a dump and look up its original.
+
+        Args:
+            file_name (str): Core dump file, with directory.
+
+        Returns:
+            tuple: `(fingerprint, original URI)`. Both are None if the executable is not deduplicated or the dump has
+            no fingerprint, the original is None if the dump is not a duplicate.
+        """
+        if not self.enabled_for(file_name):
+            return None, None
+        key = fingerprint(file_name)
+        if key is None:
+            return None, None
+        return key, self.get(key)
+
+
+def duplicate_record(file_name: str, original: str, key: str) -> bytes:
+    """Metadata object uploaded instead of a duplicate dump.
+
+    Args:
+        file_name (str): Core dump file.
+        original (str): S3 URI of the full upload it duplicates.
+        key (str): Fingerprint.
+
+    Returns:
+        bytes: JSON document.
+    """
+    record = {
+        "version": 1,
+        "dump": os.path.basename(file_name),
+        "size": os.path.getsize(file_name),
+        "duplicate_of": original,
+        "fingerprint": key,
+    }
+    try:
+        record["summary"] = triage.summarize(file_name)
+    except Exception as e:  # pylint: disable=W0718
+        logger.debug(f"No summary for {file_name}: {e!r}")
+    return json.dumps(record).encode("utf-8")
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Watchdog of the free space on the filesystem of the watched directory.
+
+When uploads cannot keep up, dumps pile up until the node's disk is full, the kubelet starts evicting pods and the
+next dumps are cut short. The watchdog is off unless `DISK_HIGH_WATERMARK` is set. It reads the usage of the
+filesystem with `statvfs`. Above `DISK_HIGH_WATERMARK` the scheduler hands out the newest dumps first and the watchdog
+deletes dumps that are not with a worker until usage is back under `DISK_LOW_WATERMARK`: first duplicates of a dump
+already uploaded, then the oldest dumps. The newest dump and dumps younger than `DISK_EVICT_MIN_AGE` are never
+evicted, and nothing is evicted if the dumps cannot free enough space, e.g. because something else fills the disk.
+Every eviction is appended to `.evictions.jsonl` in the watched directory, so a dump missing from the bucket can be
+accounted for.
+"""
+
+import json
+import logging
+import os
+import time
+import backlog
+import metrics
+import scheduler
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+MANIFEST = ".evictions.jsonl"
+DUPLICATE = "duplicate"
+OLDEST = "oldest"
+
+
+def disk_usage(path: str) -> tuple:
+    """Usage of the filesystem a path is on, as seen by unprivileged processes.
+
+    Args:
+        path (str): Any path on the filesystem.
+
+    Returns:
+        tuple: `(used ratio, bytes available)`. The ratio counts the blocks reserved for root as used, like `df`.
+    """
+    stat = os.statvfs(path)
+    total = stat.f_blocks * stat.f_frsize
+    available = stat.f_bavail * stat.f_frsize
+    if not total:
+        return 0.0, available
+    return 1 - available / total, available
+
+
+def disk_size(path: str) -> int:
+    """Size in bytes of the filesystem a path is on."""
+    stat = os.statvfs(path)
+    return stat.f_blocks * stat.f_frsize
+
+
+def allocated(path: str) -> int:
+    """Bytes deleting a file frees, less than its size for sparse files. 0 if it is gone."""
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+def read_manifest(path_to_directory: str) -> list:
+    """Eviction records of a directory.
+
+    Args:
+        path_to_directory (str): Watched directory.
+
+    Returns:
+        list: Records, oldest first.
+    """
+    try:
+        with open(os.path.join(path_to_directory, MANIFEST), encoding="utf-8") as manifest:
+            return [json.loads(line) for line in manifest if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+class DiskWatchdog:
+    """Put the scheduler under pressure and evict dumps while the watched filesystem is running full."""
+
+    def __init__(
+        self,
+        path_to_directory: str,
+        high_watermark: float = float(os.environ.get("DISK_HIGH_WATERMARK", "1")),
+        low_watermark: float = float(os.environ.get("DISK_LOW_WATERMARK", "0.75")),
+        check_seconds: float = float(os.environ.get("DISK_CHECK_SECONDS", "5")),
+        min_age: int = int(os.environ.get("DISK_EVICT_MIN_AGE", "300")),
+    ):
+        """Create the watchdog. Nothing is checked until `check()` is called.
+
+        Args:
+            path_to_directory (str): Watched directory.
+            high_watermark (float, optional): Used share of the filesystem that starts pressure and eviction. 1 or
+            more disables the watchdog. Defaults to os.environ.get("DISK_HIGH_WATERMARK", "1").
+            low_watermark (float, optional): Used share the eviction brings the filesystem back under, pressure ends
+            below it. Defaults to os.environ.get("DISK_LOW_WATERMARK", "0.75").
+            check_seconds (float, optional): Seconds between two reads of the usage.
+            Defaults to os.environ.get("DISK_CHECK_SECONDS", "5").
+            min_age (int, optional): Seconds since the last modification before a dump can be evicted.
+            Defaults to os.environ.get("DISK_EVICT_MIN_AGE", "300").
+        """
+        if low_watermark > high_watermark:
+            raise ValueError(f"DISK_LOW_WATERMARK {low_watermark} is above DISK_HIGH_WATERMARK {high_watermark}.")
+        self.path_to_directory = path_to_directory
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.check_seconds = check_seconds
+        self.min_age = min_age
+        self.pressure = False
+        self._next_check = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        """False if the high watermark can never be crossed."""
+        return self.high_watermark < 1
+
+    def check(
+        self, upload_scheduler: scheduler.UploadScheduler, fingerprints: object = None, now: float = None
+    ) -> list:
+        """Read the usage at most every `check_seconds`, update the scheduler's pressure and evict if needed.
+
+        Args:
+            upload_scheduler (scheduler.UploadScheduler): Scheduler of the watched directory.
+            fingerprints (dedup.FingerprintCache, optional): Recent uploads, to evict duplicates first.
+            Defaults to None.
+            now (float, optional): Current `time.monotonic()`. Defaults to None.
+
+        Returns:
+            list: Eviction records, empty if nothing was evicted.
+        """
+        now = time.monotonic() if now is None else now
+        if not self.enabled or now < self._next_check:
+            return []
+        self._next_check = now + self.check_seconds
+        try:
+            usage, available = disk_usage(self.path_to_directory)
+        except OSError as e:
+            logger.warning(f"Could not read the disk usage of {self.path_to_directory}: {e}")
+            return []
+        metrics.set_gauge("disk_usage_ratio", usage)
+        # Hysteresis, so the scheduler does not flip between orders around one watermark.
+        pressure = usage >= self.high_watermark or (self.pressure and usage >= self.low_watermark)
+        if pressure != self.pressure:
+            if pressure:
+                logger.warning(
+                    "%s is %.0f%% full, %s bytes left. Uploading the newest dumps first.",
+                    self.path_to_directory,
+                    usage * 100,
+                    available,
+                )
+            else:
+                logger.info("%s is %.0f%% full, back to the usual upload order.", self.path_to_directory, usage * 100)
+            self.pressure = pressure
+            upload_scheduler.set_pressure(pressure)
+        if usage < self.high_watermark:
+            return []
+        return self.evict(upload_scheduler, fingerprints, usage)
+
+    def candidates(self, upload_scheduler: scheduler.UploadScheduler, fingerprints: object = None) -> list:
+        """Dumps that can be evicted, in the order they are evicted.
+
+        Dumps still being written, dumps with a worker, dumps younger than `min_age` and the newest dump are never
+        evicted.
+
+        Args:
+            upload_scheduler (scheduler.UploadScheduler): Scheduler of the watched directory.
+            fingerprints (dedup.FingerprintCache, optional): Recent uploads. Defaults to None.
+
+        Returns:
+            list: `(file_name, size, reason, duplicate_of)` tuples, duplicates first, then oldest first.
+        """
+        duplicates = []
+        oldest = []
+        # The newest dump is either too young or the last one settled, it is kept in both cases.
+        for file_name, size in backlog.scan(self.path_to_directory, min_age=self.min_age)[:-1]:
+            if upload_scheduler.is_in_flight(file_name):
+                continue
+            original = None
+            if fingerprints is not None:
+                try:
+                    _, original = fingerprints.check(os.path.join(self.path_to_directory, file_name))
+                except OSError:
+                    continue
+            if original is not None:
+                duplicates.append((file_name, size, DUPLICATE, original))
+            else:
+                oldest.append((file_name, size, OLDEST, None))
+        return duplicates + oldest
+
+    def evict(
+        self, upload_scheduler: scheduler.UploadScheduler, fingerprints: object = None, usage: float = None
+    ) -> list:
+        """Delete dumps until usage is under the low watermark or nothing is left to evict.
+
+        Nothing is evicted if deleting every candidate would still leave usage above the low watermark, the disk is
+        then filled by something else and deleting dumps would lose them for nothing.
+
+        Args:
+            upload_scheduler (scheduler.UploadScheduler): Scheduler of the watched directory.
+            fingerprints (dedup.FingerprintCache, optional): Recent uploads. Defaults to None.
+            usage (float, optional): Current used share. Defaults to None, read it.
+
+        Returns:
+            list: Eviction records.
+        """
+        if usage is None:
+            usage, _ = disk_usage(self.path_to_directory)
+        candidates = self.candidates(upload_scheduler, fingerprints)
+        needed = (usage - self.low_watermark) * disk_size(self.path_to_directory)
+        reclaimable = sum(allocated(os.path.join(self.path_to_directory, candidate[0])) for candidate in candidates)
+        if reclaimable < needed:
+            logger.error(
+                "%s is %.0f%% full, but its dumps only take %s of the %.0f bytes needed to get under %.0f%%. "
+                "Evicting none.",
+                self.path_to_directory,
+                usage * 100,
+                reclaimable,
+                needed,
+                self.low_watermark * 100,
+            )
+            return []
+        evicted = []
+        for file_name, size, reason, original in candidates:
+            if usage < self.low_watermark:
+                break
+            path = os.path.join(self.path_to_directory, file_name)
+            # Taking it out of the scheduler fails once a worker has it, the upload frees the space then.
+            if not upload_scheduler.forget(file_name):
+                continue
+            try:
+                modified = os.path.getmtime(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning(f"Could not evict {file_name}: {e}")
+                continue
+            usage_after, _ = disk_usage(self.path_to_directory)
+            parts = scheduler.parse_core_file_name(file_name) or {}
+            entry = {
+                "name": file_name,
+                "evicted_at": round(time.time(), 3),
+                "modified_at": round(modified, 3),
+                "size": size,
+                "reason": reason,
+                "duplicate_of": original,
+                "executable": parts.get("exe"),
+                "signal": parts.get("signal"),
+                "usage_before": round(usage, 4),
+                "usage_after": round(usage_after, 4),
+            }
+            self.record(entry)
+            metrics.inc("evictions_total", reason=reason)
+            metrics.inc("evicted_bytes_total", size)
+            logger.warning(
+                "Evicted %s (%s bytes, %s), the disk is %.0f%% full.", file_name, size, reason, usage_after * 100
+            )
+            evicted.append(entry)
+            usage = usage_after
+        if usage >= self.low_watermark:
+            logger.error(
+                "%s is still %.0f%% full, no dump left that can be evicted.", self.path_to_directory, usage * 100
+            )
+        return evicted
+
+    def record(self, entry: dict):
+        """Append an eviction to the manifest of the watched directory.
+
+        Args:
+            entry (dict): Eviction record.
+        """
+        try:
+            with open(os.path.join(self.path_to_directory, MANIFEST), "a", encoding="utf-8") as manifest:
+                manifest.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            # A full disk is the likely reason, the eviction itself still happened.
+            logger.warning(f"Could not record the eviction of {entry['name']}: {e}")
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Index of uploaded core dumps, and the S3 keys they are uploaded under.
+
+Every upload appends one JSON line to `.dump_index/active.jsonl` in the watched directory. Workers append under an
+exclusive `flock()`, so any number of them can share the file. The handler periodically seals the active file,
+compacts the sealed segments into `.dump_index/index.jsonl`, dropping records older than the retention, and uploads
+it as `<INDEX_PREFIX><node>.jsonl`. Finding dumps then means reading one small object per node instead of listing the
+whole bucket.
+
+Query the indexes of all nodes with:
+    python dump_index.py query --bucket my-bucket --executable myapp --signal SIGSEGV --days 7
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+import boto3
+import botocore
+import multipart_upload
+import scheduler
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+INDEX_DIR = ".dump_index"
+ACTIVE = "active.jsonl"
+COMPACTED = "index.jsonl"
+SEGMENT_PREFIX = "segment-"
+
+
+def node_name() -> str:
+    """Name of the node the handler runs on, `NODE_NAME` or the host name."""
+    return os.environ.get("NODE_NAME") or socket.gethostname()
+
+
+def object_key(file_name: str, template: str = os.environ.get("S3_KEY_TEMPLATE", "{name}"), node: str = None) -> str:
+    """S3 object name of a dump.
+
+    The template may use `{name}`, the file name, `{node}`, `{date}` (YYYY-MM-DD), `{year}`, `{month}`, `{day}`,
+    `{executable}` and `{signal}`. The date, executable and signal come from the `core-%e-%t-%p-%s` file name, dumps
+    named otherwise use the current date and `unknown`.
+
+    Args:
+        file_name (str): Core dump file, with or without directory.
+        template (str, optional): Key template. Defaults to os.environ.get("S3_KEY_TEMPLATE", "{name}").
+        node (str, optional): Node name. Defaults to None, `node_name()`.
+
+    Returns:
+        str: S3 object name.
+    """
+    name = os.path.basename(file_name)
+    parts = scheduler.parse_core_file_name(name)
+    when = time.gmtime(parts["time"] if parts else time.time())
+    return template.format(
+        name=name,
+        node=node or node_name(),
+        date=time.strftime("%Y-%m-%d", when),
+        year=time.strftime("%Y", when),
+        month=time.strftime("%m", when),
+        day=time.strftime("%d", when),
+        executable=parts["exe"] if parts else "unknown",
+        signal=parts["signal"] if parts else "unknown",
+    ).lstrip("/")
+
+
+def signal_name(number: int) -> str:
+    try:
+        return signal.Signals(number).name
+    except ValueError:
+        return str(number)
+
+
+class DumpIndex:
+    """The index files of one watched directory."""
+
+    def __init__(self, path_to_directory: str):
+        """Locate the index of a watched directory. Nothing is created until the first `append()`.
+
+        Args:
+            path_to_directory (str): Watched directory.
+        """
+        self.directory = os.path.join(path_to_directory, INDEX_DIR)
+        self.active = os.path.join(self.directory, ACTIVE)
+        self.compacted = os.path.join(self.directory, COMPACTED)
+
+    def append(self, record: dict):
+        """Append a record. Safe to call from any number of processes.
+
+        Args:
+            record (dict): JSON serializable record.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        while True:
+            fd = os.open(self.active, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # `seal()` may have moved the file between the open and the lock, append to the new one instead.
+                try:
+                    current = os.stat(self.active).st_ino == os.fstat(fd).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    os.write(fd, line)
+                    return
+            finally:
+                os.close(fd)
+
+    def seal(self) -> str:
+        """Move the active file aside as a segment, once no process is appending to it.
+
+        Returns:
+            str: Path of the segment, None if there was nothing to seal.
+        """
+        segment = os.path.join(self.directory, f"{SEGMENT_PREFIX}{time.time_ns()}.jsonl")
+        try:
+            os.replace(self.active, segment)
+        except FileNotFoundError:
+            return None
+        with open(segment, "rb") as sealed:
+            # Waits for an append that opened the file before it was moved.
+            fcntl.flock(sealed.fileno(), fcntl.LOCK_EX)
+        return segment
+
+    def segments(self) -> list:
+        """Paths of the sealed segments, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [
+            os.path.join(self.directory, name)
+            for name in sorted(names)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(".jsonl")
+        ]
+
+    def records(self) -> object:
+        """Every record: compacted, sealed, then active.
+
+        Yields:
+            dict: Record.
+        """
+        for path in (self.compacted, *self.segments(), self.active):
+            yield from read_records(path)
+
+    def compact(self, retention_days: int = int(os.environ.get("INDEX_RETENTION_DAYS", "90"))) -> int:
+        """Seal the active file and merge all segments into the compacted index.
+
+        A dump uploaded more than once keeps its latest record.
+
+        Args:
+            retention_days (int, optional): Records of uploads older than this are dropped. 0 keeps everything.
+            Defaults to os.environ.get("INDEX_RETENTION_DAYS", "90").
+
+        Returns:
+            int: Records in the compacted index.
+        """
+        self.seal()
+        segments = self.segments()
+        oldest = time.time() - retention_days * 86400 if retention_days else 0
+        merged = {}
+        for path in (self.compacted, *segments):
+            for record in read_records(path):
+                if record.get("uploaded_at", 0) >= oldest:
+                    merged.pop(record.get("uri"), None)
+                    merged[record.get("uri")] = record
+        if not merged and not os.path.exists(self.compacted):
+            return 0
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = f"{self.compacted}.tmp"
+        with open(temporary, "w", encoding="utf-8") as compacted:
+            for record in merged.values():
+                compacted.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.replace(temporary, self.compacted)
+        for path in segments:
+            os.remove(path)
+        logger.debug("Compacted %s segments, %s records in the index.", len(segments), len(merged))
+        return len(merged)
+
+    def push(
+        self,
+        s3: object,
+        bucket: str,
+        prefix: str = os.environ.get("INDEX_PREFIX", "_index/"),
+        node: str = None,
+        checksum_algorithm: str = os.environ.get("CHECKSUM_ALGORITHM", "SHA256"),
+    ) -> str:
+        """Compact the index and upload it as `<prefix><node>.jsonl`.
+
+        Args:
+            s3 (object): boto3 S3 client.
+            bucket (str): Bucket to upload to.
+            prefix (str, optional): Key prefix of the indexes. Defaults to os.environ.get("INDEX_PREFIX", "_index/").
+            node (str, optional): Node name. Defaults to None, `node_name()`.
+            checksum_algorithm (str, optional): One of `multipart_upload.CHECKSUM_ALGORITHMS`.
+            Defaults to os.environ.get("CHECKSUM_ALGORITHM", "SHA256").
+
+        Returns:
+            str: S3 URI of the index, None if the index is empty.
+        """
+        count = self.compact()
+        if not count:
+            return None
+        object_name = f"{prefix}{node or node_name()}.jsonl"
+        multipart_upload.put_object(
+            s3,
+            self.compacted,
+            bucket,
+            object_name,
+            checksum_algorithm=checksum_algorithm,
+            extra_args={"ContentType": "application/x-ndjson"},
+        )
+        logger.info("Pushed the index of %s dumps to s3://%s/%s.", count, bucket, object_name)
+        return f"s3://{bucket}/{object_name}"
+
+
+def push(path_to_directory: str, bucket: str = os.environ.get("BUCKET_NAME"), s3: object = None) -> str:
+    """Push the index of a watched directory, see `DumpIndex.push()`. Failures are logged, not raised.
+
+    Args:
+        path_to_directory (str): Watched directory.
+        bucket (str, optional): Bucket to upload to. Defaults to os.environ.get("BUCKET_NAME").
+        s3 (object, optional): boto3 S3 client. Defaults to None, a new client. The handler's parent process must not
+        build the cached client of `upload_file_2_s3`, the pool workers it forks would share it.
+
+    Returns:
+        str: S3 URI of the index, None if the index is empty or could not be pushed.
+    """
+    if not bucket:
+        return None
+    try:
+        s3 = s3 or boto3.client("s3", region_name=os.environ.get("REGION"))
+        return DumpIndex(path_to_directory).push(s3, bucket)
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, OSError) as e:
+        logger.warning("Could not push the index of %s: %s", path_to_directory, e)
+        return None
+
+
+def read_records(path: str) -> object:
+    """Records of an index file. A line cut short by a crash is skipped.
+
+    Yields:
+        dict: Record.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as index:
+            for line in index:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("Skipping a damaged line in %s.", path)
+    except FileNotFoundError:
+        return
+
+
+def record(file_name: str, bucket: str, object_name: str, result: dict, **fields) -> dict:
+    """Add an upload to the index of the dump's directory.
+
+    Args:
+        file_name (str): Core dump file that was uploaded.
+        bucket (str): Bucket it was uploaded to.
+        object_name (str): S3 object name.
+        result (dict): Upload result from `multipart_upload`.
+        **fields: Further fields, e.g. sizes and timings.
+
+    Returns:
+        dict: The record.
+    """
+    name = os.path.basename(file_name)
+    parts = scheduler.parse_core_file_name(name) or {}
+    entry = {
+        "name": name,
+        "uri": f"s3://{bucket}/{object_name}",
+        "node": node_name(),
+        "executable": parts.get("exe"),
+        "pid": parts.get("pid"),
+        "signal": parts.get("signal"),
+        "signal_name": signal_name(parts["signal"]) if parts else None,
+        "crashed_at": parts.get("time"),
+        "uploaded_at": round(time.time(), 3),
+        "checksum": result.get("Checksum"),
+        "checksum_algorithm": result.get("Algorithm"),
+        "etag": result.get("ETag"),
+        **fields,
+    }
+    DumpIndex(os.path.dirname(file_name) or ".").append(entry)
+    return entry
+
+
+def matches(
+    entry: dict, executable: str = None, signal_filter: str = None, node: str = None, since: float = None
+) -> bool:
+    """Check a record against query filters. Unset filters match everything.
+
+    Args:
+        entry (dict): Record.
+        executable (str, optional): Executable name (`%e`). Defaults to None.
+        signal_filter (str, optional): Signal number or name, e.g. "11", "SIGSEGV" or "segv". Defaults to None.
+        node (str, optional): Node name. Defaults to None.
+        since (float, optional): Unix time the dump crashed at or after. Defaults to None.
+
+    Returns:
+        bool: True if the record matches.
+    """
+    if executable is not None and entry.get("executable") != executable:
+        return False
+    if node is not None and entry.get("node") != node:
+        return False
+    if signal_filter is not None:
+        wanted = signal_filter.upper()
+        if not wanted.isdigit() and not wanted.startswith("SIG"):
+            wanted = f"SIG{wanted}"
+        if wanted not in (str(entry.get("signal")), entry.get("signal_name")):
+            return False
+    if since is not None and (entry.get("crashed_at") or entry.get("uploaded_at", 0)) < since:
+        return False
+    return True
+
+
+def remote_records(s3: object, bucket: str, prefix: str = os.environ.get("INDEX_PREFIX", "_index/")) -> object:
+    """Records of the indexes every node pushed to S3.
+
+    Yields:
+        dict: Record.
+    """
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            body = s3.get_object(Bucket=bucket, Key=item["Key"])["Body"]
+            for line in body.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    query_parser = subparsers.add_parser("query", help="Print the records of matching dumps as JSON lines.")
+    source = query_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--bucket", help="Read the indexes every node pushed to this bucket.")
+    source.add_argument("--directory", help="Read the local index of this watched directory.")
+    query_parser.add_argument("--executable", help="Executable name, %%e of the core pattern.")
+    query_parser.add_argument("--signal", help="Signal number or name, e.g. 11 or SIGSEGV.")
+    query_parser.add_argument("--node", help="Node name.")
+    query_parser.add_argument("--days", type=float, help="Only dumps of the last this many days.")
+    args = parser.parse_args()
+    if args.bucket:
+        found = remote_records(boto3.client("s3", region_name=os.environ.get("REGION")), args.bucket)
+    else:
+        found = DumpIndex(args.directory).records()
+    cutoff = time.time() - args.days * 86400 if args.days else None
+    for entry in found:
+        if matches(entry, executable=args.executable, signal_filter=args.signal, node=args.node, since=cutoff):
+            sys.stdout.write(json.dumps(entry) + "\n")
@@ -3,8 +3,20 @@
 trap 'on_failure' EXIT
 
 start_app() {
+  if [ -n "$PIPE_SOCKET" ]; then
+    echo "Starting Core Dump Pipe Ingest on $PIPE_SOCKET"
+    python3 pipe_ingest.py serve "$PIPE_SOCKET" /core_dumps &
+  fi
   echo "Starting Core Dump Handler"
-  python3 main.py /core_dumps
+  if [ "$ENGINE" = "asyncio" ]; then
+    python3 async_engine.py /core_dumps &
+  else
+    python3 main.py /core_dumps &
+  fi
+  MAIN_PID=$!
+  # bash as PID 1 does not pass SIGTERM on, forward it so uploads are checkpointed before the pod stops.
+  trap 'kill -TERM "$MAIN_PID"; wait "$MAIN_PID"; exit $?' TERM INT
+  wait "$MAIN_PID"
 }
 
 on_failure () {
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Heartbeat file for the liveness probe.
+
+The startup check file says "started" from startup until the handler exits, even while its main loop is wedged or
+every upload is stuck. The main loop rewrites the heartbeat file every few seconds instead, with what it is doing and
+whether it is healthy. The probe runs `python3 heartbeat.py`, which fails once the heartbeat is older than
+`HEARTBEAT_MAX_AGE` seconds or reports the handler unhealthy:
+
+    python3 heartbeat.py [heartbeat file] [max age]
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+HEARTBEAT_FILE = "/core_dump_handler/heartbeat"
+
+
+class Heartbeat:
+    """Rewrites the heartbeat file at most every `interval_seconds`."""
+
+    def __init__(
+        self,
+        file_name: str = os.environ.get("HEARTBEAT_FILE", HEARTBEAT_FILE),
+        interval_seconds: float = float(os.environ.get("HEARTBEAT_SECONDS", "5")),
+    ):
+        """Create the heartbeat. Nothing is written until `beat()` is called.
+
+        Args:
+            file_name (str, optional): Heartbeat file. Defaults to os.environ.get("HEARTBEAT_FILE", HEARTBEAT_FILE).
+            interval_seconds (float, optional): Seconds between two writes.
+            Defaults to os.environ.get("HEARTBEAT_SECONDS", "5").
+        """
+        self.file_name = file_name
+        self.interval_seconds = interval_seconds
+        self._next_beat = 0.0
+
+    def beat(self, healthy: bool = True, reason: str = None, now: float = None, **status) -> bool:
+        """Write the heartbeat if it is due.
+
+        Args:
+            healthy (bool, optional): False fails the liveness probe. Defaults to True.
+            reason (str, optional): Why the handler is unhealthy. Defaults to None.
+            now (float, optional): Current `time.monotonic()`. Defaults to None.
+            **status: Further fields, e.g. queue depths.
+
+        Returns:
+            bool: True if the file was written.
+        """
+        now = time.monotonic() if now is None else now
+        if now < self._next_beat:
+            return False
+        self._next_beat = now + self.interval_seconds
+        record = {"time": round(time.time(), 3), "pid": os.getpid(), "healthy": healthy, "reason": reason, **status}
+        # Replace the file in one step, so the probe never reads half a heartbeat.
+        temporary = f"{self.file_name}.tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as heartbeat:
+                json.dump(record, heartbeat)
+            os.replace(temporary, self.file_name)
+        except OSError as e:
+            logger.warning(f"Could not write the heartbeat {self.file_name}: {e}")
+            return False
+        return True
+
+
+def check(
+    file_name: str = os.environ.get("HEARTBEAT_FILE", HEARTBEAT_FILE),
+    max_age: float = float(os.environ.get("HEARTBEAT_MAX_AGE", "30")),
+) -> tuple:
+    """Check a heartbeat file.
+
+    Args:
+        file_name (str, optional): Heartbeat file. Defaults to os.environ.get("HEARTBEAT_FILE", HEARTBEAT_FILE).
+        max_age (float, optional): Seconds after which a heartbeat is stale.
+        Defaults to os.environ.get("HEARTBEAT_MAX_AGE", "30").
+
+    Returns:
+        tuple: `(alive, reason)`, reason is None when alive.
+    """
+    try:
+        with open(file_name, encoding="utf-8") as heartbeat:
+            record = json.load(heartbeat)
+    except (OSError, ValueError) as e:
+        return False, f"No heartbeat in {file_name}: {e}"
+    age = time.time() - record.get("time", 0)
+    if age > max_age:
+        return False, f"Last heartbeat {age:.0f} seconds ago."
+    if not record.get("healthy", False):
+        return False, record.get("reason") or "Unhealthy."
+    return True, None
+
+
+if __name__ == "__main__":
+    alive, problem = check(*sys.argv[1:2], *map(float, sys.argv[2:3]))
+    if not alive:
+        print(problem)
+        sys.exit(1)
@@ -3,12 +3,29 @@
 Core Dump Handler
 """
 
+import functools
 import logging
-import os
 import multiprocessing
+import os
+import signal
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from inotify_simple import INotify, flags
-import upload_file_2_s3
+import backlog
+import compression
+import dedup
+import disk_watchdog
+import heartbeat
+import metrics
+import scheduler
+import stall_watchdog
+import throttle
+import transfer_budget
+import upload_pool
+
+# `upload_file_2_s3`, `upload_journal` and `dump_index` import boto3, which takes longer than the rest of the handler
+# together. They are imported where they are used, so the directory is watched before they are loaded.
 
 
 logger = logging.getLogger(__name__)
@@ -18,6 +35,9 @@ stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(formatter)
 logger.addHandler(stream_handler)
 
+# Worker processes of the upload pool, kept low to limit the resources taken by the core dump handler.
+POOL_PROCESSES = 4
+
 
 def i_am_started(file_name: str = "/core_dump_handler/startupcheck") -> bool:
     """Write a file stating the app has started for K8s start up probe.
@@ -50,61 +70,209 @@ def i_am_dead(file_name: str = "/core_dump_handler/startupcheck") -> bool:
     return True
 
 
-def spawn_multiprocessing_pool(processes: int = 4, maxtasksperchild: int = 1) -> object:
+def spawn_multiprocessing_pool(
+    processes: int = POOL_PROCESSES,
+    maxtasksperchild: int = 1,
+    worker_mode: str = os.environ.get("WORKER_MODE", "ephemeral"),
+    recycle_bytes: int = int(os.environ.get("WORKER_RECYCLE_BYTES", str(10 * 1024**3))),
+    recycle_seconds: int = int(os.environ.get("WORKER_RECYCLE_SECONDS", "3600")),
+    budget: transfer_budget.TransferBudget = None,
+    shutdown: object = None,
+    metrics_queue: object = None,
+    upload_throttle: throttle.Throttle = None,
+    context: object = None,
+    progress: stall_watchdog.ProgressTable = None,
+) -> object:
     """Spawn multiprocessing pool.
 
     This is a pool of python processes waiting to be tasked with work. In this program, the workers get tasked with
     uploading core dumps to S3.
 
+    In "ephemeral" mode every dump is uploaded by a freshly forked worker. In "persistent" mode the workers are
+    long lived, build their boto3 session and S3 client once in `upload_file_2_s3.init_worker()`, and are recycled
+    after `recycle_bytes` bytes or `recycle_seconds` seconds instead of after every task.
+
     Args:
-        processes (int, optional): max number of processes. Defaults to 4 to limit the resources taken by the
-        core dump handler.
-        maxtasksperchild (int, optional): Maximum amount of times a worker can be distributed work.
-        Defaults to 1 to release resources back to the operating system when not in use.
+        processes (int, optional): max number of processes. Defaults to POOL_PROCESSES.
+        maxtasksperchild (int, optional): Maximum amount of times a worker can be distributed work in "ephemeral"
+        mode. Defaults to 1 to release resources back to the operating system when not in use.
+        worker_mode (str, optional): "ephemeral" or "persistent". Defaults to os.environ.get("WORKER_MODE",
+        "ephemeral").
+        recycle_bytes (int, optional): Bytes uploaded before persistent workers are replaced. 0 disables.
+        Defaults to os.environ.get("WORKER_RECYCLE_BYTES") or 10GiB.
+        recycle_seconds (int, optional): Seconds before persistent workers are replaced. 0 disables.
+        Defaults to os.environ.get("WORKER_RECYCLE_SECONDS", "3600").
+        budget (transfer_budget.TransferBudget, optional): In-flight byte budget shared by every worker.
+        Defaults to None (unlimited).
+        shutdown (object, optional): `multiprocessing.Event` that tells the workers to checkpoint and stop.
+        Defaults to None.
+        metrics_queue (object, optional): Queue returned by `metrics.start()`. Defaults to None (no worker metrics).
+        upload_throttle (throttle.Throttle, optional): Network and disk rates shared by every worker.
+        Defaults to None (unthrottled).
+        context (object, optional): Multiprocessing context from `worker_context()`. The budget, throttle, shutdown
+        event and metrics queue must come from the same context. Defaults to None (the default context).
+        progress (stall_watchdog.ProgressTable, optional): Progress of the uploads, watched for stalls.
+        Defaults to None (not watched).
 
     Returns:
-        object: Multiprocessing pool object.
+        object: `upload_pool.UploadPool` object.
     """
-    pool = multiprocessing.Pool(processes=processes, maxtasksperchild=maxtasksperchild)  # pylint: disable=R1732
-    logger.debug("pool is type %s", type(pool))
+    import upload_file_2_s3  # pylint: disable=C0415
+
+    if worker_mode == "persistent":
+        pool = upload_pool.UploadPool(
+            processes=processes,
+            initializer=upload_file_2_s3.init_worker,
+            initargs=(budget, True, shutdown, metrics_queue, upload_throttle, progress),
+            recycle_bytes=recycle_bytes,
+            recycle_seconds=recycle_seconds,
+            context=context,
+        )
+    elif worker_mode == "ephemeral":
+        pool = upload_pool.UploadPool(
+            processes=processes,
+            maxtasksperchild=maxtasksperchild,
+            initializer=upload_file_2_s3.init_worker,
+            initargs=(budget, False, shutdown, metrics_queue, upload_throttle, progress),
+            context=context,
+        )
+    else:
+        raise ValueError(f"Unknown worker mode {worker_mode}, expected 'ephemeral' or 'persistent'.")
+    logger.debug("pool is type %s in %s mode", type(pool), worker_mode)
     return pool
 
 
-def watch_directory(path_to_directory: str = "./"):
+def worker_context(
+    start_method: str = os.environ.get("WORKER_START_METHOD", "fork"),
+    preload: bool = os.environ.get("WORKER_PRELOAD", "true").lower() == "true",
+) -> object:
+    """Multiprocessing context the upload workers are started from.
+
+    With "fork" every worker is forked from the handler. With "forkserver" the workers are forked from a small server
+    process that only holds boto3 and the upload code, not the handler's scheduler, caches and threads, so a worker
+    starts from a smaller image that stays shared with its siblings. With `preload` the S3 service model is parsed
+    once, in the handler or in the server, instead of in every worker.
+
+    Args:
+        start_method (str, optional): "fork" or "forkserver". Defaults to os.environ.get("WORKER_START_METHOD",
+        "fork").
+        preload (bool, optional): Parse the S3 service model before the first worker starts.
+        Defaults to os.environ.get("WORKER_PRELOAD", "true").
+
+    Returns:
+        object: Multiprocessing context.
+    """
+    if start_method == "forkserver":
+        context = multiprocessing.get_context("forkserver")
+        # `__main__` lets the workers unpickle the tasks of `python main.py`, it imports nothing heavy.
+        context.set_forkserver_preload(["__main__", "worker_preload" if preload else "upload_file_2_s3"])
+    elif start_method == "fork":
+        context = multiprocessing.get_context("fork")
+        if preload:
+            import upload_file_2_s3  # pylint: disable=C0415
+
+            upload_file_2_s3.preload()
+    else:
+        raise ValueError(f"Unknown worker start method {start_method}, expected 'fork' or 'forkserver'.")
+    return context
+
+
+def watch_directory(
+    path_to_directory: str = "./",
+    rescan_seconds: int = int(os.environ.get("BACKLOG_RESCAN_SECONDS", "0")),
+    index_push_seconds: int = int(os.environ.get("INDEX_PUSH_SECONDS", "300")),
+):
     """Watch a directory and upload files that start with `core` to S3.
 
     How it works:
-    1. Spawns a pool of workers.
-    2. Initializes `inotify` from the Operating System to listen for writes to complete in the watched directory.
-    3. Startup check file is written indicating to Kubernetes the program is fully up.
-    4. Once a core dump is written to disk with the name that start with `core`, a worker in the pool
-    is assigned to upload the file via the `s3_upload_wrapper()` function.
+    1. Initializes `inotify` from the Operating System to listen for writes to complete in the watched directory.
+    2. Startup check file is written indicating to Kubernetes the program is up. Dumps written from now on are queued
+    by the kernel until the main loop reads them.
+    3. Spawns a pool of workers, see `worker_context()`. The directory is then scanned for dumps written while the
+    handler was not running. These drain through a few workers only, so fresh dumps are not held up.
+    4. Once a core dump is written to disk with the name that start with `core`, its triage summary is uploaded
+    from a thread of the handler, see `upload_file_2_s3.EarlySummaries`, and the dump is offered to the upload
+    scheduler. The scheduler can sample crash loops, orders the dumps and hands them to a worker in the pool,
+    which uploads the file via the `s3_upload_wrapper()` function.
     5. The worker then uploads the file to S3 and deletes the file from disk.
     6. Because the upload task is async, the main loop continues watching `inotify` for more dumps to assign to
     more workers.
     7. On an exception or shutdown of the program, the pool is closed which allows any running tasks in the
-    worker pool to complete.
+    worker pool to complete. On SIGTERM, running multipart uploads finish the parts in flight, journal them and stop,
+    and are resumed by the next start of the handler.
     8. The program updates the startup check file with the word "dead" indicating to the Kubernetes Liveness check
     the application is no longer running.
 
+    Every `index_push_seconds` and on the way out, the dump index of the directory is compacted and pushed to S3. The
+    periodic pushes run on a thread of their own, so a slow S3 never holds up reading `inotify`.
+    A disk watchdog puts the scheduler under pressure and evicts dumps while the filesystem is running full. A stall
+    watchdog cancels uploads that stopped making progress, failed uploads are retried after a backoff, and every
+    pass of the main loop refreshes the heartbeat file of the liveness probe.
+
     Args:
         path_to_directory (str, optional): Directory to watch. Defaults to "./". Recommended to use the
         full directory path
+        rescan_seconds (int, optional): Seconds between scans for dumps inotify missed, e.g. whose upload failed.
+        0 only scans once more after startup, for dumps that were still settling.
+        Defaults to os.environ.get("BACKLOG_RESCAN_SECONDS", "0").
+        index_push_seconds (int, optional): Seconds between pushes of the dump index to S3. 0 disables pushing.
+        Defaults to os.environ.get("INDEX_PUSH_SECONDS", "300").
     """
     try:
-        pool = spawn_multiprocessing_pool()
+        # Watch before anything heavy is loaded. The kernel queues the events of dumps written while the rest starts,
+        # so no dump is missed and the startup probe passes before boto3 is imported.
+        inotify = INotify()
+        inotify.add_watch(path_to_directory, flags.CLOSE_WRITE)
+        i_am_started()
+        context = worker_context()
+        budget = transfer_budget.TransferBudget(
+            max_bytes=int(os.environ.get("TRANSFER_BUDGET_BYTES", str(64 * 1024 * 1024))), context=context
+        )
+        upload_throttle = throttle.Throttle(context=context)
+        shutdown = context.Event()
+        metrics_queue = metrics.start(context=context)
+        upload_scheduler = scheduler.UploadScheduler()
+        # A dump handed out beyond the pool's workers only waits inside the pool, where it cannot be prioritized and
+        # holds a progress slot.
+        upload_scheduler.max_in_flight = min(upload_scheduler.max_in_flight, POOL_PROCESSES)
+        stalls = stall_watchdog.StallWatchdog(
+            stall_watchdog.ProgressTable(upload_scheduler.max_in_flight, context=context)
+        )
+        pool = spawn_multiprocessing_pool(
+            processes=POOL_PROCESSES,
+            budget=budget,
+            shutdown=shutdown,
+            metrics_queue=metrics_queue,
+            upload_throttle=upload_throttle,
+            context=context,
+            progress=stalls.progress,
+        )
+        beats = heartbeat.Heartbeat()
+        fingerprints = dedup.FingerprintCache() if os.environ.get("DEDUP", "false").lower() == "true" else None
+        watchdog = disk_watchdog.DiskWatchdog(path_to_directory)
+        register_gauges(upload_scheduler, pool.processes, budget, path_to_directory, upload_throttle)
+        signal.signal(signal.SIGTERM, functools.partial(handle_sigterm, shutdown))
     except Exception as e:
         logger.exception(e)
+        i_am_dead()
         raise
+    import dump_index  # pylint: disable=C0415
+    import upload_file_2_s3  # pylint: disable=C0415
+
+    summaries = upload_file_2_s3.EarlySummaries() if os.environ.get("TRIAGE", "true").lower() == "true" else None
+    indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="index")
+    pushing = None
     try:  # pylint: disable=R1702
-        # Initialize inotify
-        inotify = INotify()
-        watch_flags = flags.CLOSE_WRITE
-        # Add watched directory
-        inotify.add_watch(path_to_directory, watch_flags)
-        i_am_started()
+        submit_resumes(upload_scheduler, path_to_directory)
+        submit_backlog(upload_scheduler, path_to_directory)
+        next_scan = time.monotonic() + (rescan_seconds or int(os.environ.get("BACKLOG_MIN_AGE", "60")))
+        next_push = time.monotonic() + index_push_seconds if index_push_seconds else None
         while True:
-            for event in inotify.read():
+            # Wake up regularly to hand queued dumps to workers that have finished.
+            events = inotify.read(timeout=250)
+            if events:
+                metrics.inc("inotify_events_total", len(events))
+            for event in events:
                 for flag in flags.from_mask(event.mask):
                     # Only work if the inotify signal is CLOSE_WRITE.
                     # This ensures we do not try reading a file that is not finished writing to disk.
@@ -112,33 +280,413 @@ def watch_directory(path_to_directory: str = "./"):
                     if str(flag) == "8":
                         file_name = str(event[3])
                         if file_name.startswith("core"):
-                            logger.info("Sending %s to S3.", file_name)
-                            pool.apply_async(
-                                func=s3_upload_wrapper, args=[file_name, path_to_directory], callback=my_callback
+                            if summaries is not None:
+                                summaries.submit(f"{path_to_directory}/{file_name}")
+                            outcome = upload_scheduler.submit(
+                                file_name, path_to_directory, size=file_size(f"{path_to_directory}/{file_name}")
                             )
+                            metrics.inc("dumps_total", outcome=outcome)
+                            logger.debug("%s %s.", file_name, outcome)
+                            if outcome == scheduler.SAMPLED:
+                                discard(upload_scheduler, summaries, file_name, path_to_directory)
+            if next_scan is not None and time.monotonic() >= next_scan:
+                submit_backlog(upload_scheduler, path_to_directory)
+                next_scan = time.monotonic() + rescan_seconds if rescan_seconds else None
+            if next_push is not None and time.monotonic() >= next_push:
+                # Skip a push while the last one is still running rather than queue them up behind it.
+                if pushing is None or pushing.done():
+                    pushing = indexer.submit(dump_index.push, path_to_directory)
+                next_push = time.monotonic() + index_push_seconds
+            watchdog.check(upload_scheduler, fingerprints)
+            stalls.check()
+            # A worker killed mid-upload never gives its share of the budget back itself.
+            budget.reclaim()
+            beat(beats, upload_scheduler, stalls)
+            dispatch(upload_scheduler, pool, fingerprints, stalls, summaries)
     except Exception as e:
         logger.exception(e)
         raise
     finally:
         pool.close()
         pool.join()
+        indexer.shutdown(wait=True)
+        if summaries is not None:
+            summaries.close()
+        if index_push_seconds:
+            dump_index.push(path_to_directory)
         i_am_dead()
 
 
-def s3_upload_wrapper(file_name: str, path_to_directory: str, bucket_name: str = os.environ.get("BUCKET_NAME")) -> str:
+def register_gauges(
+    upload_scheduler: scheduler.UploadScheduler,
+    workers: int,
+    budget: transfer_budget.TransferBudget,
+    path_to_directory: str,
+    upload_throttle: throttle.Throttle = None,
+):
+    """Collect the gauges of the parent when metrics are scraped, so the main loop does not update them.
+
+    Args:
+        upload_scheduler (scheduler.UploadScheduler): Scheduler of the watched directory.
+        workers (int): Uploads that can run at once, worker processes or engine threads.
+        budget (transfer_budget.TransferBudget): In-flight byte budget shared by every worker.
+        path_to_directory (str): Watched directory.
+        upload_throttle (throttle.Throttle, optional): Network and disk rates shared by every worker. Defaults to None.
+    """
+    for queue in ("queued", "backlog", "deferred", "retrying", "in_flight"):
+        metrics.REGISTRY["queue_depth"].set_function(functools.partial(getattr, upload_scheduler, queue), queue=queue)
+    metrics.REGISTRY["workers"].set_function(lambda: workers)
+    metrics.REGISTRY["transfer_budget_bytes_in_use"].set_function(lambda: budget.in_use)
+    metrics.REGISTRY["pending_bytes"].set_function(functools.partial(backlog.pending_bytes, path_to_directory))
+    if upload_throttle is not None:
+        # The buckets are in shared memory, the parent reads what every worker took from them.
+        for resource in ("network", "disk"):
+            bucket = getattr(upload_throttle, resource)
+            metrics.REGISTRY["throttle_rate_bytes_per_second"].set_function(
+                lambda bucket=bucket: bucket.current_rate, resource=resource
+            )
+            metrics.REGISTRY["throttle_wait_seconds_total"].set_function(
+                lambda bucket=bucket: bucket.waited, resource=resource
+            )
+        metrics.REGISTRY["throttle_backoff_factor"].set_function(lambda: upload_throttle.network.factor)
+
+
+def handle_sigterm(shutdown: object, signum: int, frame: object):
+    """SIGTERM handler of the parent. Tells the workers to checkpoint and leaves the main loop.
+
+    Args:
+        shutdown (object): `multiprocessing.Event` shared with the workers.
+        signum (int): Signal number.
+        frame (object): Current stack frame.
+
+    Raises:
+        SystemExit: Always, so `watch_directory()` closes and joins the pool.
+    """
+    logger.info("Received signal %s, checkpointing uploads and shutting down.", signum)
+    shutdown.set()
+    raise SystemExit(0)
+
+
+def file_size(file_name: str) -> int:
+    """Size of a file on disk, 0 if it has already gone.
+
+    Args:
+        file_name (str): File name with path.
+
+    Returns:
+        int: Size in bytes.
+    """
+    try:
+        return os.path.getsize(file_name)
+    except OSError:
+        return 0
+
+
+def submit_backlog(upload_scheduler: scheduler.UploadScheduler, path_to_directory: str) -> int:
+    """Offer the settled dumps already in the watched directory to the scheduler as backlog.
+
+    Dumps the scheduler already knows about, queued or with a worker, are skipped by the scheduler.
+
+    Args:
+        upload_scheduler (scheduler.UploadScheduler): Scheduler to offer the dumps to.
+        path_to_directory (str): Watched directory.
+
+    Returns:
+        int: Number of dumps newly queued.
+    """
+    queued = 0
+    try:
+        for file_name, size in backlog.scan(path_to_directory):
+            outcome = upload_scheduler.submit(file_name, path_to_directory, size=size, backlog=True)
+            metrics.inc("dumps_total", outcome=outcome)
+            if outcome == scheduler.QUEUED:
+                queued += 1
+    except OSError as e:
+        logger.exception(e)
+    return queued
+
+
+def submit_resumes(upload_scheduler: scheduler.UploadScheduler, path_to_directory: str) -> int:
+    """Offer the dumps a previous run was cut off in the middle of uploading to the scheduler.
+
+    They are offered as backlog, so sampling and an overflow "drop" never delete a dump that is partly in S3.
+
+    Args:
+        upload_scheduler (scheduler.UploadScheduler): Scheduler to offer the dumps to.
+        path_to_directory (str): Watched directory.
+
+    Returns:
+        int: Number of dumps queued to resume.
+    """
+    import upload_journal  # pylint: disable=C0415
+
+    queued = 0
+    for file_name in upload_journal.pending(path_to_directory):
+        size = file_size(f"{path_to_directory}/{file_name}")
+        outcome = upload_scheduler.submit(file_name, path_to_directory, size=size, backlog=True)
+        metrics.inc("dumps_total", outcome=outcome)
+        if outcome == scheduler.QUEUED:
+            queued += 1
+    return queued
+
+
+def discard(upload_scheduler: scheduler.UploadScheduler, summaries: object, file_name: str, path_to_directory: str):
+    """Delete a dump the scheduler sampled out, once its triage summary is up.
+
+    A dump whose summary did not reach S3, e.g. one that is no ELF core dump or with triage off, is queued as backlog
+    and uploaded in full instead, so no dump is deleted without anything of it in S3.
+
+    Args:
+        upload_scheduler (scheduler.UploadScheduler): Scheduler that sampled the dump out.
+        summaries (object): `upload_file_2_s3.EarlySummaries` the dump was handed to, None if triage is off.
+        file_name (str): Core dump file name.
+        path_to_directory (str): Directory of the dump.
+    """
+
+    def upload_in_full(path: str):
+        logger.warning("No summary of %s reached S3, uploading it in full.", file_name)
+        upload_scheduler.submit(file_name, path_to_directory, size=file_size(path), backlog=True)
+
+    path = f"{path_to_directory}/{file_name}"
+    if summaries is None:
+        upload_in_full(path)
+        return
+    summaries.discard(path, fallback=upload_in_full)
+
+
+def dispatch(
+    upload_scheduler: scheduler.UploadScheduler,
+    pool: object,
+    fingerprints: dedup.FingerprintCache = None,
+    stalls: stall_watchdog.StallWatchdog = None,
+    summaries: object = None,
+) -> int:
+    """Hand dumps from the scheduler to the pool while the pool has room for them.
+
+    Args:
+        upload_scheduler (scheduler.UploadScheduler): Scheduler holding the queued dumps.
+        pool (object): `upload_pool.UploadPool` object.
+        fingerprints (dedup.FingerprintCache, optional): Recent uploads to deduplicate dumps against.
+        Defaults to None (no deduplication).
+        stalls (stall_watchdog.StallWatchdog, optional): Watchdog of the uploads' progress.
+        Defaults to None (not watched).
+        summaries (object, optional): `upload_file_2_s3.EarlySummaries` the summaries of new dumps were handed to.
+        Defaults to None.
+
+    Returns:
+        int: Number of dumps handed to the pool.
+    """
+    dispatched = 0
+    while (item := upload_scheduler.next()) is not None:
+        file_name, path_to_directory = item
+        logger.info("Sending %s to S3.", file_name)
+        duplicate = deduplicate(fingerprints, f"{path_to_directory}/{file_name}")
+        size = file_size(f"{path_to_directory}/{file_name}")
+        slot = stalls.track(file_name) if stalls is not None else None
+        summarized = summaries.claim(f"{path_to_directory}/{file_name}") if summaries is not None else False
+        pool.apply_async(
+            func=s3_upload_wrapper,
+            args=[file_name, path_to_directory],
+            kwds={
+                "dispatched_at": time.time(),
+                "queued": upload_scheduler.queued + upload_scheduler.backlog,
+                "progress_slot": slot,
+                "summarized": summarized,
+                **duplicate,
+            },
+            callback=functools.partial(
+                task_callback,
+                upload_scheduler,
+                file_name,
+                fingerprints=fingerprints,
+                stalls=stalls,
+                slot=slot,
+                **duplicate,
+            ),
+            error_callback=functools.partial(
+                task_error_callback,
+                upload_scheduler,
+                file_name,
+                path_to_directory=path_to_directory,
+                size=size,
+                stalls=stalls,
+                slot=slot,
+            ),
+            size=size,
+        )
+        dispatched += 1
+    return dispatched
+
+
+def beat(
+    beats: heartbeat.Heartbeat,
+    upload_scheduler: scheduler.UploadScheduler,
+    stalls: stall_watchdog.StallWatchdog,
+) -> bool:
+    """Refresh the heartbeat, unhealthy while a cancelled upload does not stop.
+
+    Args:
+        beats (heartbeat.Heartbeat): Heartbeat file of the liveness probe.
+        upload_scheduler (scheduler.UploadScheduler): Scheduler of the watched directory.
+        stalls (stall_watchdog.StallWatchdog): Watchdog of the uploads' progress.
+
+    Returns:
+        bool: True if the heartbeat was written.
+    """
+    hung = stalls.hung()
+    return beats.beat(
+        healthy=not hung,
+        reason=f"Cancelled uploads of {', '.join(hung)} did not stop." if hung else None,
+        queued=upload_scheduler.queued,
+        backlog=upload_scheduler.backlog,
+        retrying=upload_scheduler.retrying,
+        in_flight=upload_scheduler.in_flight,
+    )
+
+
+def deduplicate(fingerprints: dedup.FingerprintCache, file_name: str) -> dict:
+    """Fingerprint a dump about to be uploaded and look it up among the recent uploads.
+
+    Args:
+        fingerprints (dedup.FingerprintCache): Recent uploads, None if deduplication is off.
+        file_name (str): Core dump file, with directory.
+
+    Returns:
+        dict: `fingerprint` and `duplicate_of` arguments for `s3_upload_wrapper()`, empty if there is no fingerprint.
+    """
+    # The tail of a streamed dump continues an object in S3, it is never a duplicate of another dump.
+    if fingerprints is None or compression.is_rest(file_name):
+        return {}
+    try:
+        key, original = fingerprints.check(file_name)
+    except OSError as e:
+        logger.warning("Could not fingerprint %s: %s", file_name, e)
+        return {}
+    if key is None:
+        return {}
+    return {"fingerprint": key, "duplicate_of": original}
+
+
+def task_callback(
+    upload_scheduler: scheduler.UploadScheduler,
+    file_name: str,
+    value: str,
+    fingerprints: dedup.FingerprintCache = None,
+    fingerprint: str = None,
+    duplicate_of: str = None,
+    stalls: stall_watchdog.StallWatchdog = None,
+    slot: int = None,
+) -> bool:
+    """Callback of a successful upload task. Frees the dump's slot in the scheduler.
+
+    Args:
+        upload_scheduler (scheduler.UploadScheduler): Scheduler the dump came from.
+        file_name (str): Core dump file name.
+        value (str): Return value of `s3_upload_wrapper()`.
+        fingerprints (dedup.FingerprintCache, optional): Recent uploads. Defaults to None.
+        fingerprint (str, optional): Fingerprint of the dump. Defaults to None.
+        duplicate_of (str, optional): Upload the dump duplicated. Defaults to None.
+        stalls (stall_watchdog.StallWatchdog, optional): Watchdog the upload was tracked by. Defaults to None.
+        slot (int, optional): Progress slot of the upload. Defaults to None.
+
+    Returns:
+        bool: True upon completion.
+    """
+    if stalls is not None:
+        stalls.untrack(slot)
+    upload_scheduler.task_done(file_name)
+    if fingerprints is not None and fingerprint is not None and duplicate_of is None:
+        # Only full uploads become originals, a failed upload never does.
+        fingerprints.add(fingerprint, value)
+    return my_callback(value)
+
+
+def task_error_callback(
+    upload_scheduler: scheduler.UploadScheduler,
+    file_name: str,
+    exception: Exception,
+    path_to_directory: str = None,
+    size: int = 0,
+    stalls: stall_watchdog.StallWatchdog = None,
+    slot: int = None,
+) -> bool:
+    """Error callback of a failed upload task. Logs the failure and retries the dump after a backoff.
+
+    Args:
+        upload_scheduler (scheduler.UploadScheduler): Scheduler the dump came from.
+        file_name (str): Core dump file name.
+        exception (Exception): Exception raised in the worker.
+        path_to_directory (str, optional): Directory of the dump. Defaults to None, the dump is not retried.
+        size (int, optional): Size of the dump in bytes. Defaults to 0.
+        stalls (stall_watchdog.StallWatchdog, optional): Watchdog the upload was tracked by. Defaults to None.
+        slot (int, optional): Progress slot of the upload. Defaults to None.
+
+    Returns:
+        bool: True upon completion.
+    """
+    if stalls is not None:
+        stalls.untrack(slot)
+    logger.error("Uploading %s failed: %s", file_name, exception)
+    if path_to_directory is None:
+        upload_scheduler.task_done(file_name)
+        return True
+    delay = upload_scheduler.retry(file_name, path_to_directory, size=size)
+    if delay is None:
+        logger.error(
+            "Giving up on %s, it stays on disk until the handler restarts or a backlog scan finds it, "
+            "see BACKLOG_RESCAN_SECONDS.",
+            file_name,
+        )
+    else:
+        metrics.inc("upload_retries_total")
+        logger.info("Retrying %s in %.0f seconds.", file_name, delay)
+    return True
+
+
+def s3_upload_wrapper(
+    file_name: str,
+    path_to_directory: str,
+    bucket_name: str = os.environ.get("BUCKET_NAME"),
+    dispatched_at: float = None,
+    queued: int = 0,
+    fingerprint: str = None,
+    duplicate_of: str = None,
+    progress_slot: int = None,
+    summarized: bool = False,
+) -> str:
     """Wrapper for S3 upload function. Compiles the required information to send to S3 upload function.
 
     Args:
         file_name (str): File name.
         path_to_directory (str): Directory path to file on disk.
         bucket_name (str, optional): S3 Bucket name. Defaults to os.environ.get("BUCKET_NAME").
+        dispatched_at (float, optional): `time.time()` the task was handed to the pool, for the dispatch latency.
+        Defaults to None.
+        queued (int, optional): Dumps still waiting when the task was handed out, see `upload_file_2_s3.upload_file()`.
+        Defaults to 0.
+        fingerprint (str, optional): `dedup.fingerprint()` of the dump. Defaults to None.
+        duplicate_of (str, optional): Upload the dump duplicates, only its metadata is uploaded. Defaults to None.
+        progress_slot (int, optional): Slot of the upload in the progress table. Defaults to None.
+        summarized (bool, optional): The triage summary of the dump is uploaded already. Defaults to False.
 
     Returns:
         str: Path to file in S3.
     """
+    if dispatched_at is not None:
+        metrics.observe("stage_seconds", max(time.time() - dispatched_at, 0), stage="dispatch")
     file_name_with_path = f"{path_to_directory}/{file_name}"
     logger.debug("Sending %s to S3 bucket %s.", file_name_with_path, bucket_name)
-    s3_object = upload_file_2_s3.upload_file(file_name=file_name_with_path, bucket=bucket_name)
+    import upload_file_2_s3  # pylint: disable=C0415
+
+    s3_object = upload_file_2_s3.upload_file(
+        file_name=file_name_with_path,
+        bucket=bucket_name,
+        queued=queued,
+        fingerprint=fingerprint,
+        duplicate_of=duplicate_of,
+        progress_slot=progress_slot,
+        summarized=summarized,
+    )
     return s3_object
 
 
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Metrics of the upload pipeline, served in the Prometheus text format and optionally sent to StatsD.
+
+Every metric lives in the parent process. Pool workers send their updates over a `multiprocessing.SimpleQueue` handed
+to them by the pool initializer, and a thread in the parent applies them. Recording a metric is a dict lookup and an
+addition, or one small pipe write in a worker, so it is cheap enough to leave on. With metrics disabled every call is
+a no-op.
+"""
+
+import http.server
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+PREFIX = "core_dump_handler_"
+# Seconds. Small dumps take milliseconds, multi-GB dumps minutes.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+# Bytes per second.
+THROUGHPUT_BUCKETS = tuple(2**power * 1024 * 1024 for power in range(0, 11))
+
+
+class Metric:
+    """One Prometheus metric with any number of label sets."""
+
+    def __init__(self, name: str, kind: str, documentation: str, buckets: tuple = None):
+        """Create an empty metric.
+
+        Args:
+            name (str): Name without `PREFIX`.
+            kind (str): "counter", "gauge" or "histogram".
+            documentation (str): HELP text.
+            buckets (tuple, optional): Upper bounds of the histogram buckets. Defaults to None.
+        """
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.buckets = buckets
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def apply(self, op: str, value: float, labels: dict):
+        """Record an update.
+
+        Args:
+            op (str): "inc" or "set" for counters and gauges, "observe" for histograms.
+            value (float): Amount, value or observation.
+            labels (dict): Label names and values.
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if self.kind == "histogram":
+                # Cumulative bucket counts, like the text format.
+                counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+                for index, bound in enumerate(self.buckets):
+                    if value <= bound:
+                        counts[index] += 1
+                self._values[key] = (counts, total + value, count + 1)
+            elif op == "set":
+                self._values[key] = value
+            else:
+                self._values[key] = self._values.get(key, 0) + value
+
+    def set_function(self, function: object, **labels):
+        """Compute a gauge when it is collected instead of updating it.
+
+        Args:
+            function (object): Callable returning the value.
+            **labels: Label names and values.
+        """
+        self._functions[tuple(sorted(labels.items()))] = function
+
+    def value(self, **labels) -> object:
+        """Current value of a label set, mostly for tests.
+
+        Returns:
+            object: Number, `(bucket counts, sum, count)` for histograms, None if never recorded.
+        """
+        return self._values.get(tuple(sorted(labels.items())))
+
+    def render(self) -> list:
+        """Lines of the Prometheus text format.
+
+        Returns:
+            list: Lines without newlines.
+        """
+        name = PREFIX + self.name
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.kind}"]
+        with self._lock:
+            values = dict(self._values)
+        for key, function in self._functions.items():
+            try:
+                values[key] = function()
+            except Exception as e:  # pylint: disable=W0718
+                logger.debug("Could not collect %s: %s", name, e)
+        for key, value in sorted(values.items()):
+            if self.kind != "histogram":
+                lines.append(f"{name}{_labels(key)} {_number(value)}")
+                continue
+            counts, total, count = value
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{name}_bucket{_labels(key + (('le', _number(bound)),))} {bucket_count}")
+            lines.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(key)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(key)} {count}")
+        return lines
+
+
+def _labels(key: tuple) -> str:
+    if not key:
+        return ""
+    pairs = ",".join(f'{label}="{_escape(value)}"' for label, value in key)
+    return "{" + pairs + "}"
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Registry:
+    """The set of metrics of the handler."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def define(self, name: str, kind: str, documentation: str, buckets: tuple = None) -> Metric:
+        """Add a metric.
+
+        Returns:
+            Metric: The new metric.
+        """
+        self._metrics[name] = Metric(name, kind, documentation, buckets)
+        return self._metrics[name]
+
+    def __getitem__(self, name: str) -> Metric:
+        return self._metrics[name]
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text format.
+
+        Returns:
+            str: Exposition text.
+        """
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+REGISTRY.define("inotify_events_total", "counter", "inotify events read from the watched directory.")
+REGISTRY.define("dumps_total", "counter", "Dumps offered to the scheduler, by what the scheduler did with them.")
+REGISTRY.define("queue_depth", "gauge", "Dumps waiting in the scheduler or with the worker pool, by queue.")
+REGISTRY.define("stage_seconds", "histogram", "Seconds spent in each stage of the pipeline.", LATENCY_BUCKETS)
+REGISTRY.define("uploads_total", "counter", "Uploads by result.")
+REGISTRY.define("uploaded_bytes_total", "counter", "Bytes of dumps uploaded.")
+REGISTRY.define("deduplicated_bytes_total", "counter", "Bytes of duplicate dumps not uploaded.")
+REGISTRY.define("upload_throughput_bytes_per_second", "histogram", "Throughput of each upload.", THROUGHPUT_BUCKETS)
+REGISTRY.define("part_retries_total", "counter", "Retries of S3 requests sending dump data.")
+REGISTRY.define("workers", "gauge", "Uploads that can run at once, pool processes or asyncio engine threads.")
+REGISTRY.define("workers_busy", "gauge", "Workers uploading a dump.")
+REGISTRY.define("pending_bytes", "gauge", "Bytes of core dumps on disk in the watched directory.")
+REGISTRY.define("transfer_budget_bytes_in_use", "gauge", "Bytes of upload part buffers held in memory.")
+REGISTRY.define("throttle_rate_bytes_per_second", "gauge", "Paced rate by resource after backoff, 0 is unlimited.")
+REGISTRY.define("throttle_backoff_factor", "gauge", "Share of the configured network rate in use, below 1 backed off.")
+REGISTRY.define("throttle_wait_seconds_total", "counter", "Seconds uploads waited to be paced, by resource.")
+REGISTRY.define("disk_usage_ratio", "gauge", "Used share of the filesystem of the watched directory.")
+REGISTRY.define("evictions_total", "counter", "Dumps deleted from a filling disk before their upload, by reason.")
+REGISTRY.define("evicted_bytes_total", "counter", "Bytes of dumps deleted from a filling disk before their upload.")
+REGISTRY.define("stalled_uploads_total", "counter", "Uploads cancelled after making no progress for STALL_SECONDS.")
+REGISTRY.define("upload_retries_total", "counter", "Failed uploads put back to be retried after a backoff.")
+
+# Where updates go: None when metrics are disabled, `_record` in the parent, the worker queue in workers.
+_sink = None
+_statsd = None
+
+
+def inc(name: str, value: float = 1, **labels):
+    """Add to a counter or gauge.
+
+    Args:
+        name (str): Metric name without `PREFIX`.
+        value (float, optional): Amount. Defaults to 1.
+        **labels: Label names and values.
+    """
+    if _sink is not None:
+        _sink("inc", name, value, labels)
+
+
+def dec(name: str, value: float = 1, **labels):
+    """Subtract from a gauge.
+
+    Args:
+        name (str): Metric name without `PREFIX`.
+        value (float, optional): Amount. Defaults to 1.
+        **labels: Label names and values.
+    """
+    if _sink is not None:
+        _sink("inc", name, -value, labels)
+
+
+def set_gauge(name: str, value: float, **labels):
+    """Set a gauge.
+
+    Args:
+        name (str): Metric name without `PREFIX`.
+        value (float): Value.
+        **labels: Label names and values.
+    """
+    if _sink is not None:
+        _sink("set", name, value, labels)
+
+
+def observe(name: str, value: float, **labels):
+    """Add an observation to a histogram.
+
+    Args:
+        name (str): Metric name without `PREFIX`.
+        value (float): Observation, seconds for latencies.
+        **labels: Label names and values.
+    """
+    if _sink is not None:
+        _sink("observe", name, value, labels)
+
+
+def _record(op: str, name: str, value: float, labels: dict):
+    """Apply an update in the parent and forward it to StatsD."""
+    REGISTRY[name].apply(op, value, labels)
+    if _statsd is not None:
+        _statsd.send(op, name, value, labels)
+
+
+class StatsdClient:
+    """Fire and forget StatsD client over UDP, with DogStatsD style tags for labels."""
+
+    def __init__(self, address: str):
+        """Resolve the StatsD daemon.
+
+        Args:
+            address (str): `host:port` of the StatsD daemon.
+        """
+        host, _, port = address.rpartition(":")
+        self.address = (host or "localhost", int(port or 8125))
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def format(self, op: str, name: str, value: float, labels: dict) -> bytes:
+        """One StatsD line.
+
+        Returns:
+            bytes: Datagram payload.
+        """
+        kind = REGISTRY[name].kind
+        if kind == "histogram":
+            if name.endswith("_seconds"):
+                line = f"{PREFIX}{name[: -len('_seconds')]}:{_number(value * 1000)}|ms"
+            else:
+                line = f"{PREFIX}{name}:{_number(value)}|h"
+        elif kind == "counter":
+            line = f"{PREFIX}{name}:{_number(value)}|c"
+        elif op == "set":
+            line = f"{PREFIX}{name}:{_number(value)}|g"
+        else:
+            line = f"{PREFIX}{name}:{'+' if value >= 0 else ''}{_number(value)}|g"
+        if labels:
+            line += "|#" + ",".join(f"{label}:{labels[label]}" for label in sorted(labels))
+        return line.encode("utf-8")
+
+    def send(self, op: str, name: str, value: float, labels: dict):
+        """Send an update, dropping it if the daemon cannot take it."""
+        try:
+            self._socket.sendto(self.format(op, name, value, labels), self.address)
+        except OSError as e:
+            logger.debug("Dropped StatsD update: %s", e)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serve `REGISTRY` on `/metrics`."""
+
+    def do_GET(self):  # pylint: disable=C0103
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """Keep scrapes out of the logs."""
+
+
+def serve(port: int, address: str = "") -> object:
+    """Serve the metrics endpoint from a daemon thread.
+
+    Args:
+        port (int): TCP port, 0 picks a free one.
+        address (str, optional): Address to bind. Defaults to "" (all addresses).
+
+    Returns:
+        object: `http.server.ThreadingHTTPServer`, its `server_address` has the port.
+    """
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Serving metrics on port %s.", server.server_address[1])
+    return server
+
+
+def start(
+    port: int = int(os.environ.get("METRICS_PORT", "9145")),
+    statsd: str = os.environ.get("METRICS_STATSD", ""),
+    context: object = None,
+) -> object:
+    """Turn metrics on in the parent process.
+
+    Args:
+        port (int, optional): Port of the `/metrics` endpoint. -1 disables the endpoint.
+        Defaults to os.environ.get("METRICS_PORT", "9145").
+        statsd (str, optional): `host:port` of a StatsD daemon, empty to not send to StatsD.
+        Defaults to os.environ.get("METRICS_STATSD", "").
+        context (object, optional): Multiprocessing context. Defaults to None (the default context).
+
+    Returns:
+        object: Queue to hand to `init_worker()` in every worker, None if metrics are disabled.
+    """
+    global _sink, _statsd  # pylint: disable=W0603
+    if port < 0 and not statsd:
+        return None
+    _statsd = StatsdClient(statsd) if statsd else None
+    _sink = _record
+    queue = (context or multiprocessing.get_context()).SimpleQueue()
+    threading.Thread(target=_drain, args=(queue,), name="metrics-drain", daemon=True).start()
+    if port >= 0:
+        serve(port)
+    return queue
+
+
+def _drain(queue: object):
+    """Apply the updates sent by the workers, until the parent exits."""
+    while True:
+        try:
+            _record(*queue.get())
+        except Exception as e:  # pylint: disable=W0718
+            logger.debug("Dropped metrics update: %s", e)
+
+
+def init_worker(queue: object = None):
+    """Send the metrics of a worker process to the parent.
+
+    Args:
+        queue (object, optional): Queue returned by `start()`. Defaults to None (metrics disabled).
+    """
+    global _sink  # pylint: disable=W0603
+    _sink = (lambda *update: queue.put(update)) if queue is not None else None
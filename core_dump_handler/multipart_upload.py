@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+Streaming S3 uploads with S3 additional checksums computed while the data is read.
+
+Every part is hashed as it is read and sent with its checksum, so S3 rejects a corrupted part on receipt. The checksum
+S3 returns for the completed object is then compared to the one computed locally, which verifies the upload without
+another round trip to S3.
+
+Multipart uploads can be journaled with `upload_journal.UploadJournal` so they resume after a restart.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import botocore
+import metrics
+import transfer_budget
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+# S3 additional checksum algorithms that can be computed with the standard library.
+CHECKSUM_ALGORITHMS = ("SHA256", "SHA1", "CRC32")
+READ_SIZE = 1024 * 1024
+# Seconds one wait for the transfer budget counts as progress of the upload. Budget that never frees up must still
+# look like a stall to the stall watchdog.
+BUDGET_WAIT_PROGRESS_SECONDS = 60
+
+
+class ChecksumMismatchError(Exception):
+    """Raised when the checksum S3 reports for an object does not match the data that was read from disk."""
+
+
+class UploadInterrupted(Exception):
+    """Raised when an upload stops early because the handler is shutting down. A journaled upload can resume."""
+
+
+class _Checksum:
+    """Incremental S3 additional checksum with the same interface as `hashlib` objects."""
+
+    def __init__(self, algorithm: str = "SHA256"):
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            raise ValueError(f"Unsupported checksum algorithm {algorithm}, expected one of {CHECKSUM_ALGORITHMS}.")
+        self.algorithm = algorithm
+        self._crc = 0
+        self._hash = None if algorithm == "CRC32" else hashlib.new(algorithm.lower())
+
+    def update(self, data: bytes):
+        if self._hash is None:
+            self._crc = zlib.crc32(data, self._crc)
+        else:
+            self._hash.update(data)
+
+    def digest(self) -> bytes:
+        if self._hash is None:
+            return self._crc.to_bytes(4, "big")
+        return self._hash.digest()
+
+
+def checksum(data: bytes, algorithm: str = "SHA256") -> bytes:
+    """Raw S3 additional checksum of a block of data.
+
+    Args:
+        data (bytes): Data to checksum.
+        algorithm (str, optional): One of `CHECKSUM_ALGORITHMS`. Defaults to "SHA256".
+
+    Returns:
+        bytes: Raw digest.
+    """
+    digest = _Checksum(algorithm)
+    digest.update(data)
+    return digest.digest()
+
+
+def composite_checksum(part_checksums: list, algorithm: str = "SHA256") -> str:
+    """Checksum S3 reports for a multipart upload: the checksum of the concatenated part checksums.
+
+    Args:
+        part_checksums (list): Raw part checksums in part order.
+        algorithm (str, optional): One of `CHECKSUM_ALGORITHMS`. Defaults to "SHA256".
+
+    Returns:
+        str: Base64 checksum followed by `-<number of parts>`.
+    """
+    return f"{_b64(checksum(b''.join(part_checksums), algorithm))}-{len(part_checksums)}"
+
+
+def multipart_etag(part_md5s: list) -> str:
+    """ETag S3 reports for an unencrypted or SSE-S3 multipart upload.
+
+    Args:
+        part_md5s (list): Raw part MD5 digests in part order.
+
+    Returns:
+        str: Quoted ETag.
+    """
+    return f'"{hashlib.md5(b"".join(part_md5s)).hexdigest()}-{len(part_md5s)}"'
+
+
+def _b64(digest: bytes) -> str:
+    return base64.b64encode(digest).decode("ascii")
+
+
+def _count_retries(response: dict):
+    retries = response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    if retries:
+        metrics.inc("part_retries_total", retries)
+
+
+def put_object(
+    s3: object,
+    file_name: str,
+    bucket: str,
+    object_name: str,
+    checksum_algorithm: str = "SHA256",
+    extra_args: dict = None,
+) -> dict:
+    """Upload a file in a single PutObject request with its checksum.
+
+    The file is hashed in one pass and then streamed to S3, it is never held in memory as a whole.
+
+    Args:
+        s3 (object): boto3 S3 client.
+        file_name (str): File to upload.
+        bucket (str): Bucket to upload to.
+        object_name (str): S3 object name.
+        checksum_algorithm (str, optional): One of `CHECKSUM_ALGORITHMS`. Defaults to "SHA256".
+        extra_args (dict, optional): Extra PutObject arguments, e.g. StorageClass. Defaults to None.
+
+    Returns:
+        dict: Upload result for `verify_upload()`.
+    """
+    digest = _Checksum(checksum_algorithm)
+    md5 = hashlib.md5()
+    with open(file_name, "rb") as body:
+        for block in iter(lambda: body.read(READ_SIZE), b""):
+            digest.update(block)
+            md5.update(block)
+        body.seek(0)
+        response = s3.put_object(
+            Bucket=bucket,
+            Key=object_name,
+            Body=body,
+            **{f"Checksum{checksum_algorithm}": _b64(digest.digest())},
+            **(extra_args or {}),
+        )
+    _count_retries(response)
+    return {
+        "Algorithm": checksum_algorithm,
+        "Checksum": _b64(digest.digest()),
+        "ETag": f'"{md5.hexdigest()}"',
+        "Response": response,
+    }
+
+
+def put_bytes(
+    s3: object,
+    data: bytes,
+    bucket: str,
+    object_name: str,
+    checksum_algorithm: str = "SHA256",
+    extra_args: dict = None,
+) -> dict:
+    """Upload a block of data already in memory in a single PutObject request with its checksum.
+
+    Args:
+        s3 (object): boto3 S3 client.
+        data (bytes): Data to upload.
+        bucket (str): Bucket to upload to.
+        object_name (str): S3 object name.
+        checksum_algorithm (str, optional): One of `CHECKSUM_ALGORITHMS`. Defaults to "SHA256".
+        extra_args (dict, optional): Extra PutObject arguments, e.g. StorageClass. Defaults to None.
+
+    Returns:
+        dict: Upload result for `verify_upload()`.
+    """
+    data_checksum = _b64(checksum(data, checksum_algorithm))
+    response = s3.put_object(
+        Bucket=bucket,
+        Key=object_name,
+        Body=data,
+        **{f"Checksum{checksum_algorithm}": data_checksum},
+        **(extra_args or {}),
+    )
+    _count_retries(response)
+    return {
+        "Algorithm": checksum_algorithm,
+        "Checksum": data_checksum,
+        "ETag": f'"{hashlib.md5(data).hexdigest()}"',
+        "Response": response,
+    }
+
+
+def upload_part(
+    s3: object, bucket: str, object_name: str, upload_id: str, part_number: int, data: bytes, checksum_algorithm: str
+) -> dict:
+    """Checksum and upload one part. Runs in the part upload threads.
+
+    Args:
+        s3 (object): boto3 S3 client.
+        bucket (str): Bucket to upload to.
+        object_name (str): S3 object name.
+        upload_id (str): Multipart upload ID.
+        part_number (int): Part number, starting at 1.
+        data (bytes): Part data, bytes or a memoryview of a part buffer.
+        checksum_algorithm (str): One of `CHECKSUM_ALGORITHMS`.
+
+    Returns:
+        dict: Part number, ETag, raw checksum and raw MD5 of the part.
+    """
+    part_checksum = checksum(data, checksum_algorithm)
+    response = s3.upload_part(
+        Bucket=bucket,
+        Key=object_name,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=transfer_budget.BufferReader(data) if isinstance(data, memoryview) else data,
+        **{f"Checksum{checksum_algorithm}": _b64(part_checksum)},
+    )
+    _count_retries(response)
+    returned = response.get(f"Checksum{checksum_algorithm}")
+    if returned and returned != _b64(part_checksum):
+        raise ChecksumMismatchError(
+            f"Part {part_number} of {object_name} checksum mismatch, local {_b64(part_checksum)} S3 {returned}."
+        )
+    return {
+        "PartNumber": part_number,
+        "ETag": response["ETag"],
+        "Checksum": part_checksum,
+        "MD5": hashlib.md5(data).digest(),
+    }
+
+
+def upload_parts(
+    s3: object,
+    source: object,
+    bucket: str,
+    object_name: str,
+    part_size: int = 8 * 1024 * 1024,
+    max_concurrency: int = 10,
+    checksum_algorithm: str = "SHA256",
+    extra_args: dict = None,
+    budget: transfer_budget.TransferBudget = None,
+    journal: object = None,
+    stop: object = None,
+    throttle: object = None,
+    progress: object = None,
+) -> dict:
+    """Multipart upload of everything readable from `source`.
+
+    Parts are read sequentially with `readinto()` into reusable buffers and uploaded by up to `max_concurrency`
+    threads. Part buffers are charged to `budget`, so reading the next part waits while the budget shared with other
+    uploads is used up. The parts in flight are also kept within this upload's share of the budget, recomputed before
+    every part from the uploads running at that moment, so an upload that started alone makes room for later ones.
+
+    Without a journal the multipart upload is aborted on any failure. With a journal every uploaded part is recorded,
+    a journal left by an earlier attempt is resumed from the parts S3 still has, and the multipart upload is kept on
+    failure so the next attempt can resume it. Only a checksum mismatch discards it. `source` must be seekable to
+    resume.
+
+    Args:
+        s3 (object): boto3 S3 client.
+        source (object): Binary file-like object with a `readinto()` method.
+        bucket (str): Bucket to upload to.
+        object_name (str): S3 object name.
+        part_size (int, optional): Bytes per part, at least 5MiB. A resumed upload keeps its original part size.
+        Defaults to 8MiB.
+        max_concurrency (int, optional): Parts uploaded at once. Defaults to 10.
+        checksum_algorithm (str, optional): One of `CHECKSUM_ALGORITHMS`. Defaults to "SHA256".
+        extra_args (dict, optional): Extra CreateMultipartUpload arguments, e.g. StorageClass. Defaults to None.
+        budget (transfer_budget.TransferBudget, optional): In-flight byte budget. Defaults to None (unlimited).
+        journal (object, optional): `upload_journal.UploadJournal` of the upload. Defaults to None.
+        stop (object, optional): Event that stops reading new parts once set. Parts already in flight finish and are
+        journaled, then `UploadInterrupted` is raised. Defaults to None.
+        throttle (object, optional): `throttle.Throttle` that paces the parts sent and learns S3 latency from them.
+        Defaults to None (unthrottled).
+        progress (object, optional): Called with the size of every part sent, from the part's thread, and with 0 for
+        progress that sends nothing: a part read, or the first `BUDGET_WAIT_PROGRESS_SECONDS` of a wait for the budget.
+        Defaults to None.
+
+    Raises:
+        UploadInterrupted: `stop` was set before every part was uploaded.
+
+    Returns:
+        dict: Upload result for `verify_upload()`.
+    """
+    uploaded = None
+    if journal is not None and journal.load(bucket, object_name, checksum_algorithm) is not None:
+        upload_id = journal.state["UploadId"]
+        part_size = journal.state["PartSize"]
+        uploaded = _resumable_parts(s3, bucket, object_name, journal)
+    if uploaded is None:
+        upload_id = s3.create_multipart_upload(
+            Bucket=bucket, Key=object_name, ChecksumAlgorithm=checksum_algorithm, **(extra_args or {})
+        )["UploadId"]
+        uploaded = {}
+        if journal is not None:
+            journal.start(bucket, object_name, upload_id, part_size, checksum_algorithm)
+    else:
+        logger.info("Resuming %s from part %s of its multipart upload.", object_name, len(uploaded) + 1)
+    buffers = transfer_budget.BufferPool(budget=budget)
+    parts = list(uploaded.values())
+
+    def waiting(seconds: float):
+        if progress is not None and seconds < BUDGET_WAIT_PROGRESS_SECONDS:
+            progress(0)
+
+    def send(part_number: int, data: memoryview) -> dict:
+        started = time.monotonic()
+        result = upload_part(s3, bucket, object_name, upload_id, part_number, data, checksum_algorithm)
+        if throttle is not None:
+            throttle.observe(len(data), time.monotonic() - started)
+        if progress is not None:
+            progress(len(data))
+        return result
+
+    def collect(futures: set):
+        # Journal the parts that made it before raising the first failure, so a resume does not send them again.
+        results = [future.result() for future in futures if future.exception() is None]
+        parts.extend(results)
+        if journal is not None:
+            journal.record_parts(results)
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+    try:
+        interrupted = False
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            pending = set()
+            part_number = 1
+            while True:
+                if stop is not None and stop.is_set():
+                    interrupted = True
+                    break
+                if part_number in uploaded:
+                    source.seek(part_size, os.SEEK_CUR)
+                    part_number += 1
+                    continue
+                buffer = buffers.get(part_size, waiting=waiting, stop=stop)
+                if buffer is None:
+                    interrupted = True
+                    break
+                try:
+                    count = transfer_budget.readinto_full(source, memoryview(buffer)[:part_size])
+                except BaseException:
+                    buffers.put(buffer)
+                    raise
+                if progress is not None:
+                    progress(0)
+                if not count:
+                    buffers.put(buffer)
+                    break
+                if throttle is not None:
+                    throttle.network.take(count, stop)
+                future = executor.submit(send, part_number, memoryview(buffer)[:count])
+                future.add_done_callback(lambda _, buffer=buffer: buffers.put(buffer))
+                pending.add(future)
+                part_number += 1
+                while len(pending) >= _parts_in_flight(max_concurrency, part_size, budget):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(pending)
+        if interrupted:
+            raise UploadInterrupted(f"Stopped uploading {object_name} after {len(parts)} parts.")
+        result = complete_upload(s3, bucket, object_name, upload_id, parts, checksum_algorithm)
+    except BaseException as e:
+        if journal is not None and journal.state is not None and not isinstance(e, ChecksumMismatchError):
+            logger.info("Keeping multipart upload %s of %s to resume later.", upload_id, object_name)
+        else:
+            logger.debug("Aborting multipart upload %s of %s.", upload_id, object_name)
+            try:
+                s3.abort_multipart_upload(Bucket=bucket, Key=object_name, UploadId=upload_id)
+            except Exception as abort_exception:  # pylint: disable=W0718
+                logger.exception(abort_exception)
+            if journal is not None:
+                journal.remove()
+        raise
+    finally:
+        buffers.close()
+        if budget is not None:
+            logger.debug("Transfer budget in use %s of %s bytes.", budget.in_use, budget.max_bytes)
+    if journal is not None:
+        journal.remove()
+    return result
+
+
+def _parts_in_flight(max_concurrency: int, part_size: int, budget: transfer_budget.TransferBudget) -> int:
+    """Parts one upload may have in flight, at least one and at most its current share of the budget."""
+    if budget is None:
+        return max_concurrency
+    return max(1, min(max_concurrency, budget.share() // part_size))
+
+
+def _resumable_parts(s3: object, bucket: str, object_name: str, journal: object) -> dict:
+    """Journaled parts that S3 still has with the same ETag.
+
+    Returns:
+        dict: Part results by part number, None if the multipart upload is gone and has to start over.
+    """
+    listed = {}
+    try:
+        for page in s3.get_paginator("list_parts").paginate(
+            Bucket=bucket, Key=object_name, UploadId=journal.state["UploadId"]
+        ):
+            listed.update((part["PartNumber"], part["ETag"]) for part in page.get("Parts", []))
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") != "NoSuchUpload":
+            raise
+        logger.warning("Multipart upload of %s is gone, starting over.", object_name)
+        journal.remove()
+        return None
+    parts = {part["PartNumber"]: part for part in journal.parts() if listed.get(part["PartNumber"]) == part["ETag"]}
+    journal.keep_parts(set(parts))
+    return parts
+
+
+def complete_upload(
+    s3: object, bucket: str, object_name: str, upload_id: str, parts: list, checksum_algorithm: str = "SHA256"
+) -> dict:
+    """Complete a multipart upload from the results of `upload_part()`.
+
+    Args:
+        s3 (object): boto3 S3 client.
+        bucket (str): Bucket to upload to.
+        object_name (str): S3 object name.
+        upload_id (str): Multipart upload ID.
+        parts (list): Results of `upload_part()`, in any order.
+        checksum_algorithm (str, optional): One of `CHECKSUM_ALGORITHMS`. Defaults to "SHA256".
+
+    Returns:
+        dict: Upload result for `verify_upload()`.
+    """
+    parts = sorted(parts, key=lambda part: part["PartNumber"])
+    response = s3.complete_multipart_upload(
+        Bucket=bucket,
+        Key=object_name,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {
+                    "PartNumber": part["PartNumber"],
+                    "ETag": part["ETag"],
+                    f"Checksum{checksum_algorithm}": _b64(part["Checksum"]),
+                }
+                for part in parts
+            ]
+        },
+    )
+    return {
+        "Algorithm": checksum_algorithm,
+        "Checksum": composite_checksum([part["Checksum"] for part in parts], checksum_algorithm),
+        "ETag": multipart_etag([part["MD5"] for part in parts]),
+        "Response": response,
+    }
+
+
+def verify_upload(result: dict) -> bool:
+    """Verify an upload from the response S3 already returned.
+
+    1. If S3 returned the object's additional checksum, it must match the local one.
+    2. Otherwise, if the ETag matches the local MD5 based ETag, the object is verified.
+    3. Otherwise the upload cannot be verified inline (e.g. SSE-KMS ETags, S3 compatible stores without checksums).
+
+    Args:
+        result (dict): Result of `put_object()` or `upload_parts()`.
+
+    Raises:
+        ChecksumMismatchError: S3 reported a different checksum.
+
+    Returns:
+        bool: True if verified, False if the caller has to fall back to another check.
+    """
+    response = result["Response"]
+    returned = response.get(f"Checksum{result['Algorithm']}")
+    if returned:
+        # Older S3 APIs return a composite checksum without the `-<parts>` suffix.
+        if returned.split("-")[0] != result["Checksum"].split("-")[0]:
+            raise ChecksumMismatchError(f"Checksum mismatch, local {result['Checksum']} S3 {returned}.")
+        return True
+    return response.get("ETag") == result["ETag"]
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Core Dump Pipe Ingest
+
+Streams a core dump straight from the kernel to S3 without writing it to the node's disk first. It runs either as the
+`kernel.core_pattern` pipe target, reading the dump from stdin, or as a Unix socket server inside the Core Dump Handler
+pod that a tiny host side shim forwards the dump to.
+
+The dump is gzip compressed and multipart uploaded in bounded chunks. It is only spilled to the watched directory,
+where `main.py` picks it up as usual, if S3 cannot be reached.
+"""
+
+import argparse
+import logging
+import os
+import socketserver
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+import botocore
+import compression
+import dump_index
+import multipart_upload
+import upload_file_2_s3
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+READ_SIZE = 1024 * 1024
+# Errors that mean S3 cannot be reached or refused the upload. Anything else is a bug and is raised.
+S3_ERRORS = (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)
+
+
+def compressed_parts(stream: object, part_size: int = 8 * 1024 * 1024, level: int = 1) -> object:
+    """Gzip compress a stream and cut the output into parts.
+
+    Args:
+        stream (object): Binary file-like object to read the dump from.
+        part_size (int, optional): Bytes per part, every part but the last is exactly this size. Defaults to 8MiB.
+        level (int, optional): gzip compression level. Defaults to 1, the kernel blocks the crashing process until the
+        dump has been read.
+
+    Yields:
+        bytes: Compressed part.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    buffer = bytearray()
+    for block in iter(lambda: stream.read(READ_SIZE), b""):
+        buffer += compressor.compress(block)
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    buffer += compressor.flush()
+    while buffer:
+        yield bytes(buffer[:part_size])
+        del buffer[:part_size]
+
+
+def spill(parts: object, spill_dir: str, file_name: str) -> str:
+    """Write parts to a file in the watched directory so `main.py` uploads them later.
+
+    Args:
+        parts (object): Iterable of bytes.
+        spill_dir (str): Directory watched by `main.py`.
+        file_name (str): File name, must start with `core` to be picked up.
+
+    Returns:
+        str: Path of the spilled file.
+    """
+    spill_file = os.path.join(spill_dir, file_name)
+    with open(spill_file, "wb") as spilled:
+        for part in parts:
+            spilled.write(part)
+    logger.warning("Spilled %s to disk, it will be uploaded by the watcher.", spill_file)
+    return spill_file
+
+
+def ingest_stream(
+    stream: object,
+    name: str,
+    spill_dir: str,
+    bucket: str = os.environ.get("BUCKET_NAME"),
+    part_size: int = int(os.environ.get("PIPE_PART_SIZE", str(8 * 1024 * 1024))),
+    max_concurrency: int = int(os.environ.get("PIPE_MAX_CONCURRENCY", "4")),
+    level: int = int(os.environ.get("PIPE_COMPRESS_LEVEL", "1")),
+    checksum_algorithm: str = os.environ.get("CHECKSUM_ALGORITHM", "SHA256"),
+) -> str:
+    """Compress a core dump stream and upload it to S3 as `<name>.gz`, under `dump_index.object_key()`.
+
+    At most `max_concurrency` parts are held in memory. If S3 cannot be reached before the first part is sent, the
+    whole dump is spilled to `spill_dir/<name>.gz`. If a part fails later on, the parts that made it to S3 in order
+    are completed as `<name>.gz` and the rest of the stream is spilled to `spill_dir/<name>.gz.rest`, which the
+    watcher uploads byte for byte as `<object>.rest`, see `compression.REST_SUFFIX`. The two objects concatenated are
+    the full compressed dump.
+
+    Args:
+        stream (object): Binary file-like object to read the dump from.
+        name (str): Core dump file name, e.g. `core-%e-%t-%p-%s`.
+        spill_dir (str): Directory watched by `main.py`.
+        bucket (str, optional): S3 Bucket name. Defaults to os.environ.get("BUCKET_NAME").
+        part_size (int, optional): Bytes per part, at least 5MiB. Defaults to os.environ.get("PIPE_PART_SIZE") or 8MiB.
+        max_concurrency (int, optional): Parts uploaded at once. Defaults to os.environ.get("PIPE_MAX_CONCURRENCY",
+        "4").
+        level (int, optional): gzip compression level. Defaults to os.environ.get("PIPE_COMPRESS_LEVEL", "1").
+        checksum_algorithm (str, optional): One of `multipart_upload.CHECKSUM_ALGORITHMS`.
+        Defaults to os.environ.get("CHECKSUM_ALGORITHM", "SHA256").
+
+    Returns:
+        str: Path to file in S3, or path of the spilled file if nothing could be uploaded.
+    """
+    spill_name = f"{name}.gz"
+    object_name = dump_index.object_key(spill_name)
+    extra_args = {"StorageClass": "STANDARD_IA"}
+    parts = compressed_parts(stream, part_size=part_size, level=level)
+    first = next(parts, b"")
+    second = next(parts, None)
+    s3 = upload_file_2_s3.get_s3_client()
+    logger.info(f"Streaming {name} to s3://{bucket}/{object_name}.")
+    if second is None:
+        try:
+            result = multipart_upload.put_bytes(s3, first, bucket, object_name, checksum_algorithm, extra_args)
+        except S3_ERRORS as e:
+            logger.exception(e)
+            return spill([first], spill_dir, spill_name)
+    else:
+        try:
+            upload_id = s3.create_multipart_upload(
+                Bucket=bucket, Key=object_name, ChecksumAlgorithm=checksum_algorithm, **extra_args
+            )["UploadId"]
+        except S3_ERRORS as e:
+            logger.exception(e)
+            return spill(_chain([first, second], parts), spill_dir, spill_name)
+        result = _upload_stream(
+            s3,
+            _chain([first, second], parts),
+            bucket,
+            object_name,
+            upload_id,
+            spill_dir,
+            max_concurrency,
+            checksum_algorithm,
+        )
+        if result is None:
+            return os.path.join(spill_dir, spill_name)
+    if not multipart_upload.verify_upload(result):
+        upload_file_2_s3.check_if_exists(bucket=bucket, object_name=object_name)
+    logger.info(f"{object_name} upload done.")
+    try:
+        dump_index.record(os.path.join(spill_dir, spill_name), bucket, object_name, result, streamed=True)
+    except OSError as e:
+        logger.warning("Could not index %s: %s", object_name, e)
+    return f"s3://{bucket}/{object_name}"
+
+
+def _chain(head: list, tail: object) -> object:
+    yield from head
+    yield from tail
+
+
+def _upload_stream(
+    s3: object,
+    parts: object,
+    bucket: str,
+    object_name: str,
+    upload_id: str,
+    spill_dir: str,
+    max_concurrency: int,
+    checksum_algorithm: str,
+) -> dict:
+    """Upload parts to an open multipart upload, spilling the rest of the stream on failure.
+
+    A part's data is kept until it and every part before it are in S3, so whatever follows the last contiguous
+    uploaded part can always be spilled.
+
+    Returns:
+        dict: Upload result for `multipart_upload.verify_upload()`, None if nothing made it to S3.
+    """
+    window = {}
+    uploaded = []
+    next_part = 1
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while window or not exhausted:
+            while not exhausted and len(window) < max_concurrency:
+                data = next(parts, None)
+                if data is None:
+                    exhausted = True
+                    break
+                part_number = next_part + len(window)
+                window[part_number] = (
+                    data,
+                    executor.submit(
+                        multipart_upload.upload_part,
+                        s3,
+                        bucket,
+                        object_name,
+                        upload_id,
+                        part_number,
+                        data,
+                        checksum_algorithm,
+                    ),
+                )
+            if not window:
+                break
+            future = window[next_part][1]
+            wait([future])
+            if future.exception() is not None:
+                logger.exception(future.exception())
+                rest = _chain([data for data, _ in window.values()], parts)
+                return _complete_partial(
+                    s3, rest, uploaded, bucket, object_name, upload_id, spill_dir, checksum_algorithm
+                )
+            uploaded.append(future.result())
+            del window[next_part]
+            next_part += 1
+    return multipart_upload.complete_upload(s3, bucket, object_name, upload_id, uploaded, checksum_algorithm)
+
+
+def _complete_partial(
+    s3: object,
+    rest: object,
+    uploaded: list,
+    bucket: str,
+    object_name: str,
+    upload_id: str,
+    spill_dir: str,
+    checksum_algorithm: str,
+) -> dict:
+    """Spill the rest of a stream whose upload failed and complete whatever made it to S3.
+
+    Returns:
+        dict: Upload result of the uploaded parts, None if no part made it to S3.
+    """
+    spill_name = os.path.basename(object_name)
+    if not uploaded:
+        try:
+            s3.abort_multipart_upload(Bucket=bucket, Key=object_name, UploadId=upload_id)
+        except S3_ERRORS as e:
+            logger.exception(e)
+        spill(rest, spill_dir, spill_name)
+        return None
+    spill(rest, spill_dir, f"{spill_name}{compression.REST_SUFFIX}")
+    logger.error(
+        f"Only the first {len(uploaded)} parts of {object_name} reached S3, "
+        f"the rest follows as {object_name}{compression.REST_SUFFIX}."
+    )
+    return multipart_upload.complete_upload(s3, bucket, object_name, upload_id, uploaded, checksum_algorithm)
+
+
+class DumpStreamHandler(socketserver.StreamRequestHandler):
+    """Receive one core dump per connection: the file name on the first line, then the raw dump until EOF."""
+
+    def handle(self):
+        name = os.path.basename(self.rfile.readline(256).decode("utf-8", "replace").strip())
+        if not name.startswith("core"):
+            logger.error("Refusing dump stream named %r, names must start with `core`.", name)
+            return
+        with self.server.slots:
+            try:
+                logger.info(ingest_stream(self.rfile, name, self.server.spill_dir))
+            except Exception as e:  # pylint: disable=W0718
+                logger.exception(e)
+
+
+def serve(socket_path: str, spill_dir: str, max_streams: int = int(os.environ.get("PIPE_MAX_STREAMS", "2"))):
+    """Accept core dump streams on a Unix socket until the process is stopped.
+
+    Args:
+        socket_path (str): Path of the Unix socket. Must be reachable from the host, e.g. inside the watched directory.
+        spill_dir (str): Directory watched by `main.py`.
+        max_streams (int, optional): Dumps ingested at once, further connections wait.
+        Defaults to os.environ.get("PIPE_MAX_STREAMS", "2").
+    """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, DumpStreamHandler) as server:
+        server.daemon_threads = True
+        server.spill_dir = spill_dir
+        server.slots = threading.BoundedSemaphore(max_streams)
+        logger.info("Listening for core dump streams on `%s`.", socket_path)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    stdin_parser = subparsers.add_parser("stdin", help="Upload a dump read from stdin, as a core_pattern pipe target.")
+    stdin_parser.add_argument("name", help="Core dump file name, e.g. core-%%e-%%t-%%p-%%s.")
+    stdin_parser.add_argument("spill_dir", help="Directory watched by main.py.")
+    serve_parser = subparsers.add_parser("serve", help="Accept dumps streamed over a Unix socket by a host shim.")
+    serve_parser.add_argument("socket_path", help="Path of the Unix socket.")
+    serve_parser.add_argument("spill_dir", help="Directory watched by main.py.")
+    args = parser.parse_args()
+    if args.mode == "stdin":
+        logger.info(ingest_stream(sys.stdin.buffer, os.path.basename(args.name), args.spill_dir))
+    else:
+        serve(args.socket_path, args.spill_dir)
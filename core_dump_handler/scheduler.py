@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Upload scheduler that sits in front of the worker pool.
+
+Dumps are queued in a bounded priority queue instead of being handed to the pool as they arrive. A crash looping
+executable is sampled per time window, so it cannot crowd out a single dump of something else, and the pool is only
+ever given a few more tasks than it has workers. Dumps found by a backlog scan wait in their own queue and only get a
+few of the workers, so draining a backlog never holds up a fresh dump.
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import random
+import re
+import threading
+import time
+import compression
+import metrics
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+# `core-%e-%t-%p-%s` with an optional suffix such as `.gz`. %e may itself contain dashes.
+CORE_FILE_NAME = re.compile(r"^core-(?P<exe>.+)-(?P<time>\d+)-(?P<pid>\d+)-(?P<signal>\d+)(?P<suffix>\..*)?$")
+# SIGSEGV, SIGABRT, SIGBUS, SIGFPE, SIGILL, SIGTRAP, SIGSYS, SIGQUIT. SIGQUIT is last as it is mostly sent by hand.
+DEFAULT_SIGNAL_PRIORITY = "11,6,7,8,4,5,31,3"
+
+QUEUED = "queued"
+DEFERRED = "deferred"
+DROPPED = "dropped"
+SAMPLED = "sampled"
+DUPLICATE = "duplicate"
+
+
+def parse_core_file_name(file_name: str) -> dict:
+    """Split a `core-%e-%t-%p-%s` file name into its parts.
+
+    Args:
+        file_name (str): Core dump file name, without directory.
+
+    Returns:
+        dict: `exe`, `time`, `pid` and `signal`, None if the name does not follow the pattern.
+    """
+    match = CORE_FILE_NAME.match(file_name)
+    if match is None:
+        return None
+    return {
+        "exe": match.group("exe"),
+        "time": int(match.group("time")),
+        "pid": int(match.group("pid")),
+        "signal": int(match.group("signal")),
+    }
+
+
+class UploadScheduler:
+    """Bounded, prioritized and rate limited queue of dumps waiting for a worker.
+
+    - Per executable, the first `keep_first` dumps of every `window_seconds` window are queued, after that only every
+    `sample_every`th one. Sampled out dumps are never uploaded: depending on `sample_policy` only their triage summary
+    is kept, the caller deletes them once it is up, or they are dropped (deleted from disk) right away.
+    - Queued dumps are ordered smallest first, by signal, or first in first out.
+    - At most `max_queue` dumps are queued. On overflow the least important dump is deferred (kept on disk and
+    retried once the queue is empty) or dropped (deleted from disk), depending on `overflow_policy`. At most
+    `max_deferred` dumps are deferred, beyond that the least important deferred dump is dropped.
+    - `next()` hands out dumps while fewer than `max_in_flight` are with the workers. Queued dumps go first, then
+    backlog dumps while fewer than `max_backlog_in_flight` of them are with the workers, then deferred dumps.
+    - Under disk pressure, see `set_pressure()`, the newest dumps go first, the oldest are the ones being evicted.
+    - A failed upload is put back with `retry()` and handed out again as backlog after an exponential backoff, until
+    it failed `max_attempts` times.
+
+    Callbacks of the pool call `task_done()`, so all methods are thread safe.
+    """
+
+    def __init__(
+        self,
+        max_queue: int = int(os.environ.get("SCHEDULER_MAX_QUEUE", "100")),
+        max_in_flight: int = int(os.environ.get("SCHEDULER_MAX_IN_FLIGHT", "8")),
+        priority: str = os.environ.get("SCHEDULER_PRIORITY", "smallest"),
+        keep_first: int = int(os.environ.get("SCHEDULER_KEEP_FIRST", "0")),
+        sample_every: int = int(os.environ.get("SCHEDULER_SAMPLE_EVERY", "10")),
+        window_seconds: int = int(os.environ.get("SCHEDULER_WINDOW_SECONDS", "600")),
+        overflow_policy: str = os.environ.get("SCHEDULER_OVERFLOW_POLICY", "defer"),
+        sample_policy: str = os.environ.get("SCHEDULER_SAMPLE_POLICY", "summary"),
+        max_deferred: int = int(os.environ.get("SCHEDULER_MAX_DEFERRED", "1000")),
+        signal_priority: str = os.environ.get("SCHEDULER_SIGNAL_PRIORITY", DEFAULT_SIGNAL_PRIORITY),
+        max_backlog_in_flight: int = int(os.environ.get("BACKLOG_DRAIN_CONCURRENCY", "2")),
+        max_attempts: int = int(os.environ.get("UPLOAD_MAX_ATTEMPTS", "5")),
+        retry_seconds: float = float(os.environ.get("UPLOAD_RETRY_SECONDS", "10")),
+        max_retry_seconds: float = float(os.environ.get("UPLOAD_MAX_RETRY_SECONDS", "600")),
+    ):
+        """Create an empty scheduler.
+
+        Args:
+            max_queue (int, optional): Max dumps queued. Defaults to os.environ.get("SCHEDULER_MAX_QUEUE", "100").
+            max_in_flight (int, optional): Max dumps handed to the pool at once.
+            Defaults to os.environ.get("SCHEDULER_MAX_IN_FLIGHT", "8").
+            priority (str, optional): "smallest", "signal" or "fifo". Defaults to os.environ.get("SCHEDULER_PRIORITY",
+            "smallest").
+            keep_first (int, optional): Dumps per executable and window always queued. 0 disables sampling.
+            Defaults to os.environ.get("SCHEDULER_KEEP_FIRST", "0").
+            sample_every (int, optional): After `keep_first`, queue one in this many dumps.
+            Defaults to os.environ.get("SCHEDULER_SAMPLE_EVERY", "10").
+            window_seconds (int, optional): Length of the sampling window.
+            Defaults to os.environ.get("SCHEDULER_WINDOW_SECONDS", "600").
+            overflow_policy (str, optional): "defer" or "drop". Defaults to os.environ.get("SCHEDULER_OVERFLOW_POLICY",
+            "defer").
+            sample_policy (str, optional): "summary" or "drop". Defaults to os.environ.get("SCHEDULER_SAMPLE_POLICY",
+            "summary").
+            max_deferred (int, optional): Max dumps deferred. Defaults to os.environ.get("SCHEDULER_MAX_DEFERRED",
+            "1000").
+            signal_priority (str, optional): Comma separated signal numbers, most important first.
+            Defaults to os.environ.get("SCHEDULER_SIGNAL_PRIORITY", DEFAULT_SIGNAL_PRIORITY).
+            max_backlog_in_flight (int, optional): Max backlog dumps handed to the pool at once.
+            Defaults to os.environ.get("BACKLOG_DRAIN_CONCURRENCY", "2").
+            max_attempts (int, optional): Uploads of a dump before it is left on disk, for a backlog scan at the next
+            start or every BACKLOG_RESCAN_SECONDS.
+            Defaults to os.environ.get("UPLOAD_MAX_ATTEMPTS", "5").
+            retry_seconds (float, optional): Backoff before the first retry, doubled for every further one.
+            Defaults to os.environ.get("UPLOAD_RETRY_SECONDS", "10").
+            max_retry_seconds (float, optional): Longest backoff.
+            Defaults to os.environ.get("UPLOAD_MAX_RETRY_SECONDS", "600").
+        """
+        if priority not in ("smallest", "signal", "fifo"):
+            raise ValueError(f"Unknown scheduler priority {priority}, expected 'smallest', 'signal' or 'fifo'.")
+        if overflow_policy not in ("defer", "drop"):
+            raise ValueError(f"Unknown overflow policy {overflow_policy}, expected 'defer' or 'drop'.")
+        if sample_policy not in ("summary", "drop"):
+            raise ValueError(f"Unknown sample policy {sample_policy}, expected 'summary' or 'drop'.")
+        self.max_queue = max_queue
+        self.max_in_flight = max_in_flight
+        self.priority = priority
+        self.keep_first = keep_first
+        self.sample_every = max(sample_every, 1)
+        self.window_seconds = window_seconds
+        self.overflow_policy = overflow_policy
+        self.sample_policy = sample_policy
+        self.max_deferred = max_deferred
+        self.signal_priority = [int(signal) for signal in signal_priority.split(",") if signal.strip()]
+        self.max_backlog_in_flight = max_backlog_in_flight
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self._queue = []
+        self._backlog = []
+        self._deferred = []
+        self._retry = []
+        self._attempts = {}
+        self._in_flight = set()
+        self._backlog_in_flight = set()
+        self._known = {}
+        self._submitted = {}
+        self._sizes = {}
+        self.pressure = False
+        self._windows = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self) -> int:
+        """Dumps waiting in the queue."""
+        return len(self._queue)
+
+    @property
+    def backlog(self) -> int:
+        """Backlog dumps waiting for a worker."""
+        return len(self._backlog)
+
+    @property
+    def deferred(self) -> int:
+        """Dumps deferred until the queue is empty."""
+        return len(self._deferred)
+
+    @property
+    def retrying(self) -> int:
+        """Failed dumps waiting for their backoff to pass."""
+        return len(self._retry)
+
+    @property
+    def in_flight(self) -> int:
+        """Dumps handed to the pool and not done yet."""
+        return len(self._in_flight)
+
+    def _sort_key(self, size: int, parsed: dict, sequence: int) -> tuple:
+        if self.pressure:
+            return (-sequence,)
+        if self.priority == "smallest":
+            return (size,)
+        if self.priority == "signal":
+            signal = parsed["signal"] if parsed else None
+            rank = self.signal_priority.index(signal) if signal in self.signal_priority else len(self.signal_priority)
+            return (rank, size)
+        return ()
+
+    def _sampled_in(self, exe: str, now: float) -> bool:
+        """Count a dump against its executable's window and decide if it is queued."""
+        if not self.keep_first:
+            return True
+        started, count = self._windows.get(exe, (now, 0))
+        if now - started >= self.window_seconds:
+            started, count = now, 0
+        self._windows[exe] = (started, count + 1)
+        return count < self.keep_first or (count - self.keep_first) % self.sample_every == self.sample_every - 1
+
+    def submit(self, file_name: str, path_to_directory: str, size: int = 0, backlog: bool = False) -> str:
+        """Offer a dump to the scheduler.
+
+        Args:
+            file_name (str): Core dump file name.
+            path_to_directory (str): Directory of the dump.
+            size (int, optional): Size of the dump in bytes. Defaults to 0.
+            backlog (bool, optional): The dump was found by a backlog scan rather than just written. Backlog dumps
+            are neither sampled nor bounded, they are already on disk and only wait for a worker. The spilled tail of
+            a streamed dump, see `compression.REST_SUFFIX`, is always queued like this, its head is in S3 already.
+            Defaults to False.
+
+        Returns:
+            str: What happened to the dump: "queued", "deferred", "dropped", "sampled" or "duplicate". A "sampled" dump
+            is left on disk for the caller to delete once its triage summary is up, or to queue as backlog if none
+            reached S3.
+        """
+        with self._lock:
+            if file_name in self._known or file_name in self._in_flight:
+                return DUPLICATE
+            parsed = parse_core_file_name(file_name)
+            now = time.monotonic()
+            sequence = next(self._sequence)
+            item = [*self._sort_key(size, parsed, sequence), sequence, file_name, path_to_directory]
+            self._submitted[file_name] = now
+            self._sizes[file_name] = size
+            if backlog or compression.is_rest(file_name):
+                self._known[file_name] = QUEUED
+                heapq.heappush(self._backlog, item)
+                return QUEUED
+            if not self._sampled_in(parsed["exe"] if parsed else file_name, now):
+                logger.info("Sampled out %s, %s has crashed repeatedly.", file_name, parsed["exe"] if parsed else "it")
+                if self.sample_policy == "drop":
+                    return self._drop(item)
+                self._submitted.pop(file_name, None)
+                self._sizes.pop(file_name, None)
+                return SAMPLED
+            self._known[file_name] = QUEUED
+            heapq.heappush(self._queue, item)
+            if len(self._queue) > self.max_queue:
+                # Give up the least important dump, which may be the one just offered.
+                worst = max(self._queue)
+                self._queue.remove(worst)
+                heapq.heapify(self._queue)
+                del self._known[worst[-2]]
+                outcome = self._overflow(worst)
+                if worst is item:
+                    return outcome
+            return QUEUED
+
+    def _overflow(self, item: list) -> str:
+        """Defer or drop a dump that did not make it into the queue. Called with the lock held."""
+        file_name = item[-2]
+        if self.overflow_policy == "drop":
+            return self._drop(item)
+        self._known[file_name] = DEFERRED
+        self._deferred.append(item)
+        logger.debug("Deferred %s.", file_name)
+        if len(self._deferred) <= self.max_deferred:
+            return DEFERRED
+        # Give up the least important deferred dump, which may be the one just deferred.
+        worst = max(self._deferred)
+        self._deferred.remove(worst)
+        del self._known[worst[-2]]
+        self._drop(worst)
+        return DROPPED if worst is item else DEFERRED
+
+    def _drop(self, item: list) -> str:
+        """Delete a dump that is not uploaded. Called with the lock held."""
+        file_name, path_to_directory = item[-2], item[-1]
+        self._submitted.pop(file_name, None)
+        self._sizes.pop(file_name, None)
+        try:
+            os.remove(os.path.join(path_to_directory, file_name))
+        except OSError as e:
+            logger.exception(e)
+        logger.warning("Dropped %s.", file_name)
+        return DROPPED
+
+    def next(self) -> tuple:
+        """Take the next dump to hand to the pool, if the pool has room for it.
+
+        Returns:
+            tuple: `(file_name, path_to_directory)`, None if nothing is due or the pool is full.
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._retry and self._retry[0][0] <= now:
+                _, sequence, file_name, path_to_directory = heapq.heappop(self._retry)
+                key = self._sort_key(self._sizes.get(file_name, 0), parse_core_file_name(file_name), sequence)
+                heapq.heappush(self._backlog, [*key, sequence, file_name, path_to_directory])
+                self._submitted[file_name] = now
+            if len(self._in_flight) >= self.max_in_flight:
+                return None
+            if self._queue:
+                item = heapq.heappop(self._queue)
+            elif self._backlog and len(self._backlog_in_flight) < self.max_backlog_in_flight:
+                item = heapq.heappop(self._backlog)
+                self._backlog_in_flight.add(item[-2])
+            elif self._deferred:
+                item = self._deferred.pop(0)
+            else:
+                return None
+            file_name, path_to_directory = item[-2], item[-1]
+            del self._known[file_name]
+            self._sizes.pop(file_name, None)
+            self._in_flight.add(file_name)
+            metrics.observe("stage_seconds", now - self._submitted.pop(file_name), stage="queue")
+            return file_name, path_to_directory
+
+    def set_pressure(self, pressure: bool):
+        """Hand out the newest dumps first while the disk is running full, or go back to `priority`.
+
+        Args:
+            pressure (bool): True under disk pressure.
+        """
+        with self._lock:
+            if pressure == self.pressure:
+                return
+            self.pressure = pressure
+            for queue in (self._queue, self._backlog):
+                for index, item in enumerate(queue):
+                    sequence, file_name, path_to_directory = item[-3:]
+                    size = self._sizes.get(file_name, 0)
+                    key = self._sort_key(size, parse_core_file_name(file_name), sequence)
+                    queue[index] = [*key, sequence, file_name, path_to_directory]
+                heapq.heapify(queue)
+
+    def is_in_flight(self, file_name: str) -> bool:
+        """Check if a dump is with a worker.
+
+        Args:
+            file_name (str): Core dump file name.
+
+        Returns:
+            bool: True if `next()` handed it out and it is not done yet.
+        """
+        with self._lock:
+            return file_name in self._in_flight
+
+    def forget(self, file_name: str) -> bool:
+        """Take a dump that is waiting out of the scheduler, e.g. because it was evicted from disk.
+
+        Args:
+            file_name (str): Core dump file name.
+
+        Returns:
+            bool: False if the dump is with a worker and cannot be taken out, True otherwise.
+        """
+        with self._lock:
+            if file_name in self._in_flight:
+                return False
+            if self._known.pop(file_name, None) is not None:
+                for queue in (self._queue, self._backlog, self._deferred, self._retry):
+                    for item in queue:
+                        if item[-2] == file_name:
+                            queue.remove(item)
+                            break
+                heapq.heapify(self._queue)
+                heapq.heapify(self._backlog)
+                heapq.heapify(self._retry)
+            self._submitted.pop(file_name, None)
+            self._attempts.pop(file_name, None)
+            self._sizes.pop(file_name, None)
+            return True
+
+    def task_done(self, file_name: str):
+        """Mark a dump handed out by `next()` as done, whether it succeeded or not.
+
+        Args:
+            file_name (str): Core dump file name.
+        """
+        with self._lock:
+            self._in_flight.discard(file_name)
+            self._backlog_in_flight.discard(file_name)
+            self._attempts.pop(file_name, None)
+
+    def retry(self, file_name: str, path_to_directory: str, size: int = 0) -> float:
+        """Mark a dump handed out by `next()` as failed and hand it out again after a backoff.
+
+        The backoff doubles with every failure of the dump, up to `max_retry_seconds`, with jitter so dumps that
+        failed together, e.g. while S3 was unreachable, are not all retried at once.
+
+        Args:
+            file_name (str): Core dump file name.
+            path_to_directory (str): Directory of the dump.
+            size (int, optional): Size of the dump in bytes. Defaults to 0.
+
+        Returns:
+            float: Seconds until the retry, None if the dump failed `max_attempts` times and is given up.
+        """
+        with self._lock:
+            self._in_flight.discard(file_name)
+            self._backlog_in_flight.discard(file_name)
+            attempts = self._attempts.pop(file_name, 0) + 1
+            if attempts >= self.max_attempts or file_name in self._known:
+                return None
+            self._attempts[file_name] = attempts
+            delay = min(self.retry_seconds * 2 ** (attempts - 1), self.max_retry_seconds)
+            delay *= random.uniform(0.5, 1.0)
+            heapq.heappush(self._retry, [time.monotonic() + delay, next(self._sequence), file_name, path_to_directory])
+            self._known[file_name] = QUEUED
+            self._sizes[file_name] = size
+            return delay
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Sparse core dumps: upload only the data extents and restore the holes afterwards.
+
+An uncompressed core dump maps the whole address space of the crashed process, most of which was never touched and is
+written as holes. The holes are found with `SEEK_DATA` / `SEEK_HOLE`, only the data extents are read and uploaded, back
+to back, as `<dump>.sparse`, and their offsets are uploaded as the extent map `<dump>.sparse.json`. The map is
+uploaded last, so a map in S3 means the data is complete.
+
+Restore a dump with:
+    python sparse.py fetch <bucket> <dump>.sparse.json <output file>
+or, from files already downloaded:
+    python sparse.py restore <dump>.sparse.json <dump>.sparse <output file>
+"""
+
+import argparse
+import bisect
+import errno
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+DATA_SUFFIX = ".sparse"
+MAP_SUFFIX = ".sparse.json"
+COPY_SIZE = 1024 * 1024
+
+
+def data_extents(
+    file_name: str, min_savings: float = float(os.environ.get("SPARSE_MIN_SAVINGS", "0.25"))
+) -> list:
+    """Data extents of a file, if skipping its holes is worthwhile.
+
+    A `stat()` of the allocated blocks rules out dense files before any seeking.
+
+    Args:
+        file_name (str): File to inspect.
+        min_savings (float, optional): Share of the file that must be holes. Defaults to
+        os.environ.get("SPARSE_MIN_SAVINGS", "0.25").
+
+    Returns:
+        list: `(offset, length)` tuples in file order, None if the file is not sparse enough or the filesystem cannot
+        report holes.
+    """
+    stat = os.stat(file_name)
+    if not stat.st_size or stat.st_blocks * 512 > stat.st_size * (1 - min_savings):
+        return None
+    extents = []
+    with open(file_name, "rb") as sparse_file:
+        fd = sparse_file.fileno()
+        offset = 0
+        while offset < stat.st_size:
+            try:
+                data = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                if e.errno == errno.EINVAL:
+                    return None
+                raise
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), stat.st_size)
+            extents.append((data, hole - data))
+            offset = hole
+    if packed_size(extents) > stat.st_size * (1 - min_savings):
+        return None
+    logger.debug("%s has %s data extents.", file_name, len(extents))
+    return extents
+
+
+def packed_size(extents: list) -> int:
+    """Bytes of data in a list of extents.
+
+    Args:
+        extents (list): `(offset, length)` tuples.
+
+    Returns:
+        int: Total length.
+    """
+    return sum(length for _, length in extents)
+
+
+def extent_map(file_size: int, extents: list, data_object: str) -> bytes:
+    """Extent map uploaded next to the data.
+
+    Args:
+        file_size (int): Size of the original file, holes included.
+        extents (list): `(offset, length)` tuples.
+        data_object (str): S3 object name of the packed data.
+
+    Returns:
+        bytes: JSON document.
+    """
+    return json.dumps(
+        {"version": 1, "size": file_size, "data": data_object, "extents": [list(extent) for extent in extents]},
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class ExtentReader:
+    """Read-only file-like object over the data extents of a file, as if they were written back to back.
+
+    Supports `readinto()` for `multipart_upload.upload_parts()` and seeking, so journaled uploads can resume.
+    """
+
+    def __init__(self, file_name: str, extents: list):
+        """Open the file.
+
+        Args:
+            file_name (str): Sparse file.
+            extents (list): `(offset, length)` tuples from `data_extents()`.
+        """
+        self.extents = extents
+        self.size = packed_size(extents)
+        self._starts = []
+        start = 0
+        for _, length in extents:
+            self._starts.append(start)
+            start += length
+        self._position = 0
+        self._file = open(file_name, "rb")  # pylint: disable=R1732
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def readinto(self, buffer: object) -> int:
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        while filled < len(view) and self._position < self.size:
+            index = bisect.bisect_right(self._starts, self._position) - 1
+            offset, length = self.extents[index]
+            within = self._position - self._starts[index]
+            count = min(len(view) - filled, length - within)
+            self._file.seek(offset + within)
+            read = self._file.readinto(view[filled : filled + count])
+            if not read:
+                raise EOFError(f"{self._file.name} shrank while it was read.")
+            filled += read
+            self._position += read
+        return filled
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.size - self._position
+        buffer = bytearray(remaining if size is None or size < 0 else min(size, remaining))
+        return bytes(buffer[: self.readinto(buffer)])
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: self.size}[whence]
+        self._position = max(0, min(base + offset, self.size))
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def restore(dump_map: dict, data: object, output: str) -> int:
+    """Rebuild the original file from an extent map and the packed data.
+
+    Args:
+        dump_map (dict): Parsed extent map.
+        data (object): Binary file-like object with the packed data, e.g. an S3 `StreamingBody`.
+        output (str): File to write. Holes are left unwritten, so it is sparse again.
+
+    Returns:
+        int: Bytes of data written.
+    """
+    if dump_map.get("version") != 1:
+        raise ValueError(f"Unsupported extent map version {dump_map.get('version')}.")
+    written = 0
+    with open(output, "wb") as restored:
+        for offset, length in dump_map["extents"]:
+            restored.seek(offset)
+            while length:
+                block = data.read(min(length, COPY_SIZE))
+                if not block:
+                    raise EOFError(f"Packed data ended {length} bytes short of the extent at {offset}.")
+                restored.write(block)
+                length -= len(block)
+                written += len(block)
+        restored.truncate(dump_map["size"])
+    logger.info("Restored %s, %s bytes of data in %s bytes.", output, written, dump_map["size"])
+    return written
+
+
+def fetch(bucket: str, map_object: str, output: str) -> int:
+    """Download a sparse dump from S3 and restore it.
+
+    Args:
+        bucket (str): Bucket name.
+        map_object (str): S3 object name of the extent map, `<dump>.sparse.json`.
+        output (str): File to write.
+
+    Returns:
+        int: Bytes of data written.
+    """
+    import upload_file_2_s3  # pylint: disable=C0415
+
+    s3 = upload_file_2_s3.get_s3_client()
+    dump_map = json.loads(s3.get_object(Bucket=bucket, Key=map_object)["Body"].read())
+    data = s3.get_object(Bucket=bucket, Key=dump_map["data"])["Body"]
+    try:
+        return restore(dump_map, data, output)
+    finally:
+        data.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    fetch_parser = subparsers.add_parser("fetch", help="Download a sparse dump from S3 and restore it.")
+    fetch_parser.add_argument("bucket", help="Bucket name.")
+    fetch_parser.add_argument("map_object", help="S3 object name of the extent map.")
+    fetch_parser.add_argument("output", help="File to write.")
+    restore_parser = subparsers.add_parser("restore", help="Restore a sparse dump from downloaded files.")
+    restore_parser.add_argument("map_file", help="Extent map file.")
+    restore_parser.add_argument("data_file", help="Packed data file.")
+    restore_parser.add_argument("output", help="File to write.")
+    args = parser.parse_args()
+    if args.mode == "fetch":
+        fetch(args.bucket, args.map_object, args.output)
+    else:
+        with open(args.map_file, "r", encoding="utf-8") as map_file, open(args.data_file, "rb") as data_file:
+            restore(json.load(map_file), data_file, args.output)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Detection of uploads that stopped making progress.
+
+Every running upload has a slot in `ProgressTable`, shared memory the parent hands to the workers like the transfer
+budget. The slot's clock starts when a worker picks the upload up, not when it is dispatched. The worker adds the bytes
+it sends to its slot. Reading the dump, waiting for the throttle and the first minute of a wait for the transfer budget
+count as progress too. The parent's `StallWatchdog` cancels an upload that made no progress for `STALL_SECONDS`: the
+upload's stop event is set, it journals the parts it sent and fails, and the scheduler retries it after a backoff. An
+upload that does not stop within `STALL_GRACE_SECONDS` of being cancelled is stuck in a way the handler cannot fix,
+e.g. in a system call, and the watchdog reports the handler unhealthy, so the liveness probe restarts it and the
+journal resumes the upload.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import metrics
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+# Seconds between two looks at the cancel flag while waiting, e.g. for throttle tokens.
+POLL_SECONDS = 0.1
+
+
+class ProgressTable:
+    """Bytes sent and time of the last progress of every running upload, in shared memory."""
+
+    def __init__(self, slots: int, context: object = None):
+        """Create the shared table, all slots free.
+
+        Args:
+            slots (int): Uploads that can run at once.
+            context (object, optional): Multiprocessing context. Defaults to None (the default context).
+        """
+        context = context or multiprocessing.get_context()
+        self.slots = slots
+        self._bytes = context.Array("q", slots, lock=False)
+        # CLOCK_MONOTONIC is system wide on Linux, the parent compares the workers' time stamps with its own.
+        self._updated = context.Array("d", slots, lock=False)
+        self._cancelled = context.Array("b", slots, lock=False)
+        self._lock = context.Lock()
+
+    def reset(self, slot: int):
+        """Start a slot over for a new upload. Its clock only runs once the worker calls `start()`."""
+        with self._lock:
+            self._bytes[slot] = 0
+            self._updated[slot] = 0
+            self._cancelled[slot] = 0
+
+    def start(self, slot: int):
+        """Start the clock of an upload. Called by the worker when it picks the upload up."""
+        with self._lock:
+            self._updated[slot] = time.monotonic()
+
+    def started(self, slot: int) -> bool:
+        """Check if a worker picked the upload up."""
+        return self._updated[slot] != 0
+
+    def advance(self, slot: int, nbytes: int):
+        """Record bytes sent by an upload. Called by the worker, from any of its part threads.
+
+        Args:
+            slot (int): Slot of the upload.
+            nbytes (int): Bytes sent, 0 for progress that sends nothing, e.g. a part read from disk.
+        """
+        with self._lock:
+            self._bytes[slot] += nbytes
+            self._updated[slot] = time.monotonic()
+
+    def sent(self, slot: int) -> int:
+        """Bytes an upload sent so far."""
+        return self._bytes[slot]
+
+    def idle(self, slot: int, now: float = None) -> float:
+        """Seconds since an upload last made progress, 0 until a worker picked it up."""
+        if not self.started(slot):
+            return 0.0
+        return (time.monotonic() if now is None else now) - self._updated[slot]
+
+    def cancel(self, slot: int):
+        """Tell an upload to stop."""
+        self._cancelled[slot] = 1
+
+    def cancelled(self, slot: int) -> bool:
+        """Check if an upload was told to stop."""
+        return bool(self._cancelled[slot])
+
+    def stop_event(self, slot: int, shutdown: object = None) -> object:
+        """Stop event of one upload, set once it is cancelled or the handler shuts down.
+
+        Args:
+            slot (int): Slot of the upload.
+            shutdown (object, optional): Handler wide shutdown event. Defaults to None.
+
+        Returns:
+            object: `TaskStop`.
+        """
+        return TaskStop(self, slot, shutdown)
+
+
+class TaskStop:
+    """Event-like view of an upload's cancel flag and the shutdown event, for `upload_parts()` and the throttle.
+
+    Time spent in `wait()`, i.e. held back by the throttle, counts as progress of the upload.
+    """
+
+    def __init__(self, progress: ProgressTable, slot: int, shutdown: object = None):
+        self._progress = progress
+        self._slot = slot
+        self._shutdown = shutdown
+
+    def is_set(self) -> bool:
+        return self._progress.cancelled(self._slot) or (self._shutdown is not None and self._shutdown.is_set())
+
+    def wait(self, timeout: float = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            self._progress.advance(self._slot, 0)
+            remaining = POLL_SECONDS if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(POLL_SECONDS, remaining))
+        return True
+
+
+class StallWatchdog:
+    """Parent side of the progress table: hands out slots, cancels stalled uploads and spots hung ones.
+
+    The main loop calls `check()` and pool callbacks call `untrack()`, so all methods are thread safe.
+    """
+
+    def __init__(
+        self,
+        progress: ProgressTable,
+        stall_seconds: float = float(os.environ.get("STALL_SECONDS", "120")),
+        grace_seconds: float = float(os.environ.get("STALL_GRACE_SECONDS", "300")),
+    ):
+        """Create the watchdog.
+
+        Args:
+            progress (ProgressTable): Table shared with the workers.
+            stall_seconds (float, optional): Seconds without progress before an upload is cancelled. 0 disables.
+            Defaults to os.environ.get("STALL_SECONDS", "120").
+            grace_seconds (float, optional): Seconds a cancelled upload has to stop before the handler reports
+            itself unhealthy. Defaults to os.environ.get("STALL_GRACE_SECONDS", "300").
+        """
+        self.progress = progress
+        self.stall_seconds = stall_seconds
+        self.grace_seconds = grace_seconds
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> int:
+        """Uploads being tracked."""
+        return len(self._tasks)
+
+    def track(self, file_name: str) -> int:
+        """Give an upload about to be dispatched a slot. It is not watched until the worker starts the slot's clock.
+
+        Args:
+            file_name (str): Core dump file name.
+
+        Returns:
+            int: Slot for the worker, None if every slot is taken and the upload goes untracked.
+        """
+        with self._lock:
+            free = [slot for slot in range(self.progress.slots) if slot not in self._tasks]
+            if not free:
+                logger.warning("No progress slot left for %s, it is not watched for stalls.", file_name)
+                return None
+            slot = free[0]
+            self.progress.reset(slot)
+            self._tasks[slot] = {"file_name": file_name, "cancelled_at": None}
+            return slot
+
+    def untrack(self, slot: int):
+        """Free the slot of an upload that finished, whether it succeeded or not.
+
+        Args:
+            slot (int): Slot from `track()`, None is ignored.
+        """
+        if slot is None:
+            return
+        with self._lock:
+            self._tasks.pop(slot, None)
+
+    def check(self, now: float = None) -> list:
+        """Cancel the uploads that made no progress for `stall_seconds`.
+
+        Args:
+            now (float, optional): Current `time.monotonic()`. Defaults to None.
+
+        Returns:
+            list: File names of the uploads cancelled by this call.
+        """
+        if not self.stall_seconds:
+            return []
+        now = time.monotonic() if now is None else now
+        cancelled = []
+        with self._lock:
+            for slot, task in self._tasks.items():
+                idle = self.progress.idle(slot, now)
+                if task["cancelled_at"] is None and idle >= self.stall_seconds:
+                    logger.warning(
+                        "Upload of %s made no progress for %.0f seconds after %s bytes, cancelling it.",
+                        task["file_name"],
+                        idle,
+                        self.progress.sent(slot),
+                    )
+                    self.progress.cancel(slot)
+                    task["cancelled_at"] = now
+                    metrics.inc("stalled_uploads_total")
+                    cancelled.append(task["file_name"])
+        return cancelled
+
+    def hung(self, now: float = None) -> list:
+        """Uploads that were cancelled more than `grace_seconds` ago and are still running.
+
+        Args:
+            now (float, optional): Current `time.monotonic()`. Defaults to None.
+
+        Returns:
+            list: File names.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [
+                task["file_name"]
+                for task in self._tasks.values()
+                if task["cancelled_at"] is not None and now - task["cancelled_at"] >= self.grace_seconds
+            ]
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Pacing of uploads, so a burst of dumps does not take the node's network and disk from the workloads running on it.
+
+`Throttle` holds two token buckets in shared memory, one for bytes sent to S3 and one for bytes read from disk. Every
+worker process and part upload thread takes tokens from the same buckets, so the configured rates hold for the whole
+handler no matter how many uploads run at once. With adaptive backoff the network rate is lowered while S3 requests
+take much longer than usual and raised again once they recover. `lower_priority()` runs uploads at a lower CPU and IO
+priority than the workloads on the node.
+"""
+
+import ctypes
+import logging
+import multiprocessing
+import os
+import platform
+import time
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+MiB = 1024 * 1024
+# Adaptive backoff: back off when requests take this many times the baseline, recover below the second ratio.
+BACKOFF_RATIO = 2.0
+RECOVER_RATIO = 1.25
+MIN_FACTOR = 0.1
+# Seconds between two changes of the backoff factor, so one slow burst does not back off all the way at once.
+ADJUST_SECONDS = 5.0
+# The baseline creeps up this much per request, so it follows a network that got slower for good.
+BASELINE_DRIFT = 0.01
+# ioprio_set(2) syscall numbers, Python has no binding.
+IOPRIO_SET = {"x86_64": 251, "aarch64": 30, "i686": 289, "armv7l": 314}
+# Only classes at or below the default, the realtime class would put the workers ahead of the workloads on the node.
+IOPRIO_CLASSES = {"best-effort": 2, "idle": 3}
+# Level a thread gets within "best-effort" by default, lower levels are higher priorities.
+IOPRIO_DEFAULT_LEVEL = 4
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+
+class TokenBucket:
+    """Cross-process token bucket of bytes per second.
+
+    Tokens are taken before the bytes are sent or read. A request larger than the tokens left puts the bucket in debt
+    and waits for it to be paid back, so requests of any size are let through in turn and the rate holds on average.
+    """
+
+    def __init__(self, rate: int = 0, burst: int = None, context: object = None):
+        """Create the shared bucket, full.
+
+        Args:
+            rate (int, optional): Bytes per second. 0 disables the bucket. Defaults to 0.
+            burst (int, optional): Bytes that can be taken at once without waiting. Defaults to None, one second.
+            context (object, optional): Multiprocessing context. Defaults to None (the default context).
+        """
+        context = context or multiprocessing.get_context()
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = context.Value("d", float(self.burst), lock=False)
+        # CLOCK_MONOTONIC is system wide on Linux, so every process can refill from the same time stamp.
+        self._updated = context.Value("d", time.monotonic(), lock=False)
+        self._factor = context.Value("d", 1.0, lock=False)
+        self._waited = context.Value("d", 0.0, lock=False)
+        self._lock = context.Lock()
+
+    @property
+    def current_rate(self) -> float:
+        """Bytes per second after adaptive backoff, 0 if the bucket is disabled."""
+        return self.rate * self._factor.value
+
+    @property
+    def factor(self) -> float:
+        """Share of the configured rate in use, 1.0 unless backed off."""
+        return self._factor.value
+
+    @factor.setter
+    def factor(self, value: float):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._factor.value = value
+
+    @property
+    def waited(self) -> float:
+        """Seconds requests waited for tokens, across every process."""
+        return self._waited.value
+
+    def _refill(self, now: float):
+        rate = self.rate * self._factor.value
+        self._tokens.value = min(self.burst, self._tokens.value + (now - self._updated.value) * rate)
+        self._updated.value = now
+
+    def take(self, nbytes: int, stop: object = None) -> float:
+        """Take tokens for `nbytes` bytes, waiting until the bucket can afford them.
+
+        Args:
+            nbytes (int): Bytes about to be sent or read.
+            stop (object, optional): Event that cuts the wait short, e.g. on shutdown. Defaults to None.
+
+        Returns:
+            float: Seconds waited.
+        """
+        if not self.rate or nbytes <= 0:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens.value -= nbytes
+            wait = -self._tokens.value / (self.rate * self._factor.value) if self._tokens.value < 0 else 0.0
+            self._waited.value += wait
+        if wait:
+            logger.debug("Pacing %s bytes for %.2f seconds.", nbytes, wait)
+            if stop is not None:
+                stop.wait(wait)
+            else:
+                time.sleep(wait)
+        return wait
+
+
+class Throttle:
+    """Network and disk rates shared by every upload, with optional adaptive backoff of the network rate."""
+
+    def __init__(
+        self,
+        network_bytes_per_second: int = int(os.environ.get("THROTTLE_NETWORK_BYTES_PER_SECOND", "0")),
+        disk_bytes_per_second: int = int(os.environ.get("THROTTLE_DISK_BYTES_PER_SECOND", "0")),
+        adaptive: bool = os.environ.get("THROTTLE_ADAPTIVE", "false").lower() == "true",
+        context: object = None,
+    ):
+        """Create the shared buckets. Create it in the parent and hand it to the workers like the transfer budget.
+
+        Args:
+            network_bytes_per_second (int, optional): Bytes per second sent to S3. 0 is unlimited.
+            Defaults to os.environ.get("THROTTLE_NETWORK_BYTES_PER_SECOND", "0").
+            disk_bytes_per_second (int, optional): Bytes per second read from dumps. 0 is unlimited.
+            Defaults to os.environ.get("THROTTLE_DISK_BYTES_PER_SECOND", "0").
+            adaptive (bool, optional): Lower the network rate while S3 latency is up. Needs a network rate.
+            Defaults to os.environ.get("THROTTLE_ADAPTIVE", "false").
+            context (object, optional): Multiprocessing context. Defaults to None (the default context).
+        """
+        context = context or multiprocessing.get_context()
+        self.network = TokenBucket(network_bytes_per_second, context=context)
+        self.disk = TokenBucket(disk_bytes_per_second, context=context)
+        self.adaptive = adaptive and network_bytes_per_second > 0
+        if adaptive and not self.adaptive:
+            logger.warning("THROTTLE_ADAPTIVE needs THROTTLE_NETWORK_BYTES_PER_SECOND, adaptive backoff is off.")
+        # Seconds per MiB of recent requests and of the fastest ones, shared so every worker backs off together.
+        self._latency = context.Value("d", 0.0, lock=False)
+        self._baseline = context.Value("d", 0.0, lock=False)
+        self._adjusted = context.Value("d", 0.0, lock=False)
+        self._lock = context.Lock()
+
+    def observe(self, nbytes: int, seconds: float):
+        """Feed the duration of one S3 request to the adaptive backoff.
+
+        Args:
+            nbytes (int): Bytes sent.
+            seconds (float): Seconds the request took.
+        """
+        if not self.adaptive or nbytes <= 0:
+            return
+        # Per MiB, so parts of different sizes compare. Small requests are dominated by the round trip, count them
+        # as 1MiB.
+        sample = seconds / max(nbytes / MiB, 1.0)
+        with self._lock:
+            latency = sample if not self._latency.value else 0.7 * self._latency.value + 0.3 * sample
+            baseline = self._baseline.value * (1 + BASELINE_DRIFT) if self._baseline.value else sample
+            self._latency.value = latency
+            self._baseline.value = baseline = min(baseline, sample)
+            now = time.monotonic()
+            if now - self._adjusted.value < ADJUST_SECONDS:
+                return
+            factor = self.network.factor
+            if latency > BACKOFF_RATIO * baseline and factor > MIN_FACTOR:
+                factor = max(MIN_FACTOR, factor / 2)
+                logger.info(
+                    "S3 latency %.2fs/MiB is up from %.2fs/MiB, pacing uploads to %.0f bytes/s.",
+                    latency,
+                    baseline,
+                    self.network.rate * factor,
+                )
+            elif latency < RECOVER_RATIO * baseline and factor < 1.0:
+                factor = min(1.0, factor + 0.1)
+                logger.debug("S3 latency back to %.2fs/MiB, raising the upload rate.", latency)
+            else:
+                return
+            self.network.factor = factor
+            self._adjusted.value = now
+
+
+class ThrottledReader:
+    """File-like wrapper that takes disk tokens for every byte read from the wrapped stream."""
+
+    def __init__(self, source: object, bucket: TokenBucket, stop: object = None):
+        """Wrap a stream.
+
+        Args:
+            source (object): Binary file-like object, closed with the reader.
+            bucket (TokenBucket): Disk bucket.
+            stop (object, optional): Event that cuts waits short. Defaults to None.
+        """
+        self._source = source
+        self._bucket = bucket
+        self._stop = stop
+
+    def readinto(self, buffer: object) -> int:
+        count = self._source.readinto(buffer)
+        self._bucket.take(count or 0, self._stop)
+        return count
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._source.read(size)
+        self._bucket.take(len(data), self._stop)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._source.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._source.tell()
+
+    def close(self):
+        self._source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def lower_priority(
+    niceness: int = int(os.environ.get("WORKER_NICE", "10")),
+    io_class: str = os.environ.get("WORKER_IO_CLASS", "best-effort"),
+    io_level: int = int(os.environ.get("WORKER_IO_LEVEL", "7")),
+):
+    """Lower the CPU and IO priority of the calling thread, and of the threads it starts after.
+
+    Linux keeps both priorities per thread, so call it in a pool initializer or a thread pool's initializer before
+    any upload runs. Settings that would raise a priority are refused.
+
+    Args:
+        niceness (int, optional): Added to the nice value, at least 0. 0 keeps it.
+        Defaults to os.environ.get("WORKER_NICE", "10").
+        io_class (str, optional): "best-effort", "idle" or "off" to keep the IO priority. "idle" only gets the disk
+        when nothing else uses it. Defaults to os.environ.get("WORKER_IO_CLASS", "best-effort").
+        io_level (int, optional): Level within "best-effort", from `IOPRIO_DEFAULT_LEVEL` to 7 lowest.
+        Defaults to os.environ.get("WORKER_IO_LEVEL", "7").
+    """
+    if niceness < 0:
+        raise ValueError(f"WORKER_NICE {niceness} would raise the CPU priority, expected 0 or more.")
+    if niceness:
+        try:
+            os.nice(niceness)
+        except OSError as e:
+            logger.warning(f"Could not lower the CPU priority: {e}")
+    if io_class == "off":
+        return
+    if io_class not in IOPRIO_CLASSES:
+        raise ValueError(f"Unknown IO class {io_class}, expected one of {', '.join(IOPRIO_CLASSES)} or off.")
+    if io_class == "best-effort" and not IOPRIO_DEFAULT_LEVEL <= io_level <= 7:
+        raise ValueError(
+            f"WORKER_IO_LEVEL {io_level} would raise the IO priority, expected {IOPRIO_DEFAULT_LEVEL} to 7."
+        )
+    syscall_number = IOPRIO_SET.get(platform.machine())
+    if syscall_number is None:
+        logger.debug("ioprio_set is not known on %s, keeping the IO priority.", platform.machine())
+        return
+    priority = IOPRIO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT | (io_level if io_class == "best-effort" else 0)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, priority) != 0:
+        logger.warning(f"Could not lower the IO priority: {os.strerror(ctypes.get_errno())}")
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Memory budget shared by every upload of the Core Dump Handler.
+
+`TransferBudget` caps the bytes of part buffers held in memory across all worker processes and their part upload
+threads. `BufferPool` hands out reusable part buffers so parts are read with `readinto()` instead of allocating a new
+bytes object for every part.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+
+class TransferBudget:
+    """Cross-process budget of in-flight upload bytes.
+
+    Create it in the parent and hand it to the pool workers through the pool initializer. A single request larger than
+    the whole budget is let through once nothing else is in flight, so it can never block forever.
+
+    The bytes and uploads of every process are counted too, so the parent can `reclaim()` what a worker killed in the
+    middle of an upload held.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, context: object = None, max_holders: int = 64):
+        """Create the shared counter.
+
+        Args:
+            max_bytes (int, optional): Bytes allowed in flight at once. Defaults to 64MiB.
+            context (object, optional): Multiprocessing context. Defaults to None (the default context).
+            max_holders (int, optional): Processes whose share is counted for `reclaim()`. Defaults to 64.
+        """
+        context = context or multiprocessing.get_context()
+        self.max_bytes = max_bytes
+        self._in_use = context.Value("q", 0, lock=False)
+        self._active_uploads = context.Value("i", 0, lock=False)
+        # `pid, bytes, uploads` of every process holding part of the budget.
+        self._holders = context.Array("q", 3 * max_holders, lock=False)
+        self._condition = context.Condition()
+
+    @property
+    def in_use(self) -> int:
+        """Bytes currently in flight across every process."""
+        return self._in_use.value
+
+    @property
+    def active_uploads(self) -> int:
+        """Uploads currently running across every process."""
+        return self._active_uploads.value
+
+    def share(self) -> int:
+        """Bytes of the budget each running upload gets, split evenly between the uploads running right now."""
+        return self.max_bytes // max(self._active_uploads.value, 1)
+
+    def upload_started(self):
+        """Count an upload as running, so uploads can split the budget between them."""
+        with self._condition:
+            self._active_uploads.value += 1
+            self._hold(0, 1)
+
+    def upload_finished(self):
+        """Count an upload as finished."""
+        with self._condition:
+            self._active_uploads.value -= 1
+            self._hold(0, -1)
+
+    def acquire(self, nbytes: int, timeout: float = None) -> bool:
+        """Wait until `nbytes` fit in the budget and take them.
+
+        Args:
+            nbytes (int): Bytes to take.
+            timeout (float, optional): Max seconds to wait. Defaults to None (wait forever).
+
+        Returns:
+            bool: True if the bytes were taken, False on timeout.
+        """
+        with self._condition:
+            acquired = self._condition.wait_for(
+                lambda: self._in_use.value == 0 or self._in_use.value + nbytes <= self.max_bytes, timeout=timeout
+            )
+            if acquired:
+                self._in_use.value += nbytes
+                self._hold(nbytes, 0)
+            return acquired
+
+    def release(self, nbytes: int):
+        """Give bytes back to the budget.
+
+        Args:
+            nbytes (int): Bytes to give back, as taken by `acquire()`.
+        """
+        with self._condition:
+            self._in_use.value -= nbytes
+            self._hold(-nbytes, 0)
+            self._condition.notify_all()
+
+    def reclaim(self) -> int:
+        """Give back the bytes and uploads held by processes that are gone, e.g. a worker killed mid-upload.
+
+        Called regularly by the parent. Without it the share of a dead worker would be lost until the handler restarts
+        and every later upload would wait for it.
+
+        Returns:
+            int: Bytes given back.
+        """
+        reclaimed = 0
+        with self._condition:
+            for index in range(0, len(self._holders), 3):
+                pid, nbytes, uploads = self._holders[index : index + 3]
+                if not pid or pid == os.getpid() or _alive(pid):
+                    continue
+                self._in_use.value -= nbytes
+                self._active_uploads.value -= uploads
+                self._holders[index : index + 3] = [0, 0, 0]
+                reclaimed += nbytes
+                logger.warning(
+                    "Reclaimed %s bytes and %s uploads of the transfer budget from dead process %s.",
+                    nbytes,
+                    uploads,
+                    pid,
+                )
+            if reclaimed:
+                self._condition.notify_all()
+        return reclaimed
+
+    def _hold(self, nbytes: int, uploads: int):
+        """Count bytes and uploads against the calling process. Called with the condition held."""
+        pid = os.getpid()
+        free = None
+        for index in range(0, len(self._holders), 3):
+            if self._holders[index] == pid:
+                break
+            if free is None and not self._holders[index]:
+                free = index
+        else:
+            if free is None:
+                # More processes than slots, the share of this one cannot be reclaimed.
+                return
+            index = free
+            self._holders[index] = pid
+        self._holders[index + 1] += nbytes
+        self._holders[index + 2] += uploads
+        if not self._holders[index + 1] and not self._holders[index + 2]:
+            self._holders[index] = 0
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class BufferPool:
+    """Pool of reusable part buffers for one upload, charged against a `TransferBudget`.
+
+    The budget is charged when a buffer is allocated and credited when it is freed, so it always matches the part
+    buffers held in memory. A buffer returned with `put()` is kept for the next part, any further one is freed right
+    away so finished parts do not hold budget other uploads wait for. `close()` frees them all.
+    """
+
+    def __init__(self, budget: TransferBudget = None, max_idle: int = 1):
+        """Create an empty pool.
+
+        Args:
+            budget (TransferBudget, optional): Budget to charge allocations to. Defaults to None (unlimited).
+            max_idle (int, optional): Idle buffers kept for reuse, extra buffers are freed. Defaults to 1.
+        """
+        self.budget = budget
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _take_idle(self, size: int) -> bytearray:
+        with self._lock:
+            for index, buffer in enumerate(self._idle):
+                if len(buffer) >= size:
+                    return self._idle.pop(index)
+        return None
+
+    def get(self, size: int, waiting: object = None, stop: object = None) -> bytearray:
+        """Take a buffer of at least `size` bytes, waiting for the budget if a new one has to be allocated.
+
+        Args:
+            size (int): Minimum buffer size.
+            waiting (object, optional): Called with the seconds waited so far every time the budget is still used up,
+            e.g. to tell a stall watchdog that the upload is held back, not stuck. Defaults to None.
+            stop (object, optional): Event that ends the wait for the budget, e.g. the upload's stop event.
+            Defaults to None.
+
+        Returns:
+            bytearray: Buffer, None if `stop` was set while waiting for the budget.
+        """
+        started = time.monotonic()
+        while True:
+            buffer = self._take_idle(size)
+            if buffer is not None:
+                return buffer
+            # Poll so buffers put back by this upload's own part threads are picked up while waiting for the budget.
+            if self.budget is None or self.budget.acquire(size, timeout=0.05):
+                return bytearray(size)
+            if stop is not None and stop.is_set():
+                return None
+            if waiting is not None:
+                waiting(time.monotonic() - started)
+
+    def put(self, buffer: bytearray):
+        """Return a buffer to the pool.
+
+        Args:
+            buffer (bytearray): Buffer from `get()`.
+        """
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(buffer)
+                return
+        self._free(buffer)
+
+    def close(self):
+        """Free every idle buffer."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for buffer in idle:
+            self._free(buffer)
+
+    def _free(self, buffer: bytearray):
+        if self.budget is not None:
+            self.budget.release(len(buffer))
+
+
+class BufferReader:
+    """Read-only, seekable file-like view of a part buffer, so botocore can send and retry it without a copy."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._position = 0
+
+    def __len__(self) -> int:
+        return len(self._view)
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(self._position + size, len(self._view))
+        data = self._view[self._position : end].tobytes()
+        self._position = end
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._position, os.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, min(base + offset, len(self._view)))
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def readinto_full(source: object, view: memoryview) -> int:
+    """Fill a buffer from `source`, looping over short reads from pipes and sockets.
+
+    Args:
+        source (object): Binary file-like object with a `readinto()` method.
+        view (memoryview): Buffer to fill.
+
+    Returns:
+        int: Bytes read, less than `len(view)` only at the end of the stream.
+    """
+    filled = 0
+    while filled < len(view):
+        count = source.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return filled
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Pick multipart settings for an upload from the size of the dump and the uploads running next to it.
+"""
+
+import logging
+import math
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+MiB = 1024 * 1024
+# S3 multipart limits.
+MIN_PART_SIZE = 5 * MiB
+MAX_PARTS = 10000
+# Files smaller than this go up in a single request, a multipart upload only pays off with at least a few parts.
+MULTIPART_THRESHOLD = 16 * MiB
+PART_SIZE = 8 * MiB
+# Above PART_SIZE * TARGET_PARTS the part size grows instead of the part count, keeping request overhead flat.
+TARGET_PARTS = 1000
+
+
+def plan_transfer(
+    file_size: int,
+    active_uploads: int = 1,
+    max_connections: int = 20,
+    budget_bytes: int = 0,
+    max_concurrency: int = None,
+) -> dict:
+    """Multipart threshold, part size and concurrency for one upload.
+
+    - Files under 16MiB use a single PutObject request.
+    - Parts are 8MiB, growing for files over ~8GiB so they stay around 1,000 parts, and never fewer than needed to
+    stay under S3's 10,000 part limit.
+    - The connections and the transfer budget are split evenly between the uploads running at the same time, with at
+    least two parts of the budget per upload so every upload keeps streaming.
+
+    Args:
+        file_size (int): Size of the file in bytes.
+        active_uploads (int, optional): Uploads running at the same time, including this one. Defaults to 1.
+        max_connections (int, optional): S3 connections of one worker. Defaults to 20.
+        budget_bytes (int, optional): Transfer budget shared by all uploads. 0 means unlimited. Defaults to 0.
+        max_concurrency (int, optional): Upper bound on the concurrency, e.g. from `ThroughputTuner`.
+        Defaults to None.
+
+    Returns:
+        dict: `multipart_threshold`, `part_size` and `max_concurrency`.
+    """
+    active_uploads = max(active_uploads, 1)
+    min_part_size = max(MIN_PART_SIZE, _round_up_mib(math.ceil(file_size / MAX_PARTS)))
+    part_size = max(PART_SIZE, _round_up_mib(math.ceil(file_size / TARGET_PARTS)))
+    budget_share = budget_bytes // active_uploads if budget_bytes else 0
+    if budget_share:
+        part_size = min(part_size, max(MIN_PART_SIZE, budget_share // 2 // MiB * MiB))
+    part_size = max(part_size, min_part_size)
+    parts = max(1, math.ceil(file_size / part_size))
+    concurrency = max(1, max_connections // active_uploads)
+    if budget_share:
+        concurrency = min(concurrency, max(1, budget_share // part_size))
+    if max_concurrency:
+        concurrency = min(concurrency, max_concurrency)
+    plan = {
+        "multipart_threshold": MULTIPART_THRESHOLD,
+        "part_size": part_size,
+        "max_concurrency": min(concurrency, parts),
+    }
+    logger.debug("Transfer plan for %s bytes with %s active uploads: %s", file_size, active_uploads, plan)
+    return plan
+
+
+def _round_up_mib(size: int) -> int:
+    return math.ceil(size / MiB) * MiB
+
+
+class ThroughputTuner:
+    """Hill climbing on per-upload concurrency from the throughput of recent uploads.
+
+    The cap starts low and grows by one connection while the extra connection still adds at least 5% aggregate
+    throughput. Once it stops paying off, e.g. when the node's NIC or the S3 prefix is saturated, the cap steps back
+    and stays there, re-probing one step up every `explore_every` uploads. State is per worker process, so it only
+    learns in persistent worker mode.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 20,
+        initial: int = 4,
+        min_bytes: int = 64 * MiB,
+        smoothing: float = 0.3,
+        explore_every: int = 10,
+    ):
+        """Start with a low cap.
+
+        Args:
+            max_concurrency (int, optional): Highest cap the tuner will suggest. Defaults to 20.
+            initial (int, optional): Starting cap. Defaults to 4.
+            min_bytes (int, optional): Uploads smaller than this are ignored, they are dominated by latency.
+            Defaults to 64MiB.
+            smoothing (float, optional): Weight of the newest observation in the moving averages. Defaults to 0.3.
+            explore_every (int, optional): Uploads at a steady cap before probing one step up again. Defaults to 10.
+        """
+        self.max_concurrency = max_concurrency
+        self.min_bytes = min_bytes
+        self.smoothing = smoothing
+        self.explore_every = explore_every
+        self.cap = min(initial, max_concurrency)
+        self._ceiling = None
+        self._steady = 0
+        self._per_connection = {}
+        self._lock = threading.Lock()
+
+    def observe(self, nbytes: int, seconds: float, concurrency: int):
+        """Record a finished upload and move the cap.
+
+        Args:
+            nbytes (int): Bytes uploaded.
+            seconds (float): Wall clock seconds of the upload.
+            concurrency (int): Concurrency the upload used.
+        """
+        if nbytes < self.min_bytes or seconds <= 0 or concurrency < 1:
+            return
+        with self._lock:
+            throughput = nbytes / seconds / concurrency
+            previous = self._per_connection.get(concurrency)
+            if previous is not None:
+                throughput = previous + self.smoothing * (throughput - previous)
+            self._per_connection[concurrency] = throughput
+            lower = self._per_connection.get(concurrency - 1)
+            if lower is not None and throughput * concurrency < lower * (concurrency - 1) * 1.05:
+                self.cap = max(1, concurrency - 1)
+                self._ceiling = concurrency
+                self._steady = 0
+            elif concurrency >= self.cap and (self._ceiling is None or concurrency + 1 < self._ceiling):
+                self.cap = min(self.max_concurrency, concurrency + 1)
+            else:
+                self._steady += 1
+                if self._steady >= self.explore_every:
+                    self._ceiling = None
+                    self._steady = 0
+                    self.cap = min(self.max_concurrency, self.cap + 1)
+            logger.debug("Throughput tuner cap is %s after %.0f B/s per connection.", self.cap, throughput)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Triage summary of an ELF core dump.
+
+The notes of a core dump, the PT_NOTE segments the kernel writes right after the ELF header, say which process
+crashed, with which signal, in which thread and with which files mapped. They are a few KiB at the start of a dump
+that is often gigabytes. `summarize()` reads only the notes, from a memory map of the dump or from the first
+decompressed bytes of a gzip or zstd dump, so the summary can be uploaded before the dump itself.
+
+Print the summary of a dump with:
+    python triage.py <core file>
+"""
+
+import gzip
+import json
+import logging
+import mmap
+import os
+import signal
+import struct
+import sys
+import urllib.parse
+import compression
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+SUMMARY_SUFFIX = ".summary.json"
+# Notes further into a compressed dump than this are not worth decompressing for.
+MAX_COMPRESSED_OFFSET = 64 * 1024 * 1024
+MAX_MAPPED_FILES = 256
+
+ET_CORE = 4
+PT_NOTE = 4
+NT_PRSTATUS = 1
+NT_PRPSINFO = 3
+NT_AUXV = 6
+NT_SIGINFO = 0x53494749
+NT_FILE = 0x46494C45
+MACHINES = {3: "i386", 40: "arm", 62: "x86_64", 183: "aarch64"}
+# Offset of the program counter and stack pointer in `pr_reg` of NT_PRSTATUS, in registers.
+REGISTERS = {"x86_64": (16, 19), "aarch64": (32, 31)}
+AUXV = {3: "AT_PHDR", 6: "AT_PAGESZ", 7: "AT_BASE", 9: "AT_ENTRY", 11: "AT_UID", 12: "AT_EUID", 16: "AT_HWCAP"}
+# Offsets in NT_PRSTATUS and NT_PRPSINFO for 32 and 64 bit cores.
+LAYOUTS = {
+    32: {"prstatus_pid": 24, "prstatus_reg": 72, "prpsinfo_ids": "HHiiii", "prpsinfo_uid": 8, "prpsinfo_fname": 28},
+    64: {"prstatus_pid": 32, "prstatus_reg": 112, "prpsinfo_ids": "IIiiii", "prpsinfo_uid": 16, "prpsinfo_fname": 40},
+}
+
+
+class NotACore(Exception):
+    """The file is not an ELF core dump."""
+
+
+def _open(file_name: str) -> object:
+    """Open a dump for reading its start: a memory map for plain dumps, a decompressing stream otherwise."""
+    with open(file_name, "rb") as dump:
+        head = dump.read(4)
+        if head.startswith(b"\x1f\x8b"):
+            return gzip.open(file_name, "rb")
+        if head.startswith(b"\x28\xb5\x2f\xfd"):
+            if compression.zstandard is None:
+                raise NotACore(f"{file_name} is zstd compressed and zstandard is not installed.")
+            # pylint: disable=R1732
+            return compression.zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"), closefd=True)
+        if head != b"\x7fELF":
+            raise NotACore(f"{file_name} is not an ELF file.")
+        return mmap.mmap(dump.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _read(dump: object, offset: int, size: int, compressed: bool) -> bytes:
+    if compressed and offset + size > MAX_COMPRESSED_OFFSET:
+        raise NotACore(f"Notes at {offset} are too far into the compressed dump.")
+    dump.seek(offset)
+    data = dump.read(size)
+    if len(data) != size:
+        raise NotACore(f"Dump ends before {offset + size}.")
+    return data
+
+
+def notes(file_name: str) -> tuple:
+    """Read the notes of an ELF core dump.
+
+    Args:
+        file_name (str): Core dump, plain, gzip or zstd compressed.
+
+    Returns:
+        tuple: `(elf_class, byte_order, machine, notes)`, notes as `(type, name, desc)` tuples in file order.
+    """
+    dump = _open(file_name)
+    compressed = not isinstance(dump, mmap.mmap)
+    try:
+        ident = _read(dump, 0, 16, compressed)
+        elf_class = {1: 32, 2: 64}.get(ident[4])
+        byte_order = {1: "<", 2: ">"}.get(ident[5])
+        if elf_class is None or byte_order is None:
+            raise NotACore(f"{file_name} has an unknown ELF class or byte order.")
+        if elf_class == 64:
+            header = struct.unpack(f"{byte_order}HHIQQQIHHHHHH", _read(dump, 16, 48, compressed))
+        else:
+            header = struct.unpack(f"{byte_order}HHIIIIIHHHHHH", _read(dump, 16, 36, compressed))
+        e_type, e_machine, _, _, e_phoff, _, _, _, e_phentsize, e_phnum = header[:10]
+        if e_type != ET_CORE:
+            raise NotACore(f"{file_name} is an ELF file, but not a core dump.")
+        segments = []
+        table = _read(dump, e_phoff, e_phentsize * e_phnum, compressed)
+        for index in range(e_phnum):
+            entry = table[index * e_phentsize : (index + 1) * e_phentsize]
+            if elf_class == 64:
+                p_type, _, p_offset, _, _, p_filesz = struct.unpack(f"{byte_order}IIQQQQ", entry[:40])
+            else:
+                p_type, p_offset, _, _, p_filesz = struct.unpack(f"{byte_order}IIIII", entry[:20])
+            if p_type == PT_NOTE:
+                segments.append((p_offset, p_filesz))
+        found = []
+        # Compressed streams only seek forward cheaply.
+        for p_offset, p_filesz in sorted(segments):
+            found.extend(_parse_notes(_read(dump, p_offset, p_filesz, compressed), byte_order))
+    finally:
+        dump.close()
+    return elf_class, byte_order, MACHINES.get(e_machine, str(e_machine)), found
+
+
+def _parse_notes(segment: bytes, byte_order: str) -> list:
+    found = []
+    offset = 0
+    while offset + 12 <= len(segment):
+        namesz, descsz, note_type = struct.unpack_from(f"{byte_order}III", segment, offset)
+        offset += 12
+        name = segment[offset : offset + namesz].rstrip(b"\0").decode("ascii", "replace")
+        offset += (namesz + 3) & ~3
+        found.append((note_type, name, segment[offset : offset + descsz]))
+        offset += (descsz + 3) & ~3
+    return found
+
+
+def summarize(file_name: str) -> dict:
+    """Summarize the crash recorded in an ELF core dump.
+
+    Args:
+        file_name (str): Core dump, plain, gzip or zstd compressed.
+
+    Returns:
+        dict: JSON serializable summary.
+    """
+    elf_class, byte_order, machine, found = notes(file_name)
+    layout = LAYOUTS[elf_class]
+    word = "Q" if elf_class == 64 else "I"
+    word_size = elf_class // 8
+    summary = {
+        "version": 1,
+        "dump": os.path.basename(file_name),
+        "size": os.path.getsize(file_name),
+        "machine": machine,
+        "class": elf_class,
+        "threads": [],
+    }
+    mappings = []
+    for note_type, name, desc in found:
+        if name != "CORE":
+            continue
+        if note_type == NT_PRSTATUS:
+            cursig = struct.unpack_from(f"{byte_order}h", desc, 12)[0]
+            thread = {"tid": struct.unpack_from(f"{byte_order}i", desc, layout["prstatus_pid"])[0], "signal": cursig}
+            if machine in REGISTERS:
+                pc, sp = REGISTERS[machine]
+                thread["pc"] = hex(struct.unpack_from(f"{byte_order}Q", desc, layout["prstatus_reg"] + pc * 8)[0])
+                thread["sp"] = hex(struct.unpack_from(f"{byte_order}Q", desc, layout["prstatus_reg"] + sp * 8)[0])
+            summary["threads"].append(thread)
+        elif note_type == NT_PRPSINFO:
+            ids = struct.unpack_from(byte_order + layout["prpsinfo_ids"], desc, layout["prpsinfo_uid"])
+            uid, gid, pid, ppid = ids[:4]
+            fname = desc[layout["prpsinfo_fname"] : layout["prpsinfo_fname"] + 16]
+            psargs = desc[layout["prpsinfo_fname"] + 16 : layout["prpsinfo_fname"] + 96]
+            summary.update(
+                pid=pid,
+                ppid=ppid,
+                uid=uid,
+                gid=gid,
+                executable=fname.split(b"\0")[0].decode("utf-8", "replace"),
+                command_line=psargs.split(b"\0")[0].decode("utf-8", "replace").strip(),
+            )
+        elif note_type == NT_SIGINFO:
+            signo, errno, code = struct.unpack_from(f"{byte_order}iii", desc, 0)
+            summary.update(signal=signo, signal_code=code, signal_errno=errno)
+            # Only faults the kernel raised carry an address, si_code <= 0 means the signal was sent by a process.
+            if signo in (signal.SIGSEGV, signal.SIGBUS, signal.SIGFPE, signal.SIGILL) and code > 0:
+                # si_addr follows the three ints, aligned to a word.
+                address = struct.unpack_from(f"{byte_order}{word}", desc, 16 if elf_class == 64 else 12)[0]
+                summary["fault_address"] = hex(address)
+        elif note_type == NT_AUXV:
+            auxv = {}
+            for index in range(0, len(desc) - 2 * word_size + 1, 2 * word_size):
+                key, value = struct.unpack_from(f"{byte_order}{word}{word}", desc, index)
+                if key == 0:
+                    break
+                if key in AUXV:
+                    auxv[AUXV[key]] = value if key in (6, 11, 12) else hex(value)
+            summary["auxv"] = auxv
+        elif note_type == NT_FILE:
+            count, page_size = struct.unpack_from(f"{byte_order}{word}{word}", desc, 0)
+            names = desc[(2 + 3 * count) * word_size :].split(b"\0")[:count]
+            ranges = struct.unpack_from(f"{byte_order}{3 * count}{word}", desc, 2 * word_size)
+            for index, name in enumerate(names):
+                start, end, page_offset = ranges[3 * index : 3 * index + 3]
+                mappings.append((start, end, page_offset * page_size, name.decode("utf-8", "replace")))
+            mapped = list(dict.fromkeys(name.decode("utf-8", "replace") for name in names))
+            summary["mapped_files"] = mapped[:MAX_MAPPED_FILES]
+            summary["mapped_files_total"] = len(mapped)
+    if "signal" not in summary and summary["threads"]:
+        summary["signal"] = summary["threads"][0]["signal"]
+    if summary["threads"]:
+        # The kernel writes the thread that took the signal first.
+        summary["crashing_thread"] = summary["threads"][0]["tid"]
+        if "pc" in summary["threads"][0]:
+            # The program counter as file and offset is the same for every crash at that instruction, despite ASLR.
+            pc = int(summary["threads"][0]["pc"], 16)
+            for start, end, file_offset, name in mappings:
+                if start <= pc < end:
+                    summary["crash_location"] = {"file": name, "offset": hex(pc - start + file_offset)}
+                    break
+    if summary.get("signal"):
+        try:
+            summary["signal_name"] = signal.Signals(summary["signal"]).name
+        except ValueError:
+            pass
+    return summary
+
+
+def tags(summary: dict) -> str:
+    """S3 object tags of a summary, URL encoded for the `Tagging` argument of PutObject.
+
+    Args:
+        summary (dict): From `summarize()`.
+
+    Returns:
+        str: Tag set, e.g. `signal=SIGSEGV&executable=myapp`.
+    """
+    tag_set = {}
+    for key in ("signal_name", "executable", "pid", "machine"):
+        if summary.get(key) not in (None, ""):
+            # Tag values allow letters, numbers, spaces and + - = . _ : / @ only, and up to 256 characters.
+            value = "".join(c if c.isalnum() or c in " +-=._:/@" else "_" for c in str(summary[key]))
+            tag_set["signal" if key == "signal_name" else key] = value[:256]
+    return urllib.parse.urlencode(tag_set)
+
+
+if __name__ == "__main__":
+    print(json.dumps(summarize(sys.argv[1]), indent=2))
@@ -1,10 +1,28 @@
 #!/usr/bin/env python3
 
+import functools
+import json
 import logging
 import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import botocore
+import botocore.session
 import boto3
-from boto3.s3.transfer import TransferConfig
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
+import compression
+import dedup
+import dump_index
+import metrics
+import multipart_upload
+import sparse
+import throttle
+import transfer_tuning
+import triage
+import upload_journal
 
 
 logger = logging.getLogger(__name__)
@@ -15,37 +33,690 @@ stream_handler.setFormatter(formatter)
 logger.addHandler(stream_handler)
 logger.propagate = False
 
+# Per-process S3 client cache. Persistent pool workers build these once in `init_worker()` and reuse them for every
+# upload so credential resolution (IRSA STS calls) and TLS connections are not repeated per dump.
+_s3_session = None
+_s3_client = None
+_s3_client_created = 0.0
+_s3_client_lock = threading.Lock()
+# botocore data loader holding the parsed S3 service model, see `preload()`. Inherited by processes forked after it.
+_data_loader = None
+# In-flight byte budget shared with every other worker, handed over by `init_worker()`.
+_transfer_budget = None
+# Set by the parent on SIGTERM, handed over by `init_worker()`. Uploads checkpoint their journal and stop.
+_shutdown = None
+# Network and disk rates shared with every other worker, handed over by `init_worker()`.
+_throttle = None
+# Progress of every running upload, watched by the parent for stalls, handed over by `init_worker()`.
+_progress = None
+# Learns the best per-upload concurrency from recent uploads of this worker, see `transfer_tuning.ThroughputTuner`.
+_throughput_tuner = (
+    transfer_tuning.ThroughputTuner(max_concurrency=int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "20")))
+    if os.environ.get("ADAPTIVE_TUNING", "false").lower() == "true"
+    else None
+)
 
-def upload_file(file_name: str = "./", bucket: str = "my-bucket", object_name=None) -> bool:
-    """Upload a file to an S3 bucket.
+
+def init_worker(
+    budget: object = None,
+    warm: bool = True,
+    shutdown: object = None,
+    metrics_queue: object = None,
+    upload_throttle: object = None,
+    progress: object = None,
+) -> bool:
+    """Pool initializer for upload workers.
+
+    Stores the transfer budget, throttle, progress table and shutdown event shared by all workers, lowers the
+    worker's CPU and IO priority, points the worker's metrics at the parent and, for persistent workers, builds the
+    worker's boto3 session and S3 client up front so the first dump assigned to the worker does not pay for it.
+
+    Args:
+        budget (object, optional): `transfer_budget.TransferBudget` shared by all workers. Defaults to None.
+        warm (bool, optional): Build the S3 client now. Defaults to True.
+        shutdown (object, optional): `multiprocessing.Event` set when the handler is shutting down. Defaults to None.
+        metrics_queue (object, optional): Queue returned by `metrics.start()`. Defaults to None (no metrics).
+        upload_throttle (object, optional): `throttle.Throttle` shared by all workers. Defaults to None.
+        progress (object, optional): `stall_watchdog.ProgressTable` shared by all workers. Defaults to None.
+
+    Returns:
+        bool: True when completed.
+    """
+    configure(budget=budget, shutdown=shutdown, upload_throttle=upload_throttle, progress=progress)
+    metrics.init_worker(metrics_queue)
+    throttle.lower_priority()
+    # Workers are forked from the parent, undo its SIGTERM handler so `Pool.terminate()` still stops them.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if warm:
+        get_s3_client()
+    logger.debug("Worker %s initialized.", os.getpid())
+    return True
+
+
+def configure(
+    budget: object = None, shutdown: object = None, upload_throttle: object = None, progress: object = None
+):
+    """Set the state shared by every upload of this process.
+
+    Pool workers get it from `init_worker()`, the single process asyncio engine sets it directly.
+
+    Args:
+        budget (object, optional): `transfer_budget.TransferBudget` shared by all uploads. Defaults to None.
+        shutdown (object, optional): Event set when the handler is shutting down. Defaults to None.
+        upload_throttle (object, optional): `throttle.Throttle` shared by all uploads. Defaults to None.
+        progress (object, optional): `stall_watchdog.ProgressTable` shared by all uploads. Defaults to None.
+    """
+    global _transfer_budget, _shutdown, _throttle, _progress  # pylint: disable=W0603
+    _transfer_budget = budget
+    _shutdown = shutdown
+    _throttle = upload_throttle
+    _progress = progress
+
+
+def get_s3_client(max_age: int = int(os.environ.get("S3_CLIENT_MAX_AGE", "3600"))) -> object:
+    """Return the cached S3 client for this process, building a new one if needed.
+
+    The client is rebuilt when it is older than `max_age` seconds or when the session credentials have expired and
+    could not be refreshed in place.
+
+    Args:
+        max_age (int, optional): Max seconds to reuse a client. 0 disables age based rebuilds.
+        Defaults to os.environ.get("S3_CLIENT_MAX_AGE", "3600").
+
+    Returns:
+        object: boto3 S3 client.
+    """
+    global _s3_session, _s3_client, _s3_client_created  # pylint: disable=W0603
+    with _s3_client_lock:
+        expired = max_age and time.monotonic() - _s3_client_created > max_age
+        if _s3_client is None or expired or _credentials_expired(_s3_session):
+            logger.debug("Building S3 client for process %s.", os.getpid())
+            _s3_session = _new_session()
+            _s3_client = _new_client(_s3_session)
+            _s3_client_created = time.monotonic()
+        return _s3_client
+
+
+def new_s3_client() -> object:
+    """Build an S3 client that is not cached.
+
+    For the handler's parent, whose forked workers must not share the client of `get_s3_client()`.
+
+    Returns:
+        object: boto3 S3 client.
+    """
+    return _new_client(_new_session())
+
+
+def _new_session() -> object:
+    botocore_session = botocore.session.get_session()
+    if _data_loader is not None:
+        botocore_session.register_component("data_loader", _data_loader)
+    return boto3.session.Session(botocore_session=botocore_session)
+
+
+def _new_client(session: object) -> object:
+    return session.client(
+        "s3",
+        region_name=os.environ.get("REGION"),
+        config=Config(max_pool_connections=int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "20"))),
+    )
+
+
+def preload(region: str = os.environ.get("REGION")) -> object:
+    """Load and parse the S3 service model, endpoint rules and partitions ahead of the first upload.
+
+    Reading and parsing these JSON files is most of the cost of a process's first S3 client. Every client
+    `get_s3_client()` builds afterwards reuses them, in this process and in every process forked from it. The throwaway
+    client has placeholder credentials, so no credentials are resolved and STS is not called.
+
+    Args:
+        region (str, optional): Region of the throwaway client. Defaults to os.environ.get("REGION").
+
+    Returns:
+        object: botocore data loader.
+    """
+    global _data_loader  # pylint: disable=W0603
+    started = time.monotonic()
+    botocore_session = botocore.session.get_session()
+    botocore_session.create_client(
+        "s3",
+        region_name=region or "us-east-1",
+        aws_access_key_id="preload",
+        aws_secret_access_key="preload",
+    )
+    _data_loader = botocore_session.get_component("data_loader")
+    logger.debug("Preloaded the S3 service model in %.3f seconds.", time.monotonic() - started)
+    return _data_loader
+
+
+def _credentials_expired(session: object) -> bool:
+    """Check if the credentials of a boto3 session have expired.
+
+    Refreshable credentials (IRSA, instance profile) refresh themselves ahead of expiry, so this only reports True
+    once the expiry time has actually passed.
+
+    Args:
+        session (object): boto3 session.
+
+    Returns:
+        bool: True if the credentials are missing or expired.
+    """
+    credentials = session.get_credentials()
+    if credentials is None:
+        return True
+    refresh_needed = getattr(credentials, "refresh_needed", None)
+    return bool(refresh_needed and refresh_needed(refresh_in=0))
+
+
+def upload_file(
+    file_name: str = "./",
+    bucket: str = "my-bucket",
+    object_name=None,
+    multipart_threshold: int = None,
+    part_size: int = None,
+    max_concurrency: int = None,
+    verify_mode: str = os.environ.get("VERIFY_MODE", "checksum"),
+    checksum_algorithm: str = os.environ.get("CHECKSUM_ALGORITHM", "SHA256"),
+    journal: bool = os.environ.get("UPLOAD_JOURNAL", "true").lower() == "true",
+    sparse_upload: bool = os.environ.get("SPARSE_UPLOAD", "true").lower() == "true",
+    compress: str = os.environ.get("COMPRESSION", "off"),
+    compress_level: int = int(os.environ.get("COMPRESSION_LEVEL", "0")),
+    queued: int = 0,
+    triage_summary: bool = os.environ.get("TRIAGE", "true").lower() == "true",
+    index: bool = os.environ.get("DUMP_INDEX", "true").lower() == "true",
+    duplicate_of: str = None,
+    fingerprint: str = None,
+    progress_slot: int = None,
+    summarized: bool = False,
+) -> bool:
+    """Upload a file to an S3 bucket, verify it and delete it from disk.
+
+    The file is sent with S3 additional checksums computed while it is read. In "checksum" verify mode the upload is
+    verified against the checksum (or ETag) S3 returned for it and the file is deleted straight away. Uploads that
+    cannot be verified inline, and the "waiter" verify mode, poll S3 with `check_if_exists()` instead.
+
+    Multipart settings that are not passed in are picked by `transfer_tuning.plan_transfer()` from the file size and
+    the uploads running in the other workers, capped by the throughput tuner when `ADAPTIVE_TUNING` is enabled.
+
+    Multipart uploads are journaled next to the file, so an upload interrupted by a shutdown or a failure resumes from
+    the parts already in S3 the next time the file is uploaded.
+
+    Sparse files, e.g. uncompressed core dumps, are uploaded as `sparse.DATA_SUFFIX` objects with only their data
+    extents, followed by a `sparse.MAP_SUFFIX` extent map to restore them with `sparse.py`. Other files that are not
+    compressed yet are compressed on the fly with `compress`, if set, and uploaded with the codec's file extension.
+
+    The triage summary of an ELF core dump is uploaded first, as `<object_name>.summary.json`, and its signal and
+    executable tag both objects. If the parent uploaded the summary already when the dump landed, see
+    `EarlySummaries`, the dump is only tagged.
+
+    A dump the parent found to duplicate a recent upload is not uploaded, only `<object_name>.duplicate.json`
+    pointing to the original, see `dedup.py`.
+
+    The spilled tail of a streamed dump, see `compression.REST_SUFFIX`, is uploaded as it is: it is neither sparse,
+    compressed nor triaged, so it still continues the object uploaded by `pipe_ingest.py`.
 
     Args:
         file_name (str, optional): File to upload. Defaults to "./".
         bucket (str, optional): Bucket to upload to. Defaults to "my-bucket".
-        object_name (optional): S3 object name. If not specified then file_name is used. Defaults to None.
+        object_name (optional): S3 object name. If not specified it is derived from file_name with
+        `dump_index.object_key()`. Defaults to None.
+        multipart_threshold (int, optional): Files of this size or larger use a multipart upload. Defaults to None.
+        part_size (int, optional): Bytes per part of a multipart upload. Defaults to None.
+        max_concurrency (int, optional): Parts uploaded at once. Defaults to None.
+        verify_mode (str, optional): "checksum" or "waiter". Defaults to os.environ.get("VERIFY_MODE", "checksum").
+        checksum_algorithm (str, optional): "SHA256", "SHA1" or "CRC32".
+        Defaults to os.environ.get("CHECKSUM_ALGORITHM", "SHA256").
+        journal (bool, optional): Journal multipart uploads to resume them.
+        Defaults to os.environ.get("UPLOAD_JOURNAL", "true").
+        sparse_upload (bool, optional): Skip the holes of sparse files.
+        Defaults to os.environ.get("SPARSE_UPLOAD", "true").
+        compress (str, optional): "off", "gzip" or "zstd". Defaults to os.environ.get("COMPRESSION", "off").
+        compress_level (int, optional): Compression level, 0 picks one from the CPU load and `queued`.
+        Defaults to os.environ.get("COMPRESSION_LEVEL", "0").
+        queued (int, optional): Dumps waiting for a worker. Defaults to 0.
+        triage_summary (bool, optional): Upload a triage summary ahead of core dumps.
+        Defaults to os.environ.get("TRIAGE", "true").
+        index (bool, optional): Add the upload to the dump index of the file's directory.
+        Defaults to os.environ.get("DUMP_INDEX", "true").
+        duplicate_of (str, optional): S3 URI of the upload this dump duplicates. Defaults to None.
+        fingerprint (str, optional): `dedup.fingerprint()` of the dump, for the index. Defaults to None.
+        progress_slot (int, optional): Slot of the upload in the progress table. The parent cancels the upload
+        through it once it stalls, the upload then stops like on shutdown. Defaults to None (not watched).
+        summarized (bool, optional): The triage summary is uploaded already, see `EarlySummaries.claim()`.
+        Defaults to False.
 
     Returns:
         bool: True if file was uploaded.
     """
-    # If S3 object_name was not specified, use file_name
+    # If S3 object_name was not specified, derive it from file_name
     if object_name is None:
-        object_name = os.path.basename(file_name)
-    # Set the desired multipart threshold value (1GB)
-    config = TransferConfig(multipart_threshold=104857600, max_concurrency=20)
+        object_name = dump_index.object_key(file_name)
+    extra_args = {"StorageClass": "STANDARD_IA"}
+    budget = _transfer_budget
+    metrics.inc("workers_busy")
+    begun = time.monotonic()
+    watched = _progress is not None and progress_slot is not None
+    stop = _progress.stop_event(progress_slot, _shutdown) if watched else _shutdown
+    if watched:
+        # The stall clock runs from here, the time the dump waited for a free worker is no stall.
+        _progress.start(progress_slot)
     # Perform the transfer
     try:
+        if stop is not None and stop.is_set():
+            raise multipart_upload.UploadInterrupted(f"Not uploading {file_name}, shutting down or cancelled.")
         logger.info(f"Uploading {file_name} to s3://{bucket}.")
-        s3 = boto3.client("s3", region_name=os.environ.get("REGION"))
-        s3.upload_file(file_name, bucket, object_name, ExtraArgs={"StorageClass": "STANDARD_IA"}, Config=config)
+        s3 = get_s3_client()
+        if duplicate_of is not None:
+            return _upload_duplicate(
+                s3, file_name, bucket, object_name, duplicate_of, fingerprint, checksum_algorithm, index
+            )
+        file_size = os.path.getsize(file_name)
+        summary_name = f"{object_name}{triage.SUMMARY_SUFFIX}"
+        rest = compression.is_rest(file_name)
+        extents = sparse.data_extents(file_name) if sparse_upload and not rest else None
+        if extents is not None:
+            logger.info(f"{file_name} is sparse, uploading {sparse.packed_size(extents)} of {file_size} bytes.")
+            map_name = f"{object_name}{sparse.MAP_SUFFIX}"
+            object_name = f"{object_name}{sparse.DATA_SUFFIX}"
+            upload_size = sparse.packed_size(extents)
+        else:
+            upload_size = file_size
+        codec = compression.codec(compress) if extents is None and not rest else None
+        if codec is not None and compression.is_compressed(file_name):
+            logger.debug(f"{file_name} is compressed already.")
+            codec = None
+        level = None
+        if codec is not None:
+            level = compress_level or compression.pick_level(codec, queued=queued)
+            logger.info(f"Compressing {file_name} with {codec} level {level}.")
+            object_name = f"{object_name}{compression.EXTENSIONS[codec]}"
+        if triage_summary and not rest:
+            if summarized:
+                summary = _summarize(file_name)
+                tagging = triage.tags(summary) if summary is not None else None
+            else:
+                tagging = _upload_summary(s3, file_name, bucket, summary_name, object_name, checksum_algorithm)
+            if tagging:
+                extra_args["Tagging"] = tagging
+        if budget is not None:
+            budget.upload_started()
+        try:
+            plan = transfer_tuning.plan_transfer(
+                upload_size,
+                active_uploads=budget.active_uploads if budget is not None else 1,
+                max_connections=int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "20")),
+                budget_bytes=budget.max_bytes if budget is not None else 0,
+                max_concurrency=_throughput_tuner.cap if _throughput_tuner is not None else None,
+            )
+            multipart_threshold = multipart_threshold or plan["multipart_threshold"]
+            part_size = part_size or plan["part_size"]
+            max_concurrency = max_concurrency or plan["max_concurrency"]
+            started = time.monotonic()
+            multipart = False
+            if upload_size < multipart_threshold and extents is None and codec is None:
+                if _throttle is not None:
+                    _throttle.disk.take(upload_size, stop)
+                    _throttle.network.take(upload_size, stop)
+                result = multipart_upload.put_object(
+                    s3, file_name, bucket, object_name, checksum_algorithm=checksum_algorithm, extra_args=extra_args
+                )
+            else:
+                with _open_source(file_name, extents, codec, level, stop) as source:
+                    if upload_size < multipart_threshold:
+                        data = source.read()
+                        if _throttle is not None:
+                            _throttle.network.take(len(data), stop)
+                        result = multipart_upload.put_bytes(
+                            s3,
+                            data,
+                            bucket,
+                            object_name,
+                            checksum_algorithm=checksum_algorithm,
+                            extra_args=extra_args,
+                        )
+                    else:
+                        result = multipart_upload.upload_parts(
+                            s3,
+                            source,
+                            bucket,
+                            object_name,
+                            part_size=part_size,
+                            max_concurrency=max_concurrency,
+                            checksum_algorithm=checksum_algorithm,
+                            extra_args=extra_args,
+                            budget=budget,
+                            # Compressed output is not seekable, so compressed uploads start over instead.
+                            journal=upload_journal.UploadJournal(file_name) if journal and codec is None else None,
+                            stop=stop,
+                            throttle=_throttle,
+                            progress=functools.partial(_progress.advance, progress_slot) if watched else None,
+                        )
+                        multipart = True
+                    if codec is not None:
+                        upload_size = source.tell()
+            if watched and not multipart:
+                _progress.advance(progress_slot, upload_size)
+            if multipart and _throughput_tuner is not None:
+                _throughput_tuner.observe(upload_size, time.monotonic() - started, max_concurrency)
+            upload_seconds = time.monotonic() - started
+            metrics.observe("stage_seconds", upload_seconds, stage="upload")
+            metrics.inc("uploaded_bytes_total", upload_size)
+            if upload_seconds > 0:
+                metrics.observe("upload_throughput_bytes_per_second", upload_size / upload_seconds)
+        except botocore.exceptions.ClientError as e:
+            raise S3UploadFailedError(f"Failed to upload {file_name} to {bucket}/{object_name}: {e}") from e
+        finally:
+            if budget is not None:
+                budget.upload_finished()
         logger.info(f"{object_name} upload done.")
-        check_if_exists(bucket=bucket, object_name=object_name)
+        started = time.monotonic()
+        if verify_mode == "waiter" or not multipart_upload.verify_upload(result):
+            logger.debug(f"Verifying {object_name} with the object_exists waiter.")
+            check_if_exists(bucket=bucket, object_name=object_name)
+        if extents is not None:
+            # The extent map goes last, a map in S3 means the data it points to is complete.
+            map_result = multipart_upload.put_bytes(
+                s3,
+                sparse.extent_map(file_size, extents, object_name),
+                bucket,
+                map_name,
+                checksum_algorithm=checksum_algorithm,
+                extra_args=extra_args,
+            )
+            if verify_mode == "waiter" or not multipart_upload.verify_upload(map_result):
+                check_if_exists(bucket=bucket, object_name=map_name)
+            object_name = map_name
+        metrics.observe("stage_seconds", time.monotonic() - started, stage="verify")
+        if index:
+            try:
+                dump_index.record(
+                    file_name,
+                    bucket,
+                    object_name,
+                    result,
+                    size=file_size,
+                    uploaded_bytes=upload_size,
+                    upload_seconds=round(upload_seconds, 3),
+                    seconds=round(time.monotonic() - begun, 3),
+                    fingerprint=fingerprint,
+                )
+            except OSError as e:
+                logger.warning(f"Could not add {file_name} to the dump index: {e}")
+        started = time.monotonic()
         os.remove(file_name)
+        metrics.observe("stage_seconds", time.monotonic() - started, stage="delete")
         logger.info(f"Deleted {file_name} from the filesystem.")
     except Exception as e:
+        metrics.inc("uploads_total", result="failure")
         logging.exception(e)
         raise
     else:
+        metrics.inc("uploads_total", result="success")
         return f"s3://{bucket}/{object_name}"
+    finally:
+        metrics.dec("workers_busy")
+
+
+def _upload_summary(
+    s3: object, file_name: str, bucket: str, summary_name: str, object_name: str, checksum_algorithm: str
+) -> str:
+    """Upload the triage summary of a core dump ahead of the dump itself.
+
+    A summary that cannot be made or uploaded never stops the dump from being uploaded.
+
+    Args:
+        s3 (object): boto3 S3 client.
+        file_name (str): Core dump.
+        bucket (str): Bucket to upload to.
+        summary_name (str): S3 object name of the summary.
+        object_name (str): S3 object name the dump is uploaded as.
+        checksum_algorithm (str): One of `multipart_upload.CHECKSUM_ALGORITHMS`.
+
+    Returns:
+        str: S3 object tags for the dump, None if there is no summary or it could not be uploaded.
+    """
+    started = time.monotonic()
+    summary = _summarize(file_name)
+    if summary is None:
+        return None
+    summary["object"] = object_name
+    tagging = triage.tags(summary)
+    try:
+        multipart_upload.put_bytes(
+            s3,
+            json.dumps(summary).encode("utf-8"),
+            bucket,
+            summary_name,
+            checksum_algorithm=checksum_algorithm,
+            extra_args={"ContentType": "application/json", "Tagging": tagging},
+        )
+    except botocore.exceptions.ClientError as e:
+        logger.warning(f"Could not upload the summary of {file_name}: {e}")
+        return None
+    logger.info(f"{summary_name} upload done, {summary.get('executable')} {summary.get('signal_name')}.")
+    metrics.observe("stage_seconds", time.monotonic() - started, stage="triage")
+    return tagging
+
+
+def _summarize(file_name: str) -> dict:
+    """Triage summary of a dump, None if it is not an ELF core dump or cannot be read."""
+    try:
+        return triage.summarize(file_name)
+    except triage.NotACore as e:
+        logger.debug(e)
+    except Exception as e:  # pylint: disable=W0718
+        logger.warning(f"Could not summarize {file_name}: {e!r}")
+    return None
+
+
+def upload_summary(
+    file_name: str,
+    bucket: str = os.environ.get("BUCKET_NAME"),
+    s3: object = None,
+    sparse_upload: bool = os.environ.get("SPARSE_UPLOAD", "true").lower() == "true",
+    compress: str = os.environ.get("COMPRESSION", "off"),
+    checksum_algorithm: str = os.environ.get("CHECKSUM_ALGORITHM", "SHA256"),
+) -> str:
+    """Upload the triage summary of a dump on its own, pointing to the object `upload_file()` will upload it as.
+
+    Args:
+        file_name (str): Core dump.
+        bucket (str, optional): Bucket to upload to. Defaults to os.environ.get("BUCKET_NAME").
+        s3 (object, optional): boto3 S3 client. Defaults to None, `get_s3_client()`.
+        sparse_upload (bool, optional): As for `upload_file()`. Defaults to os.environ.get("SPARSE_UPLOAD", "true").
+        compress (str, optional): As for `upload_file()`. Defaults to os.environ.get("COMPRESSION", "off").
+        checksum_algorithm (str, optional): One of `multipart_upload.CHECKSUM_ALGORITHMS`.
+        Defaults to os.environ.get("CHECKSUM_ALGORITHM", "SHA256").
+
+    Returns:
+        str: S3 object tags for the dump, None if there is no summary or it could not be uploaded.
+    """
+    object_name = dump_index.object_key(file_name)
+    summary_name = f"{object_name}{triage.SUMMARY_SUFFIX}"
+    # The object name `upload_file()` picks for the dump.
+    codec = compression.codec(compress)
+    if sparse_upload and sparse.data_extents(file_name) is not None:
+        object_name = f"{object_name}{sparse.DATA_SUFFIX}"
+    elif codec is not None and not compression.is_compressed(file_name):
+        object_name = f"{object_name}{compression.EXTENSIONS[codec]}"
+    return _upload_summary(s3 or get_s3_client(), file_name, bucket, summary_name, object_name, checksum_algorithm)
+
+
+class EarlySummaries:
+    """Upload the triage summaries of dumps from the handler's parent, as soon as inotify reports them.
+
+    A few threads of its own make and upload the summaries, so a dump still waiting for a worker, or one that is never
+    uploaded in full, has its summary in S3 within milliseconds of landing. The parent uses a client of its own, see
+    `new_s3_client()`.
+    """
+
+    def __init__(
+        self,
+        bucket: str = os.environ.get("BUCKET_NAME"),
+        threads: int = int(os.environ.get("TRIAGE_THREADS", "2")),
+    ):
+        """Create the threads, nothing is uploaded until `submit()`.
+
+        Args:
+            bucket (str, optional): Bucket to upload to. Defaults to os.environ.get("BUCKET_NAME").
+            threads (int, optional): Summaries made and uploaded at once.
+            Defaults to os.environ.get("TRIAGE_THREADS", "2").
+        """
+        self.bucket = bucket
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="triage")
+        self._s3 = None
+        self._s3_lock = threading.Lock()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, file_name: str):
+        """Start uploading the summary of a dump that has just landed.
+
+        Args:
+            file_name (str): Core dump, with directory.
+        """
+        if compression.is_rest(file_name):
+            return
+        with self._lock:
+            # Forget the finished summaries of dumps that left without being claimed, e.g. dropped or evicted ones.
+            self._pending = {
+                name: future for name, future in self._pending.items() if not future.done() or os.path.exists(name)
+            }
+            self._pending[file_name] = self._executor.submit(self._upload, file_name)
+
+    def claim(self, file_name: str) -> bool:
+        """Take over the summary of a dump about to be uploaded, for `upload_file(summarized=...)`.
+
+        Only a summary that is up already is taken over. One that has not started yet is cancelled, and one that is
+        still running or failed is left to the upload, which makes its own.
+
+        Args:
+            file_name (str): Core dump, with directory.
+
+        Returns:
+            bool: True if the summary is up, False if the upload has to make it.
+        """
+        with self._lock:
+            future = self._pending.pop(file_name, None)
+        if future is None or future.cancel() or not future.done():
+            return False
+        return future.result()
+
+    def discard(self, file_name: str, fallback: object = None):
+        """Delete a dump that is not uploaded itself, e.g. one sampled out, once its summary is up.
+
+        A dump without a summary in S3, because it is no core dump or the upload failed, is handed to `fallback`
+        instead. A dump whose summary was cancelled by `close()` stays on disk.
+
+        Args:
+            file_name (str): Core dump, with directory.
+            fallback (object, optional): Called with `file_name` if no summary reached S3, e.g. to upload the dump in
+            full. Defaults to None, the dump stays on disk.
+        """
+        with self._lock:
+            future = self._pending.pop(file_name, None)
+
+        def done(future):
+            if future is not None and future.cancelled():
+                return
+            if future is not None and future.result():
+                _remove_summarized(file_name)
+            elif fallback is not None:
+                fallback(file_name)
+            else:
+                logger.warning(f"Keeping {file_name}, its summary did not reach S3.")
+
+        if future is None:
+            done(None)
+        else:
+            future.add_done_callback(done)
+
+    def close(self):
+        """Wait for the summaries being uploaded, the ones not started yet are left to the uploads."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _upload(self, file_name: str) -> bool:
+        try:
+            with self._s3_lock:
+                if self._s3 is None:
+                    self._s3 = new_s3_client()
+            return upload_summary(file_name, self.bucket, s3=self._s3) is not None
+        except Exception as e:  # pylint: disable=W0718
+            logger.warning(f"Could not upload the summary of {file_name} early: {e!r}")
+            return False
+
+
+def _remove_summarized(file_name: str):
+    try:
+        os.remove(file_name)
+    except OSError as e:
+        logger.warning(f"Could not delete {file_name}: {e}")
+    else:
+        logger.info(f"Deleted {file_name}, only its summary is uploaded.")
+
+
+def _upload_duplicate(
+    s3: object,
+    file_name: str,
+    bucket: str,
+    object_name: str,
+    original: str,
+    key: str,
+    checksum_algorithm: str,
+    index: bool,
+) -> str:
+    """Upload the metadata of a duplicate dump instead of the dump, then delete the dump.
+
+    Returns:
+        str: S3 URI of the metadata.
+    """
+    started = time.monotonic()
+    file_size = os.path.getsize(file_name)
+    duplicate_name = f"{object_name}{dedup.DUPLICATE_SUFFIX}"
+    result = multipart_upload.put_bytes(
+        s3,
+        dedup.duplicate_record(file_name, original, key),
+        bucket,
+        duplicate_name,
+        checksum_algorithm=checksum_algorithm,
+        extra_args={"ContentType": "application/json"},
+    )
+    if not multipart_upload.verify_upload(result):
+        check_if_exists(bucket=bucket, object_name=duplicate_name)
+    logger.info(f"{file_name} duplicates {original}, uploaded {duplicate_name} instead.")
+    if index:
+        try:
+            dump_index.record(
+                file_name, bucket, duplicate_name, result, size=file_size, duplicate_of=original, fingerprint=key
+            )
+        except OSError as e:
+            logger.warning(f"Could not add {file_name} to the dump index: {e}")
+    os.remove(file_name)
+    metrics.observe("stage_seconds", time.monotonic() - started, stage="dedup")
+    metrics.inc("uploads_total", result="duplicate")
+    metrics.inc("deduplicated_bytes_total", file_size)
+    return f"s3://{bucket}/{duplicate_name}"
+
+
+def _open_source(file_name: str, extents: list, codec: str, level: int, stop: object = None) -> object:
+    """Open the stream to upload: the file, its data extents or its compressed contents, paced by the disk rate.
+
+    Waits for the disk rate are cut short by `stop`, the upload's own stop event.
+    """
+    if extents is not None:
+        return _throttled(sparse.ExtentReader(file_name, extents), stop)
+    if codec is not None:
+        # Pace the dump read from disk, not the compressed stream, which `upload_parts()` paces as network bytes.
+        source = _throttled(open(file_name, "rb"), stop)  # pylint: disable=R1732
+        return compression.CompressedReader(source, codec, level, budget=_transfer_budget)
+    return _throttled(open(file_name, "rb"), stop)  # pylint: disable=R1732
+
+
+def _throttled(source: object, stop: object = None) -> object:
+    if _throttle is None or not _throttle.disk.rate:
+        return source
+    return throttle.ThrottledReader(source, _throttle.disk, stop)
 
 
 def check_if_exists(
@@ -63,7 +734,7 @@ def check_if_exists(
         bool: True on success.
     """
     try:
-        s3 = boto3.client("s3", region_name=os.environ.get("REGION"))
+        s3 = get_s3_client()
         waiter = s3.get_waiter("object_exists")
         waiter.wait(Bucket=bucket, Key=object_name, WaiterConfig={"Delay": delay, "MaxAttempts": max_attempts})
     except botocore.exceptions.WaiterError as waiter_exception:
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+On-disk journal of multipart uploads, so an upload cut off by a pod restart resumes instead of starting over.
+
+Each multipart upload writes `<watched directory>/.upload_journal/<dump>.json` with its upload ID, part size and the
+ETag and checksums of every part that made it to S3. The journal is rewritten atomically after every part and removed
+once the upload is completed. A restarted handler finds the journals left behind, lists the parts S3 still has, and
+only uploads the missing ones.
+"""
+
+import base64
+import json
+import logging
+import os
+import threading
+import boto3
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+# Does not start with `core`, so the watcher never picks journals up as dumps.
+JOURNAL_DIR = ".upload_journal"
+
+
+class UploadJournal:
+    """Journal of one multipart upload of one dump."""
+
+    def __init__(self, file_name: str, journal_dir: str = None):
+        """Point the journal at a dump. Nothing is read or written yet.
+
+        Args:
+            file_name (str): Dump file name with path.
+            journal_dir (str, optional): Directory of the journal files. Defaults to `JOURNAL_DIR` next to the dump.
+        """
+        self.file_name = file_name
+        journal_dir = journal_dir or os.path.join(os.path.dirname(file_name) or ".", JOURNAL_DIR)
+        self.path = os.path.join(journal_dir, f"{os.path.basename(file_name)}.json")
+        self.state = None
+        self._lock = threading.Lock()
+
+    def load(self, bucket: str, object_name: str, checksum_algorithm: str) -> dict:
+        """Read the journal left behind by an earlier attempt at the same upload.
+
+        The journal is only used if it is for the same bucket, object and checksum algorithm, and the dump has not
+        changed since, otherwise it is discarded.
+
+        Args:
+            bucket (str): Bucket to upload to.
+            object_name (str): S3 object name.
+            checksum_algorithm (str): Checksum algorithm of the upload.
+
+        Returns:
+            dict: Journal state, None if there is nothing to resume.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as journal:
+                state = json.load(journal)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable upload journal %s: %s", self.path, e)
+            return None
+        stat = os.stat(self.file_name)
+        expected = {
+            "Bucket": bucket,
+            "Key": object_name,
+            "ChecksumAlgorithm": checksum_algorithm,
+            "Size": stat.st_size,
+            "MTime": stat.st_mtime_ns,
+        }
+        if any(state.get(key) != value for key, value in expected.items()):
+            logger.warning("Upload journal %s does not match %s, starting over.", self.path, self.file_name)
+            return None
+        self.state = state
+        return state
+
+    def start(self, bucket: str, object_name: str, upload_id: str, part_size: int, checksum_algorithm: str):
+        """Journal a new multipart upload.
+
+        Args:
+            bucket (str): Bucket to upload to.
+            object_name (str): S3 object name.
+            upload_id (str): Multipart upload ID.
+            part_size (int): Bytes per part.
+            checksum_algorithm (str): Checksum algorithm of the upload.
+        """
+        stat = os.stat(self.file_name)
+        with self._lock:
+            self.state = {
+                "Bucket": bucket,
+                "Key": object_name,
+                "UploadId": upload_id,
+                "PartSize": part_size,
+                "ChecksumAlgorithm": checksum_algorithm,
+                "Size": stat.st_size,
+                "MTime": stat.st_mtime_ns,
+                "Parts": {},
+            }
+            self._write()
+
+    def record_parts(self, parts: list):
+        """Journal parts that made it to S3.
+
+        Args:
+            parts (list): Results of `multipart_upload.upload_part()`.
+        """
+        if not parts:
+            return
+        with self._lock:
+            for part in parts:
+                self.state["Parts"][str(part["PartNumber"])] = {
+                    "ETag": part["ETag"],
+                    "Checksum": base64.b64encode(part["Checksum"]).decode("ascii"),
+                    "MD5": part["MD5"].hex(),
+                }
+            self._write()
+
+    def keep_parts(self, part_numbers: set):
+        """Forget journaled parts that are not in `part_numbers`, e.g. because S3 no longer has them.
+
+        Args:
+            part_numbers (set): Part numbers to keep.
+        """
+        with self._lock:
+            self.state["Parts"] = {
+                number: part for number, part in self.state["Parts"].items() if int(number) in part_numbers
+            }
+            self._write()
+
+    def parts(self) -> list:
+        """Journaled parts in the format of `multipart_upload.upload_part()` results.
+
+        Returns:
+            list: Part results.
+        """
+        return [
+            {
+                "PartNumber": int(number),
+                "ETag": part["ETag"],
+                "Checksum": base64.b64decode(part["Checksum"]),
+                "MD5": bytes.fromhex(part["MD5"]),
+            }
+            for number, part in self.state["Parts"].items()
+        ]
+
+    def remove(self):
+        """Delete the journal once the upload is completed or given up on."""
+        self.state = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _write(self):
+        """Replace the journal file atomically, so a crash mid-write leaves the previous version. Lock held."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as journal:
+            json.dump(self.state, journal)
+        os.replace(temporary, self.path)
+
+
+def pending(path_to_directory: str) -> list:
+    """Find the dumps whose upload was cut off, and clean up journals whose dump is gone.
+
+    The multipart upload of a journal without a dump is aborted, so its parts do not linger in the bucket.
+
+    Args:
+        path_to_directory (str): Watched directory.
+
+    Returns:
+        list: Dump file names, without directory, to upload again.
+    """
+    journal_dir = os.path.join(path_to_directory, JOURNAL_DIR)
+    try:
+        journal_files = sorted(os.listdir(journal_dir))
+    except FileNotFoundError:
+        return []
+    resumable = []
+    for journal_file in journal_files:
+        if not journal_file.endswith(".json"):
+            continue
+        file_name = journal_file[: -len(".json")]
+        if os.path.exists(os.path.join(path_to_directory, file_name)):
+            resumable.append(file_name)
+            continue
+        journal = UploadJournal(os.path.join(path_to_directory, file_name), journal_dir=journal_dir)
+        try:
+            with open(journal.path, "r", encoding="utf-8") as journal_fd:
+                state = json.load(journal_fd)
+            # Throwaway client, the parent must not cache a client its forked workers would inherit.
+            boto3.client("s3", region_name=os.environ.get("REGION")).abort_multipart_upload(
+                Bucket=state["Bucket"], Key=state["Key"], UploadId=state["UploadId"]
+            )
+        except Exception as e:  # pylint: disable=W0718
+            logger.warning("Could not abort the upload of vanished dump %s: %s", file_name, e)
+        journal.remove()
+    if resumable:
+        logger.info("Resuming %s interrupted uploads.", len(resumable))
+    return resumable
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Upload worker pool with a recycle policy based on bytes uploaded or age instead of tasks per child.
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get("LOGLEVEL", "INFO").upper())
+formatter = logging.Formatter("%(levelname)s:%(name)s:%(message)s")
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+logger.propagate = False
+
+
+class UploadPool:
+    """Wrapper around `multiprocessing.Pool` that recycles its workers by bytes dispatched or by age.
+
+    `multiprocessing.Pool` can only recycle a worker after a number of tasks. Long lived workers keep their boto3
+    session warm, but should still be replaced now and then to hand memory back to the operating system. Once the
+    current generation of workers has been given `recycle_bytes` bytes of dumps, or is older than `recycle_seconds`,
+    it is closed and a fresh generation is spawned. The retired generation finishes its queued uploads in the
+    background and is reaped once all of its results are ready.
+    """
+
+    def __init__(
+        self,
+        processes: int = 4,
+        maxtasksperchild: int = None,
+        initializer: object = None,
+        initargs: tuple = (),
+        recycle_bytes: int = 0,
+        recycle_seconds: int = 0,
+        context: object = None,
+    ):
+        """Spawn the first generation of workers.
+
+        Args:
+            processes (int, optional): Max number of processes. Defaults to 4.
+            maxtasksperchild (int, optional): Maximum amount of tasks per worker. Defaults to None (no limit).
+            initializer (object, optional): Callable run once in each new worker. Defaults to None.
+            initargs (tuple, optional): Arguments for `initializer`. Defaults to ().
+            recycle_bytes (int, optional): Bytes dispatched before the workers are replaced. 0 disables.
+            Defaults to 0.
+            recycle_seconds (int, optional): Seconds before the workers are replaced. 0 disables. Defaults to 0.
+            context (object, optional): Multiprocessing context. Defaults to None (the default context).
+        """
+        self.processes = processes
+        self.maxtasksperchild = maxtasksperchild
+        self.initializer = initializer
+        self.initargs = initargs
+        self.recycle_bytes = recycle_bytes
+        self.recycle_seconds = recycle_seconds
+        self.context = context or multiprocessing.get_context()
+        self.generation = 0
+        self._retired = []
+        self._spawn()
+
+    def _spawn(self):
+        """Spawn a new generation of workers and reset the recycle counters."""
+        self._pool = self.context.Pool(  # pylint: disable=R1732
+            processes=self.processes,
+            initializer=self.initializer,
+            initargs=self.initargs,
+            maxtasksperchild=self.maxtasksperchild,
+        )
+        self._results = []
+        self._bytes_dispatched = 0
+        self._started = time.monotonic()
+        self.generation += 1
+        logger.debug("Spawned worker generation %s.", self.generation)
+
+    def needs_recycle(self) -> bool:
+        """Check the current generation against the recycle policy.
+
+        Returns:
+            bool: True if the current generation should be replaced.
+        """
+        if self.recycle_bytes and self._bytes_dispatched >= self.recycle_bytes:
+            return True
+        if self.recycle_seconds and time.monotonic() - self._started >= self.recycle_seconds:
+            return True
+        return False
+
+    def recycle(self):
+        """Retire the current generation of workers and spawn a new one."""
+        logger.info(
+            "Recycling worker generation %s after %s bytes and %.0f seconds.",
+            self.generation,
+            self._bytes_dispatched,
+            time.monotonic() - self._started,
+        )
+        self._pool.close()
+        self._retired.append((self._pool, self._results))
+        self._spawn()
+
+    def _reap(self):
+        """Join retired generations whose uploads have all finished."""
+        for pool, results in list(self._retired):
+            if all(result.ready() for result in results):
+                pool.join()
+                self._retired.remove((pool, results))
+        self._results = [result for result in self._results if not result.ready()]
+
+    def apply_async(self, func, args=(), kwds=None, callback=None, error_callback=None, size: int = 0) -> object:
+        """Queue a task on the current generation of workers.
+
+        Args:
+            func (object): Function to run in a worker.
+            args (tuple, optional): Positional arguments for `func`. Defaults to ().
+            kwds (dict, optional): Keyword arguments for `func`. Defaults to None.
+            callback (object, optional): Called with the result on success. Defaults to None.
+            error_callback (object, optional): Called with the exception on failure. Defaults to None.
+            size (int, optional): Bytes the task will upload, counted towards `recycle_bytes`. Defaults to 0.
+
+        Returns:
+            object: `multiprocessing.pool.AsyncResult` of the task.
+        """
+        self._reap()
+        if self.needs_recycle():
+            self.recycle()
+        result = self._pool.apply_async(
+            func, args=args, kwds=kwds or {}, callback=callback, error_callback=error_callback
+        )
+        self._results.append(result)
+        self._bytes_dispatched += size
+        return result
+
+    def close(self):
+        """Stop accepting tasks. Queued uploads in every generation still complete."""
+        self._pool.close()
+
+    def join(self):
+        """Wait for every generation of workers to exit. `close()` must be called first."""
+        self._pool.join()
+        for pool, _ in self._retired:
+            pool.join()
+        self._retired = []
+
+    def terminate(self):
+        """Stop every generation of workers immediately."""
+        self._pool.terminate()
+        for pool, _ in self._retired:
+            pool.terminate()
+        self._retired = []
@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+"""
+Preload module of the forkserver, see `main.worker_context()`.
+
+The forkserver imports it once, before it forks any upload worker, so every worker starts with boto3 imported and the
+S3 service model parsed instead of paying for both before its first upload.
+"""
+
+import upload_file_2_s3
+
+upload_file_2_s3.preload()
@@ -0,0 +1,42 @@
+"""Fixtures shared by the test modules."""
+
+import struct
+
+
+def note(note_type: int, desc: bytes) -> bytes:
+    return struct.pack("<III", 5, len(desc), note_type) + b"CORE\0\0\0\0" + desc + b"\0" * (-len(desc) % 4)
+
+
+def build_core(file_name: str, signo: int = 11, code: int = 1, base: int = 0x400000):
+    """Write a minimal x86_64 ELF core dump with the notes the kernel writes."""
+    prstatus = bytearray(336)
+    struct.pack_into("<h", prstatus, 12, signo)
+    struct.pack_into("<i", prstatus, 32, 4243)
+    struct.pack_into("<Q", prstatus, 112 + 16 * 8, base + 0x1136)
+    struct.pack_into("<Q", prstatus, 112 + 19 * 8, 0x7FFD0000)
+    second = bytearray(336)
+    struct.pack_into("<i", second, 32, 4244)
+    prpsinfo = bytearray(136)
+    struct.pack_into("<IIii", prpsinfo, 16, 1000, 1000, 4243, 1)
+    prpsinfo[40:45] = b"myapp"
+    prpsinfo[56:72] = b"myapp --crash-me"
+    siginfo = bytearray(128)
+    struct.pack_into("<iiixxxxQ", siginfo, 0, signo, 0, code, 0xDEAD)
+    auxv = struct.pack("<6Q", 6, 4096, 9, 0x401000, 0, 0)
+    names = b"/usr/bin/myapp\0/lib/libc.so.6\0/usr/bin/myapp\0"
+    nt_file = struct.pack("<11Q", 3, 4096, base, base + 0x2000, 0, 0x7F000000, 0x7F001000, 0, 0x402000, 0x403000, 1)
+    notes = b"".join(
+        (
+            note(1, bytes(prstatus)),
+            note(3, bytes(prpsinfo)),
+            note(0x53494749, bytes(siginfo)),
+            note(6, auxv),
+            note(0x46494C45, nt_file + names),
+            note(1, bytes(second)),
+        )
+    )
+    header = b"\x7fELF\x02\x01\x01" + b"\0" * 9
+    header += struct.pack("<HHIQQQIHHHHHH", 4, 62, 1, 0, 64, 0, 0, 64, 56, 1, 0, 0, 0)
+    program_header = struct.pack("<IIQQQQQQ", 4, 0, 64 + 56, 0, 0, len(notes), 0, 0)
+    with open(file_name, "wb") as core_dump:
+        core_dump.write(header + program_header + notes + b"\0" * 4096)
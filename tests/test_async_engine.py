@@ -0,0 +1,119 @@
+import asyncio
+import os
+import shutil
+import unittest
+from unittest.mock import patch
+from moto import mock_aws
+import boto3
+
+import main
+import upload_file_2_s3
+from async_engine import AsyncEngine
+
+os.environ["REGION"] = "us-east-1"
+
+
+async def wait_until(condition, timeout=10):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+@mock_aws
+class TestAsyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="mybucket")
+        os.mkdir("async_test_files", 0o777)
+        with open("async_test_files/core-orphan-1-1-11", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        os.utime("async_test_files/core-orphan-1-1-11", (0, 0))
+        s3_upload_wrapper = main.s3_upload_wrapper
+        for patcher in (
+            patch("main.i_am_started", autospec=True),
+            patch("main.i_am_dead", autospec=True),
+            patch(
+                "main.s3_upload_wrapper",
+                side_effect=lambda *args, **kwargs: s3_upload_wrapper(*args, bucket_name="mybucket", **kwargs),
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # run() hands its shutdown event to the upload module, stop() sets it.
+        self.addCleanup(upload_file_2_s3.configure)
+
+    def tearDown(self):
+        shutil.rmtree("async_test_files")
+
+    def test_run(self):
+        """Test AsyncEngine.run().
+
+        1. Test a dump left in the directory is uploaded at startup.
+        2. Test a dump written while running is uploaded.
+        3. Test stop() leaves run() and marks the handler dead.
+        """
+
+        async def scenario():
+            engine = AsyncEngine("async_test_files", concurrency=2)
+            runner = asyncio.create_task(engine.run())
+            # 1.
+            self.assertTrue(await wait_until(lambda: not os.path.exists("async_test_files/core-orphan-1-1-11")))
+            # 2.
+            with open("async_test_files/core-live-1-2-6", "w", encoding="utf-8") as core_dump:
+                core_dump.write("test\n")
+            self.assertTrue(await wait_until(lambda: not os.path.exists("async_test_files/core-live-1-2-6")))
+            self.assertEqual(engine.scheduler.in_flight, 0)
+            # 3.
+            engine.stop()
+            await asyncio.wait_for(runner, timeout=10)
+
+        with self.assertLogs(logger="main", level="INFO"), self.assertLogs(logger="async_engine", level="INFO"):
+            asyncio.run(scenario())
+        keys = [item["Key"] for item in self.s3.list_objects_v2(Bucket="mybucket")["Contents"]]
+        self.assertEqual(sorted(keys), ["core-live-1-2-6", "core-orphan-1-1-11"])
+        main.i_am_started.assert_called_once()
+        main.i_am_dead.assert_called_once()
+
+    def test_upload_failure(self):
+        """Test a failed upload frees its scheduler slot and keeps the dump.
+
+        1. Test the failure is logged and the dump stays on disk.
+        """
+
+        async def scenario():
+            engine = AsyncEngine("async_test_files", concurrency=1)
+            engine._semaphore = asyncio.Semaphore(1)
+            with patch("main.s3_upload_wrapper", side_effect=Exception("These are not the droids you are looking for")):
+                engine.submit("core-orphan-1-1-11")
+                self.assertEqual(engine.dispatch(), 1)
+                await asyncio.gather(*engine._tasks)
+            return engine
+
+        # 1.
+        with self.assertLogs(logger="main", level="ERROR"):
+            engine = asyncio.run(scenario())
+        self.assertEqual(engine.scheduler.in_flight, 0)
+        self.assertTrue(os.path.exists("async_test_files/core-orphan-1-1-11"))
+
+    def test_dispatch_after_stop(self):
+        """Test no upload is started once the engine is stopping.
+
+        1. Test dispatch() leaves a queued dump with the scheduler.
+        """
+
+        async def scenario():
+            engine = AsyncEngine("async_test_files", concurrency=1)
+            engine._stopping = asyncio.Event()
+            engine.submit("core-orphan-1-1-11")
+            with self.assertLogs(logger="async_engine", level="INFO"):
+                engine.stop()
+            # 1.
+            self.assertEqual(engine.dispatch(), 0)
+            self.assertFalse(engine._tasks)
+            return engine
+
+        engine = asyncio.run(scenario())
+        self.assertEqual(engine.scheduler.queued, 1)
+        self.assertTrue(os.path.exists("async_test_files/core-orphan-1-1-11"))
@@ -0,0 +1,54 @@
+import os
+import time
+import unittest
+
+from backlog import open_files, scan
+
+
+class TestBacklog(unittest.TestCase):
+    def setUp(self):
+        os.mkdir("backlog_test_files", 0o777)
+        for file_name in ("core-old", "core-older", "core-recent", "core-open", "not-a-core"):
+            with open(f"backlog_test_files/{file_name}", "w", encoding="utf-8") as core_dump:
+                core_dump.write("test\n")
+        old = time.time() - 120
+        for file_name in ("core-old", "core-open", "not-a-core"):
+            os.utime(f"backlog_test_files/{file_name}", (old, old))
+        os.utime("backlog_test_files/core-older", (old - 60, old - 60))
+        os.mkdir("backlog_test_files/core-directory")
+
+    def tearDown(self):
+        os.rmdir("backlog_test_files/core-directory")
+        for file in os.listdir("backlog_test_files"):
+            os.remove(f"backlog_test_files/{file}")
+        os.rmdir("backlog_test_files")
+
+    def test_open_files(self):
+        """Test open_files().
+
+        1. Test files open in this process are found.
+        2. Test a missing procfs.
+        """
+        # 1.
+        with open("backlog_test_files/core-open", "rb"):
+            self.assertIn(os.path.abspath("backlog_test_files/core-open"), open_files())
+        # 2.
+        self.assertEqual(open_files(proc="backlog_test_files/proc"), set())
+
+    def test_scan(self):
+        """Test scan().
+
+        1. Test settled `core` files are found oldest first.
+        2. Test files still open are skipped.
+        3. Test an empty directory.
+        """
+        # 1.
+        with self.assertLogs(logger="backlog", level="INFO"):
+            self.assertEqual(
+                scan("backlog_test_files", min_age=60), [("core-older", 5), ("core-old", 5), ("core-open", 5)]
+            )
+        # 2.
+        with open("backlog_test_files/core-open", "ab"):
+            self.assertEqual([name for name, _ in scan("backlog_test_files", min_age=60)], ["core-older", "core-old"])
+        # 3.
+        self.assertEqual(scan("backlog_test_files/core-directory"), [])
@@ -0,0 +1,202 @@
+import gzip
+import io
+import os
+import shutil
+import unittest
+from unittest.mock import patch
+from moto import mock_aws
+import boto3
+
+import compression
+from compression import CompressedReader, available_cpus, codec, compressed_chunks, cpu_quota, is_compressed, pick_level
+from transfer_budget import TransferBudget
+from upload_file_2_s3 import upload_file
+
+os.environ["REGION"] = "us-east-1"
+# Compressible, but not trivially: random words.
+DATA = b" ".join(os.urandom(4).hex().encode() for _ in range(400000))
+
+
+@mock_aws
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="mybucket")
+        os.mkdir("compression_test_files", 0o777)
+        with open("compression_test_files/core-plain", "wb") as core_dump:
+            core_dump.write(DATA)
+        with open("compression_test_files/core-packed", "wb") as core_dump:
+            core_dump.write(gzip.compress(b"test\n"))
+
+    def tearDown(self):
+        shutil.rmtree("compression_test_files")
+
+    def test_is_compressed(self):
+        """Test is_compressed().
+
+        1. Test gzip files are detected from their magic bytes.
+        2. Test plain files.
+        """
+        # 1.
+        self.assertTrue(is_compressed("compression_test_files/core-packed"))
+        # 2.
+        self.assertFalse(is_compressed("compression_test_files/core-plain"))
+
+    def test_codec(self):
+        """Test codec().
+
+        1. Test compression turned off.
+        2. Test gzip.
+        3. Test zstd falls back to gzip without zstandard.
+        4. Test unknown codecs.
+        """
+        # 1.
+        self.assertIsNone(codec("off"))
+        # 2.
+        self.assertEqual(codec("GZIP"), "gzip")
+        # 3.
+        with patch("compression.zstandard", None), self.assertLogs(logger="compression", level="WARNING"):
+            self.assertEqual(codec("zstd"), "gzip")
+        # 4.
+        with self.assertRaises(ValueError):
+            codec("lz4")
+
+    def test_cpu_quota(self):
+        """Test cpu_quota() and available_cpus().
+
+        1. Test the cgroup v2 quota.
+        2. Test no quota.
+        3. Test the cgroup v1 quota.
+        4. Test the available CPUs are capped by the quota.
+        """
+        cgroup = "compression_test_files/cgroup"
+        os.makedirs(f"{cgroup}/cpu")
+        # 1.
+        with open(f"{cgroup}/cpu.max", "w", encoding="utf-8") as cpu_max:
+            cpu_max.write("150000 100000\n")
+        self.assertEqual(cpu_quota(cgroup), 1.5)
+        # 2.
+        with open(f"{cgroup}/cpu.max", "w", encoding="utf-8") as cpu_max:
+            cpu_max.write("max 100000\n")
+        self.assertIsNone(cpu_quota(cgroup))
+        # 3.
+        os.remove(f"{cgroup}/cpu.max")
+        for name, value in (("cpu.cfs_quota_us", "50000"), ("cpu.cfs_period_us", "100000")):
+            with open(f"{cgroup}/cpu/{name}", "w", encoding="utf-8") as cfs:
+                cfs.write(f"{value}\n")
+        self.assertEqual(cpu_quota(cgroup), 0.5)
+        # 4.
+        self.assertEqual(available_cpus(cgroup), 1)
+
+    def test_pick_level(self):
+        """Test pick_level().
+
+        1. Test the fastest level while dumps are queued.
+        2. Test the fastest level on busy CPUs.
+        3. Test the strongest level on idle CPUs.
+        4. Test levels in between.
+        """
+        # 1.
+        self.assertEqual(pick_level("gzip", queued=3, load=0, cpus=4), 1)
+        # 2.
+        self.assertEqual(pick_level("gzip", load=8, cpus=4), 1)
+        # 3.
+        self.assertEqual(pick_level("gzip", load=0, cpus=4), 6)
+        self.assertEqual(pick_level("zstd", load=0, cpus=4), 9)
+        # 4.
+        self.assertEqual(pick_level("gzip", load=2, cpus=4), 3)
+
+    def test_compressed_chunks(self):
+        """Test compressed_chunks().
+
+        1. Test the chunks concatenated are a valid gzip file.
+        2. Test an empty stream is a valid empty gzip file.
+        3. Test zstd chunks concatenated are a valid zstd file.
+        4. Test the chunks beyond the first are charged to the budget while it has room, and given back.
+        """
+        # 1.
+        chunks = list(compressed_chunks(io.BytesIO(DATA), level=1, chunk_size=256 * 1024, threads=3))
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(gzip.decompress(b"".join(chunks)), DATA)
+        self.assertLess(sum(map(len, chunks)), len(DATA))
+        # 2.
+        self.assertEqual(gzip.decompress(b"".join(compressed_chunks(io.BytesIO(b"")))), b"")
+        # 3.
+        if compression.zstandard is not None:
+            chunks = compressed_chunks(io.BytesIO(DATA), name="zstd", chunk_size=256 * 1024, threads=3)
+            with compression.zstandard.ZstdDecompressor().stream_reader(io.BytesIO(b"".join(chunks))) as reader:
+                self.assertEqual(reader.read(), DATA)
+        # 4.
+        budget = TransferBudget(max_bytes=512 * 1024)
+        charged = []
+        acquire = budget.acquire
+
+        def track(nbytes, timeout=None):
+            acquired = acquire(nbytes, timeout=timeout)
+            charged.append(budget.in_use)
+            return acquired
+
+        with patch.object(budget, "acquire", side_effect=track):
+            chunks = list(compressed_chunks(io.BytesIO(DATA), chunk_size=256 * 1024, threads=4, budget=budget))
+        self.assertEqual(gzip.decompress(b"".join(chunks)), DATA)
+        self.assertTrue(charged)
+        self.assertLessEqual(max(charged), 512 * 1024)
+        self.assertEqual(budget.in_use, 0)
+        budget.acquire(512 * 1024)
+        chunks = list(compressed_chunks(io.BytesIO(DATA), chunk_size=256 * 1024, threads=4, budget=budget))
+        self.assertEqual((gzip.decompress(b"".join(chunks)), budget.in_use), (DATA, 512 * 1024))
+
+    def test_compressed_reader(self):
+        """Test CompressedReader.
+
+        1. Test readinto() across chunk boundaries.
+        2. Test read() of the rest and tell().
+        """
+        with CompressedReader(io.BytesIO(DATA), chunk_size=256 * 1024, threads=2) as reader:
+            # 1.
+            buffer = bytearray(100000)
+            self.assertEqual(reader.readinto(buffer), 100000)
+            # 2.
+            rest = reader.read()
+            self.assertEqual(reader.tell(), 100000 + len(rest))
+            self.assertEqual(reader.read(10), b"")
+        self.assertEqual(gzip.decompress(bytes(buffer) + rest), DATA)
+
+    def test_upload_file_compressed(self):
+        """Test upload_file() with compression.
+
+        1. Test a plain dump is compressed and uploaded with a .gz extension.
+        2. Test multipart uploads of compressed dumps.
+        3. Test compressed dumps are uploaded as they are.
+        """
+        mock_s3_client = boto3.client("s3", region_name="us-east-1")
+        # 1.
+        with self.assertLogs(logger="upload_file_2_s3", level="INFO"):
+            self.assertEqual(
+                upload_file(file_name="compression_test_files/core-plain", bucket="mybucket", compress="gzip"),
+                "s3://mybucket/core-plain.gz",
+            )
+        body = mock_s3_client.get_object(Bucket="mybucket", Key="core-plain.gz")["Body"].read()
+        self.assertEqual(gzip.decompress(body), DATA)
+        self.assertFalse(os.path.exists("compression_test_files/core-plain"))
+        # 2.
+        with open("compression_test_files/core-large", "wb") as core_dump:
+            core_dump.write(DATA * 4)
+        upload_file(
+            file_name="compression_test_files/core-large",
+            bucket="mybucket",
+            multipart_threshold=1024 * 1024,
+            part_size=5 * 1024 * 1024,
+            compress="gzip",
+            compress_level=1,
+        )
+        body = mock_s3_client.get_object(Bucket="mybucket", Key="core-large.gz")["Body"].read()
+        self.assertEqual(gzip.decompress(body), DATA * 4)
+        # 3.
+        self.assertEqual(
+            upload_file(file_name="compression_test_files/core-packed", bucket="mybucket", compress="gzip"),
+            "s3://mybucket/core-packed",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import unittest
+from moto import mock_aws
+import boto3
+
+from dedup import FingerprintCache, fingerprint
+from dump_index import DumpIndex
+from helpers import build_core
+from upload_file_2_s3 import upload_file
+
+os.environ["REGION"] = "us-east-1"
+
+
+@mock_aws
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="mybucket")
+        os.mkdir("dedup_test_files", 0o777)
+        build_core("dedup_test_files/core-myapp-1700000000-4243-11")
+        build_core("dedup_test_files/core-myapp-1700000060-4250-11", base=0x55550000)
+
+    def tearDown(self):
+        shutil.rmtree("dedup_test_files")
+
+    def test_fingerprint(self):
+        """Test fingerprint().
+
+        1. Test dumps of one crash at different load addresses have the same fingerprint.
+        2. Test a different crash has a different fingerprint.
+        3. Test sampled blocks tell dumps of the same crash apart.
+        4. Test files that are not core dumps only have a sampled fingerprint.
+        """
+        first = fingerprint("dedup_test_files/core-myapp-1700000000-4243-11")
+        # 1.
+        self.assertEqual(fingerprint("dedup_test_files/core-myapp-1700000060-4250-11"), first)
+        # 2.
+        build_core("dedup_test_files/core-myapp-1700000120-4260-11", code=2)
+        self.assertNotEqual(fingerprint("dedup_test_files/core-myapp-1700000120-4260-11"), first)
+        # 3.
+        self.assertNotEqual(
+            fingerprint("dedup_test_files/core-myapp-1700000000-4243-11", sampled_blocks=4),
+            fingerprint("dedup_test_files/core-myapp-1700000060-4250-11", sampled_blocks=4),
+        )
+        # 4.
+        with open("dedup_test_files/core-text", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        self.assertIsNone(fingerprint("dedup_test_files/core-text"))
+        self.assertIsNotNone(fingerprint("dedup_test_files/core-text", sampled_blocks=4))
+
+    def test_fingerprint_cache(self):
+        """Test FingerprintCache.
+
+        1. Test fingerprints are looked up and the least recently matched is evicted.
+        2. Test entries expire after the TTL.
+        3. Test the executable patterns.
+        4. Test check() finds the original of a duplicate.
+        """
+        cache = FingerprintCache(max_entries=2, ttl_seconds=60)
+        # 1.
+        cache.add("a", "s3://mybucket/a", now=0)
+        cache.add("b", "s3://mybucket/b", now=0)
+        self.assertEqual(cache.get("a", now=1), "s3://mybucket/a")
+        cache.add("c", "s3://mybucket/c", now=1)
+        self.assertIsNone(cache.get("b", now=1))
+        self.assertEqual(len(cache), 2)
+        # 2.
+        self.assertIsNone(cache.get("a", now=61))
+        self.assertEqual(len(cache), 1)
+        # 3.
+        cache = FingerprintCache(executables="my*,other", exclude="mytool")
+        self.assertTrue(cache.enabled_for("dedup_test_files/core-myapp-1-2-11"))
+        self.assertFalse(cache.enabled_for("core-mytool-1-2-11"))
+        self.assertFalse(cache.enabled_for("core-third-1-2-11"))
+        # 4.
+        key, original = cache.check("dedup_test_files/core-myapp-1700000000-4243-11")
+        self.assertIsNone(original)
+        cache.add(key, "s3://mybucket/core-myapp-1700000000-4243-11")
+        self.assertEqual(
+            cache.check("dedup_test_files/core-myapp-1700000060-4250-11"),
+            (key, "s3://mybucket/core-myapp-1700000000-4243-11"),
+        )
+
+    def test_upload_file_duplicate(self):
+        """Test upload_file() of a duplicate.
+
+        1. Test only the metadata is uploaded and the dump is deleted.
+        2. Test the duplicate is in the dump index.
+        """
+        mock_s3_client = boto3.client("s3", region_name="us-east-1")
+        # 1.
+        with self.assertLogs(logger="upload_file_2_s3", level="INFO"):
+            self.assertEqual(
+                upload_file(
+                    file_name="dedup_test_files/core-myapp-1700000060-4250-11",
+                    bucket="mybucket",
+                    duplicate_of="s3://mybucket/core-myapp-1700000000-4243-11",
+                    fingerprint="abc",
+                ),
+                "s3://mybucket/core-myapp-1700000060-4250-11.duplicate.json",
+            )
+        keys = [item["Key"] for item in mock_s3_client.list_objects_v2(Bucket="mybucket")["Contents"]]
+        self.assertEqual(keys, ["core-myapp-1700000060-4250-11.duplicate.json"])
+        record = json.loads(
+            mock_s3_client.get_object(Bucket="mybucket", Key="core-myapp-1700000060-4250-11.duplicate.json")[
+                "Body"
+            ].read()
+        )
+        self.assertEqual(record["duplicate_of"], "s3://mybucket/core-myapp-1700000000-4243-11")
+        self.assertEqual(record["summary"]["pid"], 4243)
+        self.assertFalse(os.path.exists("dedup_test_files/core-myapp-1700000060-4250-11"))
+        # 2.
+        (entry,) = DumpIndex("dedup_test_files").records()
+        self.assertEqual((entry["duplicate_of"], entry["fingerprint"]), (record["duplicate_of"], "abc"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import shutil
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+from disk_watchdog import DUPLICATE, OLDEST, DiskWatchdog, disk_usage, read_manifest
+from scheduler import UploadScheduler
+
+
+class TestDiskWatchdog(unittest.TestCase):
+    def setUp(self):
+        os.mkdir("disk_watchdog_test_files", 0o777)
+        now = time.time()
+        for age, file_name in enumerate(("core-c-1-3-11", "core-b-1-2-11", "core-a-1-1-11")):
+            with open(f"disk_watchdog_test_files/{file_name}", "w", encoding="utf-8") as core_dump:
+                core_dump.write("test\n")
+            os.utime(f"disk_watchdog_test_files/{file_name}", (now - 60 * age, now - 60 * age))
+        self.scheduler = UploadScheduler(max_in_flight=1)
+        for file_name in ("core-a-1-1-11", "core-b-1-2-11", "core-c-1-3-11"):
+            self.scheduler.submit(file_name, "disk_watchdog_test_files", size=5, backlog=True)
+
+    def tearDown(self):
+        shutil.rmtree("disk_watchdog_test_files")
+
+    def test_disk_usage(self):
+        """Test disk_usage().
+
+        1. Test the usage of a real filesystem.
+        """
+        # 1.
+        usage, available = disk_usage("disk_watchdog_test_files")
+        self.assertTrue(0 <= usage <= 1)
+        self.assertGreater(available, 0)
+
+    def test_check(self):
+        """Test DiskWatchdog.check().
+
+        1. Test nothing happens below the high watermark.
+        2. Test the oldest dumps are evicted until usage is under the low watermark, never one with a worker or the
+        newest.
+        3. Test every eviction is in the manifest.
+        4. Test pressure lasts until usage is under the low watermark.
+        5. Test usage is read at most every `check_seconds`.
+        """
+        watchdog = DiskWatchdog(
+            "disk_watchdog_test_files", high_watermark=0.85, low_watermark=0.75, check_seconds=5, min_age=0
+        )
+        # 1.
+        with patch("disk_watchdog.disk_usage", return_value=(0.5, 100)):
+            self.assertEqual(watchdog.check(self.scheduler, now=0), [])
+        self.assertFalse(self.scheduler.pressure)
+        # 2.
+        self.assertEqual(self.scheduler.next()[0], "core-a-1-1-11")
+        with patch("disk_watchdog.disk_usage", side_effect=[(0.9, 10), (0.7, 30)]), patch(
+            "disk_watchdog.disk_size", return_value=10
+        ):
+            with self.assertLogs(logger="disk_watchdog", level="WARNING"):
+                evicted = watchdog.check(self.scheduler, now=10)
+        self.assertEqual([entry["name"] for entry in evicted], ["core-b-1-2-11"])
+        self.assertEqual(
+            sorted(os.listdir("disk_watchdog_test_files")), [".evictions.jsonl", "core-a-1-1-11", "core-c-1-3-11"]
+        )
+        self.assertTrue(self.scheduler.pressure)
+        self.assertEqual(self.scheduler.backlog, 1)
+        # 3.
+        manifest = read_manifest("disk_watchdog_test_files")
+        self.assertEqual(manifest, evicted)
+        self.assertEqual(
+            [(entry["reason"], entry["usage_before"], entry["usage_after"]) for entry in manifest],
+            [(OLDEST, 0.9, 0.7)],
+        )
+        # 4.
+        with patch("disk_watchdog.disk_usage", return_value=(0.8, 20)):
+            watchdog.check(self.scheduler, now=20)
+        self.assertTrue(self.scheduler.pressure)
+        with patch("disk_watchdog.disk_usage", return_value=(0.7, 30)):
+            with self.assertLogs(logger="disk_watchdog", level="INFO"):
+                watchdog.check(self.scheduler, now=30)
+        self.assertFalse(self.scheduler.pressure)
+        # 5.
+        with patch("disk_watchdog.disk_usage") as usage:
+            watchdog.check(self.scheduler, now=31)
+        usage.assert_not_called()
+
+    def test_evict_duplicates(self):
+        """Test DiskWatchdog.evict() with deduplication.
+
+        1. Test duplicates are evicted before older dumps.
+        2. Test nothing is evicted with the watchdog disabled.
+        """
+        fingerprints = Mock()
+        fingerprints.check.side_effect = lambda path: (
+            "abc",
+            "s3://mybucket/core-b-1-0-11" if path.endswith("core-b-1-2-11") else None,
+        )
+        watchdog = DiskWatchdog("disk_watchdog_test_files", high_watermark=0.85, low_watermark=0.75, min_age=0)
+        # 1.
+        with patch("disk_watchdog.disk_usage", side_effect=[(0.9, 10), (0.7, 30)]), patch(
+            "disk_watchdog.disk_size", return_value=10
+        ):
+            with self.assertLogs(logger="disk_watchdog", level="WARNING"):
+                (entry,) = watchdog.check(self.scheduler, fingerprints, now=0)
+        self.assertEqual(
+            (entry["name"], entry["reason"], entry["duplicate_of"]),
+            ("core-b-1-2-11", DUPLICATE, "s3://mybucket/core-b-1-0-11"),
+        )
+        # 2.
+        watchdog = DiskWatchdog("disk_watchdog_test_files", high_watermark=1, low_watermark=0.75)
+        with patch("disk_watchdog.disk_usage", return_value=(1.0, 0)):
+            self.assertEqual(watchdog.check(self.scheduler, now=0), [])
+
+    def test_evict_guards(self):
+        """Test what DiskWatchdog.evict() leaves alone.
+
+        1. Test nothing is evicted if the dumps cannot bring usage under the low watermark.
+        2. Test dumps younger than `min_age` are never evicted.
+        3. Test the watchdog is off by default.
+        """
+        watchdog = DiskWatchdog("disk_watchdog_test_files", high_watermark=0.85, low_watermark=0.75, min_age=0)
+        # 1.
+        with patch("disk_watchdog.disk_usage", return_value=(0.9, 10)), patch(
+            "disk_watchdog.disk_size", return_value=10**12
+        ):
+            with self.assertLogs(logger="disk_watchdog", level="ERROR"):
+                self.assertEqual(watchdog.check(self.scheduler, now=0), [])
+        self.assertEqual(len(os.listdir("disk_watchdog_test_files")), 3)
+        # 2.
+        watchdog = DiskWatchdog("disk_watchdog_test_files", high_watermark=0.85, low_watermark=0.75, min_age=90)
+        self.assertEqual(watchdog.candidates(self.scheduler), [])
+        watchdog.min_age = 30
+        self.assertEqual([candidate[0] for candidate in watchdog.candidates(self.scheduler)], ["core-a-1-1-11"])
+        # 3.
+        self.assertFalse(DiskWatchdog("disk_watchdog_test_files").enabled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import time
+import unittest
+from unittest.mock import patch
+from moto import mock_aws
+import boto3
+
+import dump_index
+from dump_index import DumpIndex, matches, object_key, remote_records
+from upload_file_2_s3 import upload_file
+
+os.environ["REGION"] = "us-east-1"
+
+
+@mock_aws
+class TestDumpIndex(unittest.TestCase):
+    def setUp(self):
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="mybucket")
+        os.mkdir("index_test_files", 0o777)
+        with open("index_test_files/core-myapp-1700000000-42-11", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+
+    def tearDown(self):
+        shutil.rmtree("index_test_files")
+
+    def test_object_key(self):
+        """Test object_key().
+
+        1. Test the default template keeps the file name.
+        2. Test a template with the executable, date and node.
+        3. Test dumps named otherwise.
+        """
+        # 1.
+        self.assertEqual(object_key("index_test_files/core-myapp-1700000000-42-11"), "core-myapp-1700000000-42-11")
+        # 2.
+        self.assertEqual(
+            object_key("core-myapp-1700000000-42-11.gz", "{executable}/{date}/{node}/{name}", node="node-1"),
+            "myapp/2023-11-14/node-1/core-myapp-1700000000-42-11.gz",
+        )
+        self.assertEqual(
+            object_key("core-myapp-1700000000-42-11", "/{year}/{month}/{day}/{signal}/{name}"),
+            "2023/11/14/11/core-myapp-1700000000-42-11",
+        )
+        # 3.
+        self.assertTrue(object_key("core.1234", "{executable}/{name}").startswith("unknown/"))
+
+    def test_append_compact(self):
+        """Test DumpIndex append(), seal() and compact().
+
+        1. Test appended records are read back from the active file.
+        2. Test sealing moves the active file to a segment.
+        3. Test compacting merges segments, keeps the latest record per object and drops expired records.
+        """
+        index = DumpIndex("index_test_files")
+        now = time.time()
+        # 1.
+        index.append({"uri": "s3://mybucket/a", "uploaded_at": now, "size": 1})
+        index.append({"uri": "s3://mybucket/b", "uploaded_at": now - 10 * 86400})
+        self.assertEqual([entry["uri"] for entry in index.records()], ["s3://mybucket/a", "s3://mybucket/b"])
+        # 2.
+        segment = index.seal()
+        self.assertEqual(index.segments(), [segment])
+        self.assertFalse(os.path.exists(index.active))
+        self.assertIsNone(index.seal())
+        # 3.
+        index.append({"uri": "s3://mybucket/a", "uploaded_at": now, "size": 2})
+        self.assertEqual(index.compact(retention_days=5), 1)
+        self.assertEqual(index.segments(), [])
+        self.assertEqual(list(index.records()), [{"uri": "s3://mybucket/a", "uploaded_at": now, "size": 2}])
+
+    def test_push(self):
+        """Test push().
+
+        1. Test the compacted index is uploaded per node.
+        2. Test an empty index is not uploaded.
+        3. Test failures are logged, not raised.
+        """
+        # 1.
+        DumpIndex("index_test_files").append({"uri": "s3://mybucket/a", "uploaded_at": time.time()})
+        with patch.dict(os.environ, {"NODE_NAME": "node-1"}):
+            self.assertEqual(
+                dump_index.push("index_test_files", "mybucket", self.s3), "s3://mybucket/_index/node-1.jsonl"
+            )
+        self.assertEqual([entry["uri"] for entry in remote_records(self.s3, "mybucket")], ["s3://mybucket/a"])
+        # 2.
+        self.assertIsNone(dump_index.push("empty_test_files", "mybucket", self.s3))
+        # 3.
+        with self.assertLogs(logger="dump_index", level="WARNING"):
+            self.assertIsNone(dump_index.push("index_test_files", "nobucket", self.s3))
+
+    def test_matches(self):
+        """Test matches().
+
+        1. Test no filters.
+        2. Test the signal by number, name and short name.
+        3. Test the executable, node and time filters.
+        """
+        entry = {"executable": "myapp", "node": "node-1", "signal": 11, "signal_name": "SIGSEGV", "crashed_at": 100}
+        # 1.
+        self.assertTrue(matches(entry))
+        # 2.
+        for signal_filter in ("11", "SIGSEGV", "segv"):
+            self.assertTrue(matches(entry, signal_filter=signal_filter))
+        self.assertFalse(matches(entry, signal_filter="SIGABRT"))
+        # 3.
+        self.assertTrue(matches(entry, executable="myapp", node="node-1", since=100))
+        self.assertFalse(matches(entry, executable="other"))
+        self.assertFalse(matches(entry, node="node-2"))
+        self.assertFalse(matches(entry, since=101))
+
+    def test_upload_file_index(self):
+        """Test upload_file() records uploads in the index.
+
+        1. Test the record of an upload under a key template.
+        2. Test uploads are not recorded with the index turned off.
+        """
+        # 1.
+        with patch("dump_index.object_key.__defaults__", ("{executable}/{name}", None)):
+            result = upload_file(file_name="index_test_files/core-myapp-1700000000-42-11", bucket="mybucket")
+        self.assertEqual(result, "s3://mybucket/myapp/core-myapp-1700000000-42-11")
+        (entry,) = DumpIndex("index_test_files").records()
+        self.assertEqual(entry["uri"], result)
+        self.assertEqual((entry["executable"], entry["pid"], entry["signal_name"]), ("myapp", 42, "SIGSEGV"))
+        self.assertEqual((entry["crashed_at"], entry["size"]), (1700000000, 5))
+        self.assertEqual(entry["checksum_algorithm"], "SHA256")
+        self.assertEqual(json.loads(json.dumps(entry)), entry)
+        # 2.
+        with open("index_test_files/core-other-1700000000-43-6", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        upload_file(file_name="index_test_files/core-other-1700000000-43-6", bucket="mybucket", index=False)
+        self.assertEqual(len(list(DumpIndex("index_test_files").records())), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
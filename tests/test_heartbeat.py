@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import time
+import unittest
+
+from heartbeat import Heartbeat, check
+
+
+class TestHeartbeat(unittest.TestCase):
+    def setUp(self):
+        os.mkdir("heartbeat_test_files", 0o777)
+
+    def tearDown(self):
+        shutil.rmtree("heartbeat_test_files")
+
+    def test_beat(self):
+        """Test Heartbeat.beat().
+
+        1. Test the heartbeat is written with the status.
+        2. Test it is written at most every `interval_seconds`.
+        3. Test a heartbeat that cannot be written is logged.
+        """
+        beats = Heartbeat("heartbeat_test_files/heartbeat", interval_seconds=5)
+        # 1.
+        self.assertTrue(beats.beat(now=0, queued=3))
+        with open("heartbeat_test_files/heartbeat", encoding="utf-8") as heartbeat:
+            record = json.load(heartbeat)
+        self.assertEqual((record["healthy"], record["queued"], record["pid"]), (True, 3, os.getpid()))
+        # 2.
+        self.assertFalse(beats.beat(now=4))
+        self.assertTrue(beats.beat(now=5))
+        self.assertEqual(os.listdir("heartbeat_test_files"), ["heartbeat"])
+        # 3.
+        beats = Heartbeat("heartbeat_test_files/missing/heartbeat")
+        with self.assertLogs(logger="heartbeat", level="WARNING"):
+            self.assertFalse(beats.beat())
+
+    def test_check(self):
+        """Test check().
+
+        1. Test a fresh and healthy heartbeat.
+        2. Test an unhealthy heartbeat.
+        3. Test a stale heartbeat.
+        4. Test a missing heartbeat.
+        """
+        file_name = "heartbeat_test_files/heartbeat"
+        # 1.
+        Heartbeat(file_name).beat()
+        self.assertEqual(check(file_name, max_age=30), (True, None))
+        # 2.
+        Heartbeat(file_name).beat(healthy=False, reason="Cancelled uploads of core-a-1-1-11 did not stop.")
+        self.assertEqual(check(file_name, max_age=30), (False, "Cancelled uploads of core-a-1-1-11 did not stop."))
+        # 3.
+        with open(file_name, "w", encoding="utf-8") as heartbeat:
+            json.dump({"time": time.time() - 60, "healthy": True}, heartbeat)
+        alive, reason = check(file_name, max_age=30)
+        self.assertFalse(alive)
+        self.assertIn("60 seconds ago", reason)
+        # 4.
+        self.assertFalse(check("heartbeat_test_files/missing", max_age=30)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
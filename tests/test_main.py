@@ -1,9 +1,33 @@
+import shutil
 import sys
 import os
+import threading
 import unittest
 from unittest.mock import patch
 
-from main import i_am_started, i_am_dead, s3_upload_wrapper, my_callback
+from dedup import FingerprintCache
+from helpers import build_core
+from main import (
+    discard,
+    dispatch,
+    handle_sigterm,
+    i_am_started,
+    submit_backlog,
+    submit_resumes,
+    i_am_dead,
+    s3_upload_wrapper,
+    my_callback,
+    worker_context,
+)
+from scheduler import UploadScheduler
+from stall_watchdog import ProgressTable, StallWatchdog
+from upload_journal import UploadJournal
+
+
+def preloaded() -> bool:
+    import upload_file_2_s3  # pylint: disable=C0415
+
+    return upload_file_2_s3._data_loader is not None
 
 
 class TestCoreUploadFile2S3(unittest.TestCase):
@@ -128,3 +152,152 @@ class TestCoreUploadFile2S3(unittest.TestCase):
         # 2.
         with self.assertRaises((Exception, SystemExit)) as cm, self.assertLogs(level="ERROR"):
             my_callback(value=False)
+
+    def test_dispatch(self):
+        """Test dispatch().
+
+        1. Test dumps are handed to the pool up to the in flight limit, each with a progress slot.
+        2. Test the callbacks free the slots.
+        3. Test a failed dump is retried after a backoff.
+        """
+        scheduler = UploadScheduler(max_in_flight=2, keep_first=0)
+        stalls = StallWatchdog(ProgressTable(2))
+        for pid in range(3):
+            scheduler.submit(f"core-a-1-{pid}-11", "main_test_files")
+        # 1.
+        with patch("upload_pool.UploadPool", autospec=True) as mock_pool:
+            pool = mock_pool()
+            with self.assertLogs(logger="main", level="INFO"):
+                self.assertEqual(dispatch(scheduler, pool, stalls=stalls), 2)
+            self.assertEqual(pool.apply_async.call_count, 2)
+            self.assertEqual(
+                [call.kwargs["kwds"]["progress_slot"] for call in pool.apply_async.call_args_list], [0, 1]
+            )
+            # 2.
+            with self.assertLogs(logger="main", level="INFO") as captured_logs:
+                pool.apply_async.call_args_list[0].kwargs["callback"]("done")
+                self.assertEqual(captured_logs.output, ["INFO:main:done"])
+            with self.assertLogs(logger="main", level="ERROR"):
+                pool.apply_async.call_args_list[1].kwargs["error_callback"](Exception("failed"))
+            self.assertEqual((scheduler.in_flight, stalls.running), (0, 0))
+            # 3.
+            self.assertEqual(scheduler.retrying, 1)
+            with self.assertLogs(logger="main", level="INFO"):
+                self.assertEqual(dispatch(scheduler, pool), 1)
+
+    def test_dispatch_dedup(self):
+        """Test dispatch() with deduplication.
+
+        1. Test the first dump of a crash is uploaded in full.
+        2. Test a dump of the same crash after the first upload is handed out as a duplicate.
+        """
+        scheduler = UploadScheduler(keep_first=0)
+        fingerprints = FingerprintCache()
+        build_core("main_test_files/core-myapp-1-4243-11")
+        build_core("main_test_files/core-myapp-2-4250-11", base=0x55550000)
+        with patch("upload_pool.UploadPool", autospec=True) as mock_pool:
+            pool = mock_pool()
+            # 1.
+            scheduler.submit("core-myapp-1-4243-11", "main_test_files")
+            with self.assertLogs(logger="main", level="INFO"):
+                dispatch(scheduler, pool, fingerprints)
+                first = pool.apply_async.call_args.kwargs
+                self.assertIsNone(first["kwds"]["duplicate_of"])
+                first["callback"]("s3://mybucket/core-myapp-1-4243-11")
+            # 2.
+            scheduler.submit("core-myapp-2-4250-11", "main_test_files")
+            with self.assertLogs(logger="main", level="INFO"):
+                dispatch(scheduler, pool, fingerprints)
+            second = pool.apply_async.call_args.kwargs["kwds"]
+            self.assertEqual(second["duplicate_of"], "s3://mybucket/core-myapp-1-4243-11")
+            self.assertEqual(second["fingerprint"], first["kwds"]["fingerprint"])
+
+    def test_handle_sigterm(self):
+        """Test handle_sigterm().
+
+        1. Test the workers are told to shut down and the main loop is left.
+        """
+        shutdown = threading.Event()
+        # 1.
+        with self.assertRaises(SystemExit), self.assertLogs(logger="main", level="INFO"):
+            handle_sigterm(shutdown, 15, None)
+        self.assertTrue(shutdown.is_set())
+
+    def test_submit_backlog(self):
+        """Test submit_backlog().
+
+        1. Test settled dumps are queued as backlog.
+        2. Test dumps already queued are not counted again.
+        3. Test a missing directory is logged.
+        """
+        scheduler = UploadScheduler(keep_first=0)
+        with open("main_test_files/core-orphan", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        os.utime("main_test_files/core-orphan", (0, 0))
+        # 1.
+        with self.assertLogs(logger="backlog", level="INFO"):
+            self.assertEqual(submit_backlog(scheduler, "main_test_files"), 1)
+        self.assertEqual(scheduler.backlog, 1)
+        # 2.
+        with self.assertLogs(logger="backlog", level="INFO"):
+            self.assertEqual(submit_backlog(scheduler, "main_test_files"), 0)
+        # 3.
+        with self.assertLogs(logger="main", level="ERROR"):
+            self.assertEqual(submit_backlog(scheduler, "main_test_files/missing"), 0)
+
+    def test_submit_resumes(self):
+        """Test submit_resumes().
+
+        1. Test a dump cut off in the middle of its upload is queued as backlog, past sampling.
+        2. Test it is kept on disk when the queue overflows with the "drop" policy.
+        """
+        scheduler = UploadScheduler(keep_first=1, sample_every=1000, max_queue=1, overflow_policy="drop")
+        for file_name in ("core-app-1-1-11", "core-app-2-2-11"):
+            with open(f"main_test_files/{file_name}", "w", encoding="utf-8") as core_dump:
+                core_dump.write("test\n")
+        self.assertEqual(scheduler.submit("core-app-1-1-11", "main_test_files"), "queued")
+        UploadJournal("main_test_files/core-app-2-2-11").start("mybucket", "core-app-2-2-11", "upload-id", 5, "SHA256")
+        try:
+            # 1.
+            self.assertEqual(submit_resumes(scheduler, "main_test_files"), 1)
+            self.assertEqual(scheduler.backlog, 1)
+            # 2.
+            self.assertTrue(os.path.exists("main_test_files/core-app-2-2-11"))
+        finally:
+            shutil.rmtree("main_test_files/.upload_journal")
+
+    def test_discard(self):
+        """Test discard().
+
+        1. Test a sampled out dump without triage is queued as backlog and kept on disk.
+        """
+        scheduler = UploadScheduler(keep_first=1, sample_every=1000)
+        for file_name in ("core-app-1-1-11", "core-app-2-2-11"):
+            with open(f"main_test_files/{file_name}", "w", encoding="utf-8") as core_dump:
+                core_dump.write("test\n")
+            scheduler.submit(file_name, "main_test_files")
+        # 1.
+        with self.assertLogs(logger="main", level="WARNING"):
+            discard(scheduler, None, "core-app-2-2-11", "main_test_files")
+        self.assertEqual((scheduler.queued, scheduler.backlog), (1, 1))
+        self.assertTrue(os.path.exists("main_test_files/core-app-2-2-11"))
+
+    def test_worker_context(self):
+        """Test worker_context().
+
+        1. Test the S3 service model is preloaded in the handler before workers are forked from it.
+        2. Test forkserver workers start with the S3 service model loaded.
+        3. Test unknown start methods.
+        """
+        # 1.
+        with patch("upload_file_2_s3.preload", autospec=True) as preload:
+            self.assertEqual(worker_context("fork").get_start_method(), "fork")
+            worker_context("fork", preload=False)
+        preload.assert_called_once_with()
+        # 2.
+        context = worker_context("forkserver")
+        with context.Pool(processes=1) as pool:
+            self.assertTrue(pool.apply(preloaded))
+        # 3.
+        with self.assertRaises(ValueError):
+            worker_context("spawn")
@@ -0,0 +1,118 @@
+import multiprocessing
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+
+import metrics
+from metrics import Registry, StatsdClient
+
+
+class TestMetrics(unittest.TestCase):
+    def test_registry(self):
+        """Test Registry and Metric rendering.
+
+        1. Test counters with labels.
+        2. Test gauges collected from a function.
+        3. Test histograms.
+        """
+        registry = Registry()
+        counter = registry.define("uploads_total", "counter", "Uploads by result.")
+        gauge = registry.define("queue_depth", "gauge", "Dumps waiting.")
+        histogram = registry.define("stage_seconds", "histogram", "Seconds per stage.", (0.5, 1))
+        # 1.
+        counter.apply("inc", 1, {"result": "success"})
+        counter.apply("inc", 2, {"result": "success"})
+        self.assertEqual(counter.value(result="success"), 3)
+        # 2.
+        gauge.set_function(lambda: 7, queue="queued")
+        # 3.
+        histogram.apply("observe", 0.25, {"stage": "upload"})
+        histogram.apply("observe", 5, {"stage": "upload"})
+        self.assertEqual(
+            registry.render().splitlines(),
+            [
+                "# HELP core_dump_handler_uploads_total Uploads by result.",
+                "# TYPE core_dump_handler_uploads_total counter",
+                'core_dump_handler_uploads_total{result="success"} 3',
+                "# HELP core_dump_handler_queue_depth Dumps waiting.",
+                "# TYPE core_dump_handler_queue_depth gauge",
+                'core_dump_handler_queue_depth{queue="queued"} 7',
+                "# HELP core_dump_handler_stage_seconds Seconds per stage.",
+                "# TYPE core_dump_handler_stage_seconds histogram",
+                'core_dump_handler_stage_seconds_bucket{stage="upload",le="0.5"} 1',
+                'core_dump_handler_stage_seconds_bucket{stage="upload",le="1"} 1',
+                'core_dump_handler_stage_seconds_bucket{stage="upload",le="+Inf"} 2',
+                'core_dump_handler_stage_seconds_sum{stage="upload"} 5.25',
+                'core_dump_handler_stage_seconds_count{stage="upload"} 2',
+            ],
+        )
+
+    def test_recording(self):
+        """Test inc(), dec(), set_gauge() and observe().
+
+        1. Test nothing is recorded while metrics are disabled.
+        2. Test updates are applied in the parent.
+        3. Test workers send their updates over the queue.
+        """
+        # 1.
+        with patch("metrics._sink", None), patch.object(metrics.REGISTRY["workers_busy"], "apply") as apply:
+            metrics.inc("workers_busy")
+            apply.assert_not_called()
+        # 2.
+        with patch("metrics._sink", metrics._record):
+            before = metrics.REGISTRY["part_retries_total"].value() or 0
+            metrics.inc("part_retries_total", 2)
+            self.assertEqual(metrics.REGISTRY["part_retries_total"].value(), before + 2)
+            metrics.set_gauge("workers_busy", 3)
+            metrics.dec("workers_busy")
+            self.assertEqual(metrics.REGISTRY["workers_busy"].value(), 2)
+            metrics.observe("stage_seconds", 0.2, stage="test")
+            self.assertEqual(metrics.REGISTRY["stage_seconds"].value(stage="test")[2], 1)
+        # 3.
+        queue = multiprocessing.SimpleQueue()
+        with patch("metrics._sink", None):
+            metrics.init_worker(queue)
+            metrics.observe("stage_seconds", 1.5, stage="upload")
+            self.assertEqual(queue.get(), ("observe", "stage_seconds", 1.5, {"stage": "upload"}))
+            metrics.init_worker(None)
+            self.assertIsNone(metrics._sink)
+
+    def test_statsd(self):
+        """Test StatsdClient.
+
+        1. Test counters, gauges and timers with tags.
+        2. Test a daemon that is not listening does not raise.
+        """
+        statsd = StatsdClient("localhost:8125")
+        # 1.
+        self.assertEqual(
+            statsd.format("inc", "uploads_total", 1, {"result": "success"}),
+            b"core_dump_handler_uploads_total:1|c|#result:success",
+        )
+        self.assertEqual(statsd.format("set", "workers", 4, {}), b"core_dump_handler_workers:4|g")
+        self.assertEqual(statsd.format("inc", "workers_busy", -1, {}), b"core_dump_handler_workers_busy:-1|g")
+        self.assertEqual(
+            statsd.format("observe", "stage_seconds", 1.5, {"stage": "upload"}),
+            b"core_dump_handler_stage:1500|ms|#stage:upload",
+        )
+        # 2.
+        statsd.send("inc", "uploads_total", 1, {})
+
+    def test_serve(self):
+        """Test serve().
+
+        1. Test the registry is served on /metrics.
+        2. Test other paths are not found.
+        """
+        with self.assertLogs(logger="metrics", level="INFO"):
+            server = metrics.serve(0, address="127.0.0.1")
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        # 1.
+        with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+            self.assertIn("# TYPE core_dump_handler_uploads_total counter", response.read().decode("utf-8"))
+        # 2.
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/", timeout=5)
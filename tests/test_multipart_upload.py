@@ -0,0 +1,286 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from moto import mock_aws
+import boto3
+
+from transfer_budget import TransferBudget
+from upload_journal import UploadJournal
+
+import multipart_upload
+from multipart_upload import (
+    ChecksumMismatchError,
+    UploadInterrupted,
+    checksum,
+    composite_checksum,
+    multipart_etag,
+    put_object,
+    upload_parts,
+    verify_upload,
+)
+
+os.environ["REGION"] = "us-east-1"
+MiB = 1024 * 1024
+
+
+@mock_aws
+class TestMultipartUpload(unittest.TestCase):
+    def setUp(self):
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="mybucket")
+        self.data = os.urandom(11 * MiB)
+
+    def test_checksum(self):
+        """Test checksum(), composite_checksum() and multipart_etag().
+
+        1. Test SHA256.
+        2. Test CRC32.
+        3. Test composite checksum.
+        4. Test multipart ETag.
+        5. Test unsupported algorithm.
+        """
+        # 1.
+        self.assertEqual(checksum(b"test\n"), hashlib.sha256(b"test\n").digest())
+        # 2.
+        self.assertEqual(checksum(b"test\n", "CRC32"), (0x3BB935C6).to_bytes(4, "big"))
+        # 3.
+        digests = [hashlib.sha256(b"a").digest(), hashlib.sha256(b"b").digest()]
+        self.assertEqual(
+            composite_checksum(digests),
+            f"{base64.b64encode(hashlib.sha256(digests[0] + digests[1]).digest()).decode()}-2",
+        )
+        # 4.
+        md5s = [hashlib.md5(b"a").digest()]
+        self.assertEqual(multipart_etag(md5s), f'"{hashlib.md5(md5s[0]).hexdigest()}-1"')
+        # 5.
+        with self.assertRaises(ValueError):
+            checksum(b"test\n", "MD5")
+
+    def test_put_object(self):
+        """Test put_object().
+
+        1. Test upload and inline verification.
+        2. Test CRC32.
+        """
+        with open("put_object.test", "wb") as test_file:
+            test_file.write(self.data)
+        try:
+            # 1.
+            result = put_object(
+                self.s3, "put_object.test", "mybucket", "put-object", extra_args={"StorageClass": "STANDARD_IA"}
+            )
+            self.assertTrue(verify_upload(result))
+            self.assertEqual(self.s3.get_object(Bucket="mybucket", Key="put-object")["Body"].read(), self.data)
+            self.assertEqual(self.s3.head_object(Bucket="mybucket", Key="put-object")["StorageClass"], "STANDARD_IA")
+            # 2.
+            result = put_object(self.s3, "put_object.test", "mybucket", "put-object-crc", checksum_algorithm="CRC32")
+            self.assertTrue(verify_upload(result))
+        finally:
+            os.remove("put_object.test")
+
+    def test_upload_parts(self):
+        """Test upload_parts().
+
+        1. Test upload and inline verification.
+        2. Test failed part aborts the upload.
+        3. Test part buffers stay within the transfer budget and are all given back.
+        4. Test an upload sharing the budget with another keeps one part in flight and holds no more than two buffers.
+        """
+        # 1.
+        result = upload_parts(self.s3, io.BytesIO(self.data), "mybucket", "multipart", part_size=5 * MiB)
+        self.assertTrue(verify_upload(result))
+        self.assertTrue(result["ETag"].endswith('-3"'))
+        self.assertEqual(self.s3.get_object(Bucket="mybucket", Key="multipart")["Body"].read(), self.data)
+        # 2.
+        with patch(
+            "multipart_upload.upload_part",
+            autospec=True,
+            side_effect=Exception("These are not the droids you are looking for."),
+        ):
+            with self.assertRaises(Exception):
+                upload_parts(self.s3, io.BytesIO(self.data), "mybucket", "aborted", part_size=5 * MiB)
+        self.assertNotIn("Uploads", self.s3.list_multipart_uploads(Bucket="mybucket"))
+        # 3.
+        budget = TransferBudget(max_bytes=10 * MiB)
+        peak = []
+        acquire = budget.acquire
+
+        def track_peak(nbytes, timeout=None):
+            acquired = acquire(nbytes, timeout)
+            peak.append(budget.in_use)
+            return acquired
+
+        with patch.object(budget, "acquire", side_effect=track_peak):
+            result = upload_parts(
+                self.s3,
+                io.BytesIO(self.data),
+                "mybucket",
+                "budget",
+                part_size=5 * MiB,
+                max_concurrency=4,
+                budget=budget,
+            )
+        self.assertTrue(verify_upload(result))
+        self.assertLessEqual(max(peak), 10 * MiB)
+        self.assertEqual(budget.in_use, 0)
+        # 4.
+        budget = TransferBudget(max_bytes=15 * MiB)
+        budget.upload_started()
+        budget.upload_started()
+        acquire = budget.acquire
+        running = [0, 0]
+        lock = threading.Lock()
+        upload_part = multipart_upload.upload_part
+
+        def track_running(*args):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            try:
+                return upload_part(*args)
+            finally:
+                with lock:
+                    running[0] -= 1
+
+        peak.clear()
+        with patch("multipart_upload.upload_part", side_effect=track_running), patch.object(
+            budget, "acquire", side_effect=track_peak
+        ):
+            result = upload_parts(
+                self.s3,
+                io.BytesIO(self.data),
+                "mybucket",
+                "shared",
+                part_size=5 * MiB,
+                max_concurrency=3,
+                budget=budget,
+            )
+        self.assertTrue(verify_upload(result))
+        self.assertLessEqual(max(peak), 10 * MiB)
+        self.assertEqual(budget.in_use, 0)
+        self.assertEqual(running, [0, 1])
+
+    def test_upload_parts_budget_wait(self):
+        """Test upload_parts() waiting for a budget that never frees up.
+
+        1. Test the wait counts as progress for `BUDGET_WAIT_PROGRESS_SECONDS` only, and the stop event ends it.
+        """
+        budget = TransferBudget(max_bytes=5 * MiB)
+        budget.acquire(5 * MiB)
+        stop = threading.Event()
+        progress = []
+        started = time.monotonic()
+        timer = threading.Timer(0.6, stop.set)
+        timer.start()
+        # 1.
+        with patch("multipart_upload.BUDGET_WAIT_PROGRESS_SECONDS", 0.2), self.assertRaises(UploadInterrupted):
+            upload_parts(
+                self.s3,
+                io.BytesIO(self.data),
+                "mybucket",
+                "starved",
+                part_size=5 * MiB,
+                budget=budget,
+                stop=stop,
+                progress=lambda nbytes: progress.append(time.monotonic() - started),
+            )
+        timer.join()
+        self.assertTrue(progress)
+        self.assertLess(max(progress), 0.5)
+        self.assertEqual(budget.in_use, 5 * MiB)
+
+    def test_upload_parts_resume(self):
+        """Test journaled upload_parts() resumes.
+
+        1. Test a failed part keeps the multipart upload and journals the parts before it.
+        2. Test the next attempt only uploads the missing part and removes the journal.
+        3. Test the stop event journals the part in flight and raises UploadInterrupted.
+        4. Test a journal whose multipart upload is gone starts over.
+        """
+        os.mkdir("multipart_test_files", 0o777)
+        self.addCleanup(os.rmdir, "multipart_test_files")
+        file_name = "multipart_test_files/core-resume"
+        with open(file_name, "wb") as core_dump:
+            core_dump.write(self.data)
+        self.addCleanup(os.remove, file_name)
+        upload_part = multipart_upload.upload_part
+        calls = []
+
+        def fail_part_3(*args):
+            calls.append(args[4])
+            if args[4] == 3:
+                raise Exception("These are not the droids you are looking for.")
+            return upload_part(*args)
+
+        # 1.
+        with patch("multipart_upload.upload_part", side_effect=fail_part_3), open(file_name, "rb") as source:
+            with self.assertRaises(Exception), self.assertLogs(logger="multipart_upload", level="INFO"):
+                upload_parts(
+                    self.s3, source, "mybucket", "resume", 5 * MiB, max_concurrency=1, journal=UploadJournal(file_name)
+                )
+        self.assertEqual(len(self.s3.list_multipart_uploads(Bucket="mybucket")["Uploads"]), 1)
+        self.assertEqual(sorted(UploadJournal(file_name).load("mybucket", "resume", "SHA256")["Parts"]), ["1", "2"])
+        # 2.
+        calls.clear()
+        with patch("multipart_upload.upload_part", side_effect=upload_part) as mock_upload_part:
+            with open(file_name, "rb") as source, self.assertLogs(logger="multipart_upload", level="INFO"):
+                result = upload_parts(self.s3, source, "mybucket", "resume", 8 * MiB, journal=UploadJournal(file_name))
+            self.assertEqual([call.args[4] for call in mock_upload_part.call_args_list], [3])
+        self.assertTrue(verify_upload(result))
+        self.assertEqual(self.s3.get_object(Bucket="mybucket", Key="resume")["Body"].read(), self.data)
+        self.assertFalse(os.path.exists(UploadJournal(file_name).path))
+        # 3.
+        stop = threading.Event()
+
+        def stop_after_part(*args):
+            stop.set()
+            return upload_part(*args)
+
+        with patch("multipart_upload.upload_part", side_effect=stop_after_part), open(file_name, "rb") as source:
+            with self.assertRaises(UploadInterrupted), self.assertLogs(logger="multipart_upload", level="INFO"):
+                upload_parts(
+                    self.s3,
+                    source,
+                    "mybucket",
+                    "interrupted",
+                    5 * MiB,
+                    max_concurrency=1,
+                    journal=UploadJournal(file_name),
+                    stop=stop,
+                )
+        journal = UploadJournal(file_name)
+        self.assertEqual(list(journal.load("mybucket", "interrupted", "SHA256")["Parts"]), ["1"])
+        # 4.
+        self.s3.abort_multipart_upload(Bucket="mybucket", Key="interrupted", UploadId=journal.state["UploadId"])
+        with open(file_name, "rb") as source, self.assertLogs(logger="multipart_upload", level="WARNING"):
+            result = upload_parts(self.s3, source, "mybucket", "interrupted", 5 * MiB, journal=journal)
+        self.assertTrue(verify_upload(result))
+        self.assertEqual(self.s3.get_object(Bucket="mybucket", Key="interrupted")["Body"].read(), self.data)
+        os.rmdir("multipart_test_files/.upload_journal")
+
+    def test_verify_upload(self):
+        """Test verify_upload().
+
+        1. Test matching checksum returned by S3.
+        2. Test S3 checksum without the part count suffix.
+        3. Test mismatched checksum.
+        4. Test matching ETag.
+        5. Test unverifiable upload.
+        """
+        result = {"Algorithm": "SHA256", "Checksum": "abc=-2", "ETag": '"etag-2"', "Response": {}}
+        # 1.
+        self.assertTrue(verify_upload({**result, "Response": {"ChecksumSHA256": "abc=-2"}}))
+        # 2.
+        self.assertTrue(verify_upload({**result, "Response": {"ChecksumSHA256": "abc="}}))
+        # 3.
+        with self.assertRaises(ChecksumMismatchError):
+            verify_upload({**result, "Response": {"ChecksumSHA256": "xyz=-2"}})
+        # 4.
+        self.assertTrue(verify_upload({**result, "Response": {"ETag": '"etag-2"'}}))
+        # 5.
+        self.assertFalse(verify_upload({**result, "Response": {"ETag": '"kms-etag"'}}))
@@ -0,0 +1,188 @@
+import gzip
+import io
+import os
+import shutil
+import socket
+import threading
+import unittest
+from unittest.mock import Mock, patch
+from moto import mock_aws
+import boto3
+
+import multipart_upload
+from dedup import FingerprintCache
+from dump_index import DumpIndex
+from main import dispatch
+from pipe_ingest import compressed_parts, ingest_stream, serve
+from scheduler import QUEUED, UploadScheduler
+
+os.environ["REGION"] = "us-east-1"
+MiB = 1024 * 1024
+
+
+@mock_aws
+class TestPipeIngest(unittest.TestCase):
+    def setUp(self):
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="mybucket")
+        self.data = os.urandom(11 * MiB)
+        os.mkdir("pipe_test_files", 0o777)
+
+    def tearDown(self):
+        shutil.rmtree("pipe_test_files")
+
+    def get_object(self, key):
+        return self.s3.get_object(Bucket="mybucket", Key=key)["Body"].read()
+
+    def test_compressed_parts(self):
+        """Test compressed_parts().
+
+        1. Test every part but the last is part_size and the parts decompress to the input.
+        2. Test empty stream.
+        """
+        # 1.
+        parts = list(compressed_parts(io.BytesIO(self.data), part_size=5 * MiB))
+        self.assertEqual([len(part) for part in parts[:-1]], [5 * MiB] * (len(parts) - 1))
+        self.assertEqual(gzip.decompress(b"".join(parts)), self.data)
+        # 2.
+        self.assertEqual(gzip.decompress(b"".join(compressed_parts(io.BytesIO(b"")))), b"")
+
+    def test_ingest_stream(self):
+        """Test ingest_stream().
+
+        1. Test small dump in a single request.
+        2. Test multipart dump.
+        3. Test nothing but the index is written to disk.
+        """
+        # 1.
+        with self.assertLogs(logger="pipe_ingest", level="INFO"):
+            self.assertEqual(
+                ingest_stream(io.BytesIO(b"test\n"), "core-small", "pipe_test_files", bucket="mybucket"),
+                "s3://mybucket/core-small.gz",
+            )
+        self.assertEqual(gzip.decompress(self.get_object("core-small.gz")), b"test\n")
+        # 2.
+        self.assertEqual(
+            ingest_stream(io.BytesIO(self.data), "core-big", "pipe_test_files", bucket="mybucket", part_size=5 * MiB),
+            "s3://mybucket/core-big.gz",
+        )
+        self.assertEqual(gzip.decompress(self.get_object("core-big.gz")), self.data)
+        # 3.
+        self.assertEqual(os.listdir("pipe_test_files"), [".dump_index"])
+        records = DumpIndex("pipe_test_files").records()
+        self.assertEqual([entry["name"] for entry in records], ["core-small.gz", "core-big.gz"])
+
+    def test_ingest_stream_spill(self):
+        """Test ingest_stream() spills to disk when S3 fails.
+
+        1. Test small dump is spilled when S3 is unreachable.
+        2. Test multipart dump is spilled when S3 is unreachable.
+        3. Test the rest of the stream is spilled when a part fails after the first part.
+        """
+        # 1.
+        with self.assertLogs(logger="pipe_ingest", level="ERROR"):
+            self.assertEqual(
+                ingest_stream(io.BytesIO(b"test\n"), "core-1", "pipe_test_files", bucket="wrongbucket"),
+                "pipe_test_files/core-1.gz",
+            )
+        with gzip.open("pipe_test_files/core-1.gz") as spilled:
+            self.assertEqual(spilled.read(), b"test\n")
+        # 2.
+        with self.assertLogs(logger="pipe_ingest", level="ERROR"):
+            self.assertEqual(
+                ingest_stream(
+                    io.BytesIO(self.data), "core-2", "pipe_test_files", bucket="wrongbucket", part_size=5 * MiB
+                ),
+                "pipe_test_files/core-2.gz",
+            )
+        with gzip.open("pipe_test_files/core-2.gz") as spilled:
+            self.assertEqual(spilled.read(), self.data)
+        # 3.
+        upload_part = multipart_upload.upload_part
+
+        def fail_after_first_part(*args):
+            if args[4] > 1:
+                raise multipart_upload.ChecksumMismatchError("These are not the droids you are looking for.")
+            return upload_part(*args)
+
+        with patch("multipart_upload.upload_part", side_effect=fail_after_first_part):
+            with self.assertLogs(logger="pipe_ingest", level="ERROR"):
+                self.assertEqual(
+                    ingest_stream(
+                        io.BytesIO(self.data), "core-3", "pipe_test_files", bucket="mybucket", part_size=5 * MiB
+                    ),
+                    "s3://mybucket/core-3.gz",
+                )
+        with open("pipe_test_files/core-3.gz.rest", "rb") as rest:
+            self.assertEqual(gzip.decompress(self.get_object("core-3.gz") + rest.read()), self.data)
+
+    def test_spill_dispatch(self):
+        """Test the watcher uploads the spilled rest of a stream as it is.
+
+        0. Setup.
+        1. Test the rest is queued even when its executable is sampled out.
+        2. Test the rest is neither deduplicated, triaged nor compressed again.
+        3. Test the two objects concatenated are the full compressed dump.
+        """
+        # 0.
+        upload_part = multipart_upload.upload_part
+
+        def fail_after_first_part(*args):
+            if args[4] > 1:
+                raise multipart_upload.ChecksumMismatchError("These are not the droids you are looking for.")
+            return upload_part(*args)
+
+        with patch("multipart_upload.upload_part", side_effect=fail_after_first_part):
+            with self.assertLogs(logger="pipe_ingest", level="ERROR"):
+                ingest_stream(io.BytesIO(self.data), "core-4", "pipe_test_files", bucket="mybucket", part_size=5 * MiB)
+        scheduler = UploadScheduler(keep_first=1, sample_every=1000)
+        scheduler.submit("core-4.gz", "pipe_test_files")
+        scheduler.forget("core-4.gz")
+        pool = Mock()
+        pool.apply_async.side_effect = lambda func, args, kwds, callback, error_callback, size: callback(
+            func(*args, bucket_name="mybucket", **kwds)
+        )
+        # 1.
+        self.assertEqual(scheduler.submit("core-4.gz.rest", "pipe_test_files"), QUEUED)
+        # 2.
+        with patch("compression.codec", return_value="gzip"), patch("triage.summarize") as summarize:
+            with self.assertLogs(logger="main", level="INFO"):
+                self.assertEqual(dispatch(scheduler, pool, FingerprintCache()), 1)
+        summarize.assert_not_called()
+        self.assertNotIn("fingerprint", pool.apply_async.call_args.kwargs["kwds"])
+        keys = [item["Key"] for item in self.s3.list_objects_v2(Bucket="mybucket")["Contents"]]
+        self.assertEqual(sorted(keys), ["core-4.gz", "core-4.gz.rest"])
+        self.assertFalse(os.path.exists("pipe_test_files/core-4.gz.rest"))
+        # 3.
+        self.assertEqual(gzip.decompress(self.get_object("core-4.gz") + self.get_object("core-4.gz.rest")), self.data)
+
+    def test_serve(self):
+        """Test serve().
+
+        1. Test a dump streamed over the socket is uploaded.
+        2. Test names that do not start with `core` are refused.
+        """
+        socket_path = "pipe_test_files/test.sock"
+        with patch("pipe_ingest.ingest_stream", autospec=True, return_value="s3://mybucket/core-sock.gz") as ingest:
+            threading.Thread(target=serve, args=[socket_path, "pipe_test_files"], daemon=True).start()
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                threading.Event().wait(0.05)
+            # 1.
+            with self.assertLogs(logger="pipe_ingest", level="INFO") as captured_logs:
+                with socket.socket(socket.AF_UNIX) as client:
+                    client.connect(socket_path)
+                    client.sendall(b"core-sock\ntest\n")
+                    client.shutdown(socket.SHUT_WR)
+                    client.recv(1)
+                self.assertIn("INFO:pipe_ingest:s3://mybucket/core-sock.gz", captured_logs.output)
+            self.assertEqual(ingest.call_args.args[1:], ("core-sock", "pipe_test_files"))
+            # 2.
+            with self.assertLogs(logger="pipe_ingest", level="ERROR"):
+                with socket.socket(socket.AF_UNIX) as client:
+                    client.connect(socket_path)
+                    client.sendall(b"../../etc/passwd\n")
+                    client.shutdown(socket.SHUT_WR)
+                    client.recv(1)
+            self.assertEqual(ingest.call_count, 1)
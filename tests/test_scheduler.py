@@ -0,0 +1,239 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from scheduler import DEFERRED, DROPPED, DUPLICATE, QUEUED, SAMPLED, UploadScheduler, parse_core_file_name
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        os.mkdir("scheduler_test_files", 0o777)
+
+    def tearDown(self):
+        for file in os.listdir("scheduler_test_files"):
+            os.remove(f"scheduler_test_files/{file}")
+        os.rmdir("scheduler_test_files")
+
+    def drain(self, scheduler):
+        names = []
+        while (item := scheduler.next()) is not None:
+            names.append(item[0])
+            scheduler.task_done(item[0])
+        return names
+
+    def test_parse_core_file_name(self):
+        """Test parse_core_file_name().
+
+        1. Test executable names with dashes and a `.gz` suffix.
+        2. Test names that do not follow the pattern.
+        """
+        # 1.
+        self.assertEqual(
+            parse_core_file_name("core-my-app-1700000000-42-11.gz"),
+            {"exe": "my-app", "time": 1700000000, "pid": 42, "signal": 11},
+        )
+        # 2.
+        self.assertIsNone(parse_core_file_name("core.1234"))
+
+    def test_priority(self):
+        """Test the queue order.
+
+        1. Test smallest first.
+        2. Test by signal, then smallest first.
+        3. Test first in first out.
+        """
+        dumps = [("core-a-1-1-3", 10), ("core-b-1-2-11", 30), ("core-c-1-3-6", 20), ("core-d-1-4-11", 5)]
+        # 1.
+        scheduler = UploadScheduler(priority="smallest", keep_first=0)
+        for name, size in dumps:
+            self.assertEqual(scheduler.submit(name, "scheduler_test_files", size=size), QUEUED)
+        self.assertEqual(self.drain(scheduler), ["core-d-1-4-11", "core-a-1-1-3", "core-c-1-3-6", "core-b-1-2-11"])
+        # 2.
+        scheduler = UploadScheduler(priority="signal", keep_first=0)
+        for name, size in dumps:
+            scheduler.submit(name, "scheduler_test_files", size=size)
+        self.assertEqual(self.drain(scheduler), ["core-d-1-4-11", "core-b-1-2-11", "core-c-1-3-6", "core-a-1-1-3"])
+        # 3.
+        scheduler = UploadScheduler(priority="fifo", keep_first=0)
+        for name, size in dumps:
+            scheduler.submit(name, "scheduler_test_files", size=size)
+        self.assertEqual(self.drain(scheduler), [name for name, _ in dumps])
+        with self.assertRaises(ValueError):
+            UploadScheduler(priority="largest")
+
+    def test_sampling(self):
+        """Test a crash looping executable is sampled.
+
+        1. Test the first dumps and every Mth after them are queued, the rest sampled out and never handed out.
+        2. Test other executables are not affected.
+        3. Test the window starts over.
+        4. Test sampled out dumps are deleted with the "drop" policy.
+        """
+        scheduler = UploadScheduler(keep_first=2, sample_every=3, window_seconds=600, overflow_policy="defer")
+        # 1.
+        with self.assertLogs(logger="scheduler", level="INFO"):
+            outcomes = [scheduler.submit(f"core-loop-1-{pid}-11", "scheduler_test_files") for pid in range(8)]
+        self.assertEqual(outcomes, [QUEUED, QUEUED, SAMPLED, SAMPLED, QUEUED, SAMPLED, SAMPLED, QUEUED])
+        self.assertEqual((scheduler.queued, scheduler.deferred), (4, 0))
+        # 2.
+        self.assertEqual(scheduler.submit("core-other-1-1-11", "scheduler_test_files"), QUEUED)
+        # 3.
+        scheduler.window_seconds = 0
+        self.assertEqual(scheduler.submit("core-loop-1-99-11", "scheduler_test_files"), QUEUED)
+        # 4.
+        scheduler = UploadScheduler(keep_first=1, sample_every=3, sample_policy="drop")
+        for pid in range(2):
+            with open(f"scheduler_test_files/core-loop-1-{pid}-11", "w", encoding="utf-8") as core_dump:
+                core_dump.write("test\n")
+        self.assertEqual(scheduler.submit("core-loop-1-0-11", "scheduler_test_files"), QUEUED)
+        with self.assertLogs(logger="scheduler", level="WARNING"):
+            self.assertEqual(scheduler.submit("core-loop-1-1-11", "scheduler_test_files"), DROPPED)
+        self.assertEqual(os.listdir("scheduler_test_files"), ["core-loop-1-0-11"])
+
+    def test_overflow(self):
+        """Test a full queue.
+
+        1. Test the largest dump is deferred and only handed out once the queue is empty.
+        2. Test the largest dump is dropped and deleted.
+        3. Test duplicates are ignored.
+        4. Test the largest deferred dump is dropped once too many are deferred.
+        """
+        # 1.
+        scheduler = UploadScheduler(max_queue=2, keep_first=0, overflow_policy="defer")
+        scheduler.submit("core-a-1-1-11", "scheduler_test_files", size=30)
+        scheduler.submit("core-b-1-2-11", "scheduler_test_files", size=10)
+        self.assertEqual(scheduler.submit("core-c-1-3-11", "scheduler_test_files", size=20), QUEUED)
+        self.assertEqual((scheduler.queued, scheduler.deferred), (2, 1))
+        self.assertEqual(self.drain(scheduler), ["core-b-1-2-11", "core-c-1-3-11", "core-a-1-1-11"])
+        # 2.
+        scheduler = UploadScheduler(max_queue=1, keep_first=0, overflow_policy="drop")
+        for name in ("core-a-1-1-11", "core-b-1-2-11"):
+            with open(f"scheduler_test_files/{name}", "w", encoding="utf-8") as core_dump:
+                core_dump.write("test\n")
+        scheduler.submit("core-a-1-1-11", "scheduler_test_files", size=10)
+        with self.assertLogs(logger="scheduler", level="WARNING"):
+            self.assertEqual(scheduler.submit("core-b-1-2-11", "scheduler_test_files", size=20), DROPPED)
+        self.assertEqual(os.listdir("scheduler_test_files"), ["core-a-1-1-11"])
+        # 3.
+        self.assertEqual(scheduler.submit("core-a-1-1-11", "scheduler_test_files", size=10), DUPLICATE)
+        # 4.
+        scheduler = UploadScheduler(max_queue=1, max_deferred=1, keep_first=0, overflow_policy="defer")
+        with open("scheduler_test_files/core-c-1-3-11", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        scheduler.submit("core-b-1-2-11", "scheduler_test_files", size=10)
+        self.assertEqual(scheduler.submit("core-c-1-3-11", "scheduler_test_files", size=30), DEFERRED)
+        with self.assertLogs(logger="scheduler", level="WARNING"):
+            self.assertEqual(scheduler.submit("core-d-1-4-11", "scheduler_test_files", size=20), DEFERRED)
+        self.assertEqual(scheduler.deferred, 1)
+        self.assertEqual(sorted(os.listdir("scheduler_test_files")), ["core-a-1-1-11"])
+        self.assertEqual(self.drain(scheduler), ["core-b-1-2-11", "core-d-1-4-11"])
+
+    def test_max_in_flight(self):
+        """Test next() stops handing out dumps while the pool is full.
+
+        1. Test the limit.
+        2. Test task_done() frees a slot.
+        """
+        scheduler = UploadScheduler(max_in_flight=2, keep_first=0)
+        for pid in range(3):
+            scheduler.submit(f"core-a-1-{pid}-11", "scheduler_test_files")
+        # 1.
+        self.assertIsNotNone(scheduler.next())
+        self.assertEqual(scheduler.next(), ("core-a-1-1-11", "scheduler_test_files"))
+        self.assertIsNone(scheduler.next())
+        self.assertEqual(scheduler.in_flight, 2)
+        # 2.
+        scheduler.task_done("core-a-1-1-11")
+        self.assertEqual(scheduler.next(), ("core-a-1-2-11", "scheduler_test_files"))
+
+    def test_backlog(self):
+        """Test backlog dumps.
+
+        1. Test backlog dumps are neither sampled nor bounded.
+        2. Test queued dumps go first and backlog dumps only get their share of the pool.
+        3. Test backlog dumps already known are duplicates.
+        """
+        scheduler = UploadScheduler(max_queue=1, max_in_flight=3, keep_first=1, max_backlog_in_flight=1)
+        # 1.
+        for pid in range(3):
+            self.assertEqual(scheduler.submit(f"core-a-1-{pid}-11", "scheduler_test_files", backlog=True), QUEUED)
+        self.assertEqual(scheduler.backlog, 3)
+        # 2.
+        scheduler.submit("core-b-1-1-11", "scheduler_test_files")
+        self.assertEqual(scheduler.next()[0], "core-b-1-1-11")
+        self.assertEqual(scheduler.next()[0], "core-a-1-0-11")
+        self.assertIsNone(scheduler.next())
+        scheduler.task_done("core-a-1-0-11")
+        self.assertEqual(scheduler.next()[0], "core-a-1-1-11")
+        # 3.
+        self.assertEqual(scheduler.submit("core-a-1-1-11", "scheduler_test_files", backlog=True), DUPLICATE)
+        self.assertEqual(scheduler.submit("core-a-1-2-11", "scheduler_test_files"), DUPLICATE)
+
+    def test_pressure(self):
+        """Test disk pressure.
+
+        1. Test the newest dumps go first under pressure and the usual order comes back after.
+        2. Test forget() takes a waiting dump out, but not one with a worker.
+        """
+        scheduler = UploadScheduler(max_in_flight=1)
+        # 1.
+        scheduler.submit("core-a-1-1-11", "scheduler_test_files", size=1)
+        scheduler.submit("core-b-1-1-11", "scheduler_test_files", size=3)
+        scheduler.submit("core-c-1-1-11", "scheduler_test_files", size=2)
+        scheduler.set_pressure(True)
+        item = scheduler.next()
+        self.assertEqual(item[0], "core-c-1-1-11")
+        scheduler.task_done(item[0])
+        scheduler.set_pressure(False)
+        self.assertEqual(self.drain(scheduler), ["core-a-1-1-11", "core-b-1-1-11"])
+        # 2.
+        scheduler.submit("core-d-1-1-11", "scheduler_test_files")
+        scheduler.submit("core-e-1-1-11", "scheduler_test_files", backlog=True)
+        self.assertEqual(scheduler.next()[0], "core-d-1-1-11")
+        self.assertTrue(scheduler.is_in_flight("core-d-1-1-11"))
+        self.assertFalse(scheduler.forget("core-d-1-1-11"))
+        self.assertTrue(scheduler.forget("core-e-1-1-11"))
+        self.assertEqual(scheduler.backlog, 0)
+        scheduler.task_done("core-d-1-1-11")
+        self.assertIsNone(scheduler.next())
+
+    def test_retry(self):
+        """Test retries of failed uploads.
+
+        1. Test a failed dump is handed out again once its backoff has passed.
+        2. Test the backoff doubles up to `max_retry_seconds`.
+        3. Test the dump is given up after `max_attempts` failures.
+        4. Test forget() takes a dump waiting for its retry out.
+        """
+        scheduler = UploadScheduler(max_attempts=4, retry_seconds=10, max_retry_seconds=25)
+        scheduler.submit("core-a-1-1-11", "scheduler_test_files", size=5)
+        with patch("scheduler.random.uniform", return_value=1.0), patch("scheduler.time.monotonic") as monotonic:
+            monotonic.return_value = 0
+            # 1.
+            self.assertEqual(scheduler.next()[0], "core-a-1-1-11")
+            self.assertEqual(scheduler.retry("core-a-1-1-11", "scheduler_test_files", size=5), 10)
+            self.assertEqual((scheduler.in_flight, scheduler.retrying), (0, 1))
+            self.assertEqual(scheduler.submit("core-a-1-1-11", "scheduler_test_files"), DUPLICATE)
+            monotonic.return_value = 9
+            self.assertIsNone(scheduler.next())
+            monotonic.return_value = 10
+            self.assertEqual(scheduler.next(), ("core-a-1-1-11", "scheduler_test_files"))
+            # 2.
+            self.assertEqual(scheduler.retry("core-a-1-1-11", "scheduler_test_files"), 20)
+            monotonic.return_value = 30
+            self.assertEqual(scheduler.next()[0], "core-a-1-1-11")
+            self.assertEqual(scheduler.retry("core-a-1-1-11", "scheduler_test_files"), 25)
+            monotonic.return_value = 55
+            self.assertEqual(scheduler.next()[0], "core-a-1-1-11")
+            # 3.
+            self.assertIsNone(scheduler.retry("core-a-1-1-11", "scheduler_test_files"))
+            self.assertEqual((scheduler.in_flight, scheduler.retrying), (0, 0))
+            self.assertIsNone(scheduler.next())
+            # 4.
+            scheduler.submit("core-b-1-1-11", "scheduler_test_files")
+            scheduler.next()
+            scheduler.retry("core-b-1-1-11", "scheduler_test_files")
+            self.assertTrue(scheduler.forget("core-b-1-1-11"))
+            self.assertEqual(scheduler.retrying, 0)
+            monotonic.return_value = 1000
+            self.assertIsNone(scheduler.next())
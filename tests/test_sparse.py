@@ -0,0 +1,138 @@
+import io
+import json
+import os
+import shutil
+import unittest
+from moto import mock_aws
+import boto3
+
+from sparse import ExtentReader, data_extents, extent_map, fetch, restore
+from upload_file_2_s3 import upload_file
+
+os.environ["REGION"] = "us-east-1"
+SIZE = 16 * 1024 * 1024
+BLOCK = 64 * 1024
+
+
+def write_sparse(file_name: str):
+    with open(file_name, "wb") as core_dump:
+        core_dump.truncate(SIZE)
+        for offset, fill in ((1024 * 1024, b"a"), (8 * 1024 * 1024, b"b")):
+            core_dump.seek(offset)
+            core_dump.write(fill * BLOCK)
+
+
+@mock_aws
+class TestSparse(unittest.TestCase):
+    def setUp(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="mybucket")
+        os.mkdir("sparse_test_files", 0o777)
+        write_sparse("sparse_test_files/core-sparse")
+        with open("sparse_test_files/core-dense", "wb") as core_dump:
+            core_dump.write(os.urandom(BLOCK))
+        self.extents = data_extents("sparse_test_files/core-sparse")
+        if self.extents is None:
+            self.skipTest("The filesystem does not report holes.")
+
+    def tearDown(self):
+        shutil.rmtree("sparse_test_files")
+
+    def test_data_extents(self):
+        """Test data_extents().
+
+        1. Test the data extents of a sparse file are found.
+        2. Test dense files are not sparse.
+        3. Test files with too few holes are not sparse.
+        """
+        # 1.
+        self.assertEqual(sum(length for _, length in self.extents), 2 * BLOCK)
+        self.assertEqual([offset for offset, _ in self.extents], [1024 * 1024, 8 * 1024 * 1024])
+        # 2.
+        self.assertIsNone(data_extents("sparse_test_files/core-dense"))
+        # 3.
+        self.assertIsNone(data_extents("sparse_test_files/core-sparse", min_savings=0.999))
+
+    def test_extent_reader(self):
+        """Test ExtentReader.
+
+        1. Test the data extents are read back to back.
+        2. Test reads across an extent boundary.
+        3. Test seeking.
+        """
+        with ExtentReader("sparse_test_files/core-sparse", self.extents) as reader:
+            # 1.
+            self.assertEqual(reader.read(), b"a" * BLOCK + b"b" * BLOCK)
+            self.assertEqual(reader.read(), b"")
+            # 2.
+            reader.seek(BLOCK - 2)
+            buffer = bytearray(4)
+            self.assertEqual(reader.readinto(buffer), 4)
+            self.assertEqual(bytes(buffer), b"aabb")
+            # 3.
+            self.assertEqual(reader.seek(BLOCK, os.SEEK_CUR), 2 * BLOCK)
+            self.assertEqual(reader.seek(-1, os.SEEK_END), 2 * BLOCK - 1)
+            self.assertEqual(reader.tell(), 2 * BLOCK - 1)
+
+    def test_restore(self):
+        """Test restore().
+
+        1. Test the original file is rebuilt.
+        2. Test short packed data.
+        3. Test unknown extent map versions.
+        """
+        dump_map = json.loads(extent_map(SIZE, self.extents, "core-sparse.sparse"))
+        # 1.
+        with self.assertLogs(logger="sparse", level="INFO"):
+            written = restore(dump_map, io.BytesIO(b"a" * BLOCK + b"b" * BLOCK), "sparse_test_files/core-restored")
+        self.assertEqual(written, 2 * BLOCK)
+        with open("sparse_test_files/core-sparse", "rb") as original:
+            with open("sparse_test_files/core-restored", "rb") as restored:
+                self.assertEqual(original.read(), restored.read())
+        # 2.
+        with self.assertRaises(EOFError):
+            restore(dump_map, io.BytesIO(b"a" * BLOCK), "sparse_test_files/core-restored")
+        # 3.
+        with self.assertRaises(ValueError):
+            restore(dict(dump_map, version=2), io.BytesIO(), "sparse_test_files/core-restored")
+
+    def test_upload_and_fetch(self):
+        """Test upload_file() with a sparse file and fetch().
+
+        1. Test only the data extents and the extent map are uploaded.
+        2. Test multipart uploads of the data extents.
+        3. Test the dump is restored from S3.
+        """
+        mock_s3_client = boto3.client("s3", region_name="us-east-1")
+        # 1.
+        self.assertEqual(
+            upload_file(file_name="sparse_test_files/core-sparse", bucket="mybucket"),
+            "s3://mybucket/core-sparse.sparse.json",
+        )
+        self.assertFalse(os.path.exists("sparse_test_files/core-sparse"))
+        objects = {item["Key"]: item["Size"] for item in mock_s3_client.list_objects_v2(Bucket="mybucket")["Contents"]}
+        self.assertEqual(objects["core-sparse.sparse"], 2 * BLOCK)
+        self.assertEqual(sorted(objects), ["core-sparse.sparse", "core-sparse.sparse.json"])
+        # 2.
+        write_sparse("sparse_test_files/core-multipart")
+        upload_file(
+            file_name="sparse_test_files/core-multipart",
+            bucket="mybucket",
+            multipart_threshold=BLOCK,
+            part_size=5 * 1024 * 1024,
+        )
+        # 3.
+        for name in ("core-sparse", "core-multipart"):
+            with self.assertLogs(logger="sparse", level="INFO"):
+                self.assertEqual(fetch("mybucket", f"{name}.sparse.json", f"sparse_test_files/{name}"), 2 * BLOCK)
+            self.assertEqual(os.path.getsize(f"sparse_test_files/{name}"), SIZE)
+            with open(f"sparse_test_files/{name}", "rb") as restored:
+                restored.seek(8 * 1024 * 1024)
+                self.assertEqual(restored.read(BLOCK), b"b" * BLOCK)
+            write_sparse("sparse_test_files/core-original")
+            with open("sparse_test_files/core-original", "rb") as original:
+                with open(f"sparse_test_files/{name}", "rb") as restored:
+                    self.assertEqual(original.read(), restored.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from stall_watchdog import ProgressTable, StallWatchdog
+
+
+class TestStallWatchdog(unittest.TestCase):
+    def test_progress_table(self):
+        """Test ProgressTable.
+
+        1. Test progress adds up and resets the idle time.
+        2. Test the stop event is set by a cancel or by the shutdown.
+        3. Test waiting on the stop event.
+        4. Test a slot's clock only runs once it is started, and waiting on the stop event is progress.
+        """
+        progress = ProgressTable(2)
+        # 1.
+        with patch("stall_watchdog.time.monotonic", return_value=100):
+            progress.reset(1)
+            progress.start(1)
+            progress.advance(1, 5)
+            progress.advance(1, 7)
+        self.assertEqual(progress.sent(1), 12)
+        self.assertEqual(progress.idle(1, now=130), 30)
+        # 2.
+        shutdown = threading.Event()
+        stop = progress.stop_event(1, shutdown)
+        self.assertFalse(stop.is_set())
+        progress.cancel(1)
+        self.assertTrue(stop.is_set())
+        progress.reset(1)
+        self.assertFalse(stop.is_set())
+        shutdown.set()
+        self.assertTrue(stop.is_set())
+        # 3.
+        self.assertTrue(stop.wait(timeout=1))
+        self.assertFalse(progress.stop_event(0).wait(timeout=0.2))
+        # 4.
+        progress.reset(0)
+        self.assertFalse(progress.started(0))
+        self.assertEqual(progress.idle(0, now=1e9), 0)
+        with patch("stall_watchdog.time.monotonic", return_value=100):
+            progress.start(0)
+        self.assertEqual(progress.idle(0, now=130), 30)
+        self.assertFalse(progress.stop_event(0).wait(timeout=0.05))
+        self.assertLess(progress.idle(0), 1)
+        self.assertEqual(progress.sent(0), 0)
+
+    def test_check(self):
+        """Test StallWatchdog.check() and StallWatchdog.hung().
+
+        1. Test uploads making progress are left alone.
+        2. Test an upload without progress for `stall_seconds` is cancelled once.
+        3. Test a cancelled upload still running after `grace_seconds` is hung.
+        4. Test a finished upload frees its slot.
+        5. Test an upload no worker picked up yet is never cancelled.
+        """
+        progress = ProgressTable(2)
+        watchdog = StallWatchdog(progress, stall_seconds=60, grace_seconds=30)
+        first = watchdog.track("core-a-1-1-11")
+        second = watchdog.track("core-b-1-1-11")
+        with patch("stall_watchdog.time.monotonic", return_value=1):
+            progress.start(first)
+            progress.start(second)
+        self.assertIsNone(watchdog.track("core-c-1-1-11"))
+        # 1.
+        with patch("stall_watchdog.time.monotonic", return_value=51):
+            progress.advance(second, 1024)
+        self.assertEqual(watchdog.check(now=60), [])
+        # 2.
+        with self.assertLogs(logger="stall_watchdog", level="WARNING"):
+            self.assertEqual(watchdog.check(now=61), ["core-a-1-1-11"])
+        self.assertTrue(progress.cancelled(first))
+        self.assertFalse(progress.cancelled(second))
+        self.assertEqual(watchdog.check(now=62), [])
+        # 3.
+        self.assertEqual(watchdog.hung(now=90), [])
+        self.assertEqual(watchdog.hung(now=91), ["core-a-1-1-11"])
+        # 4.
+        watchdog.untrack(first)
+        watchdog.untrack(None)
+        self.assertEqual((watchdog.running, watchdog.hung(now=91)), (1, []))
+        self.assertEqual(watchdog.track("core-c-1-1-11"), first)
+        self.assertFalse(progress.cancelled(first))
+        # 5.
+        watchdog.untrack(second)
+        self.assertEqual(watchdog.check(now=1e9), [])
+        self.assertFalse(progress.cancelled(first))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,190 @@
+import io
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from moto import mock_aws
+import boto3
+
+import upload_file_2_s3
+from stall_watchdog import ProgressTable, TaskStop
+from throttle import Throttle, ThrottledReader, TokenBucket, lower_priority
+from upload_file_2_s3 import upload_file
+
+os.environ["REGION"] = "us-east-1"
+
+
+def take_in_child(bucket: TokenBucket):
+    bucket.take(500)
+
+
+@mock_aws
+class TestThrottle(unittest.TestCase):
+    def setUp(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="mybucket")
+        os.mkdir("throttle_test_files", 0o777)
+        self.addCleanup(upload_file_2_s3.configure)
+
+    def tearDown(self):
+        shutil.rmtree("throttle_test_files")
+
+    def test_token_bucket(self):
+        """Test TokenBucket.
+
+        1. Test a full bucket lets a burst through without waiting.
+        2. Test a request beyond the tokens left waits for them.
+        3. Test a stop event cuts the wait short.
+        4. Test a disabled bucket never waits.
+        """
+        bucket = TokenBucket(rate=10000)
+        # 1.
+        self.assertEqual(bucket.take(10000), 0)
+        # 2.
+        started = time.monotonic()
+        self.assertAlmostEqual(bucket.take(2000), 0.2, delta=0.05)
+        self.assertGreaterEqual(time.monotonic() - started, 0.15)
+        self.assertAlmostEqual(bucket.waited, 0.2, delta=0.05)
+        # 3.
+        stop = threading.Event()
+        stop.set()
+        started = time.monotonic()
+        bucket.take(100000, stop)
+        self.assertLess(time.monotonic() - started, 1)
+        # 4.
+        self.assertEqual(TokenBucket().take(10**12), 0)
+
+    def test_token_bucket_processes(self):
+        """Test the tokens are shared with forked processes.
+
+        1. Test tokens taken in a child are missing in the parent.
+        """
+        context = multiprocessing.get_context("fork")
+        bucket = TokenBucket(rate=1000, context=context)
+        # 1.
+        child = context.Process(target=take_in_child, args=(bucket,))
+        child.start()
+        child.join()
+        self.assertAlmostEqual(bucket.take(1000), 0.5, delta=0.1)
+
+    def test_adaptive_backoff(self):
+        """Test Throttle.observe().
+
+        1. Test requests at the usual latency keep the configured rate.
+        2. Test the rate is halved while latency is up.
+        3. Test the rate recovers with latency.
+        4. Test adaptive backoff is off without a network rate.
+        """
+        upload_throttle = Throttle(network_bytes_per_second=1000, adaptive=True)
+        with patch("throttle.ADJUST_SECONDS", 0):
+            # 1.
+            for _ in range(5):
+                upload_throttle.observe(8 * 1024 * 1024, 1.0)
+            self.assertEqual(upload_throttle.network.factor, 1.0)
+            # 2.
+            with self.assertLogs(logger="throttle", level="INFO"):
+                for _ in range(5):
+                    upload_throttle.observe(8 * 1024 * 1024, 4.0)
+            self.assertLess(upload_throttle.network.factor, 1.0)
+            self.assertEqual(upload_throttle.network.current_rate, 1000 * upload_throttle.network.factor)
+            # 3.
+            for _ in range(20):
+                upload_throttle.observe(8 * 1024 * 1024, 1.0)
+            self.assertEqual(upload_throttle.network.factor, 1.0)
+        # 4.
+        with self.assertLogs(logger="throttle", level="WARNING"):
+            self.assertFalse(Throttle(adaptive=True).adaptive)
+
+    def test_throttled_reader(self):
+        """Test ThrottledReader.
+
+        1. Test reads pass through and take tokens.
+        2. Test seek() and tell().
+        """
+        bucket = TokenBucket(rate=10**9)
+        reader = ThrottledReader(io.BytesIO(b"test\n" * 10), bucket)
+        # 1.
+        buffer = bytearray(20)
+        with patch.object(bucket, "take") as take:
+            self.assertEqual(reader.readinto(buffer), 20)
+            self.assertEqual(reader.read(), b"test\n" * 6)
+        self.assertEqual([call.args[0] for call in take.call_args_list], [20, 30])
+        # 2.
+        self.assertEqual(reader.seek(5), 5)
+        self.assertEqual(reader.tell(), 5)
+        reader.close()
+
+    def test_lower_priority(self):
+        """Test lower_priority().
+
+        1. Test the nice value is raised.
+        2. Test unknown IO classes.
+        3. Test settings that would raise a priority are refused.
+        """
+        # 1.
+        with patch("os.nice") as nice:
+            lower_priority(niceness=5, io_class="off")
+        nice.assert_called_once_with(5)
+        # 2.
+        with self.assertRaises(ValueError):
+            lower_priority(niceness=0, io_class="fastest")
+        # 3.
+        for kwargs in ({"niceness": -5, "io_class": "off"}, {"io_class": "realtime"}, {"io_level": 0}):
+            with self.assertRaises(ValueError), patch("os.nice") as nice:
+                lower_priority(**{"niceness": 0, **kwargs})
+            nice.assert_not_called()
+
+    def test_upload_file_throttled(self):
+        """Test upload_file() is paced by the throttle.
+
+        1. Test a multipart upload is paced by the network and by the disk rate.
+        2. Test a single request upload takes network and disk tokens.
+        3. Test the disk reads of a watched upload are cut short by the upload's own stop event.
+        """
+        # 1.
+        for rates in ({"network_bytes_per_second": 8 * 1024 * 1024}, {"disk_bytes_per_second": 8 * 1024 * 1024}):
+            upload_throttle = Throttle(**rates)
+            upload_file_2_s3.configure(upload_throttle=upload_throttle)
+            with open("throttle_test_files/core-large", "wb") as core_dump:
+                core_dump.write(os.urandom(10 * 1024 * 1024))
+            upload_file(
+                file_name="throttle_test_files/core-large",
+                bucket="mybucket",
+                multipart_threshold=5 * 1024 * 1024,
+                part_size=5 * 1024 * 1024,
+                sparse_upload=False,
+            )
+            self.assertGreater(upload_throttle.network.waited + upload_throttle.disk.waited, 0.1)
+        # 2.
+        upload_throttle = Throttle(network_bytes_per_second=8 * 1024 * 1024, disk_bytes_per_second=8 * 1024 * 1024)
+        upload_file_2_s3.configure(upload_throttle=upload_throttle)
+        with open("throttle_test_files/core-small", "wb") as core_dump:
+            core_dump.write(os.urandom(1024 * 1024))
+        waited = upload_throttle.network.waited
+        with patch("throttle.TokenBucket.take", return_value=0) as take:
+            upload_file(file_name="throttle_test_files/core-small", bucket="mybucket")
+        self.assertEqual([call.args[0] for call in take.call_args_list], [1024 * 1024, 1024 * 1024])
+        self.assertEqual(upload_throttle.network.waited, waited)
+        # 3.
+        upload_throttle = Throttle(disk_bytes_per_second=8 * 1024 * 1024)
+        upload_file_2_s3.configure(upload_throttle=upload_throttle, progress=ProgressTable(1))
+        with open("throttle_test_files/core-watched", "wb") as core_dump:
+            core_dump.write(os.urandom(10 * 1024 * 1024))
+        with patch("throttle.TokenBucket.take", return_value=0) as take:
+            upload_file(
+                file_name="throttle_test_files/core-watched",
+                bucket="mybucket",
+                multipart_threshold=5 * 1024 * 1024,
+                part_size=5 * 1024 * 1024,
+                sparse_upload=False,
+                progress_slot=0,
+            )
+        self.assertTrue(take.call_args_list)
+        for call in take.call_args_list:
+            self.assertIsInstance(call.args[1], TaskStop)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+import io
+import multiprocessing
+import threading
+import unittest
+
+from transfer_budget import BufferPool, BufferReader, TransferBudget, readinto_full
+
+
+def hold_budget(budget, started, release):
+    budget.acquire(60)
+    started.set()
+    release.wait(10)
+    budget.release(60)
+
+
+def die_holding_budget(budget):
+    budget.upload_started()
+    budget.acquire(60)
+
+
+class ShortReads(io.RawIOBase):
+    def __init__(self, data):
+        self.data = data
+
+    def readinto(self, view):
+        count = min(3, len(view), len(self.data))
+        view[:count] = self.data[:count]
+        self.data = self.data[count:]
+        return count
+
+
+class TestTransferBudget(unittest.TestCase):
+    def test_transfer_budget(self):
+        """Test TransferBudget.
+
+        1. Test acquire and release.
+        2. Test acquire times out when the budget is used up.
+        3. Test a request larger than the budget is let through when nothing is in flight.
+        4. Test the budget is shared with other processes.
+        5. Test the budget of a process that died holding it is reclaimed.
+        """
+        budget = TransferBudget(max_bytes=100)
+        # 1.
+        self.assertTrue(budget.acquire(60))
+        self.assertEqual(budget.in_use, 60)
+        # 2.
+        self.assertFalse(budget.acquire(60, timeout=0.01))
+        budget.release(60)
+        self.assertEqual(budget.in_use, 0)
+        # 3.
+        self.assertTrue(budget.acquire(1000, timeout=0.01))
+        budget.release(1000)
+        # 4.
+        started = multiprocessing.Event()
+        release = multiprocessing.Event()
+        process = multiprocessing.Process(target=hold_budget, args=[budget, started, release])
+        process.start()
+        self.assertTrue(started.wait(10))
+        self.assertEqual(budget.in_use, 60)
+        self.assertFalse(budget.acquire(60, timeout=0.01))
+        release.set()
+        self.assertTrue(budget.acquire(60, timeout=10))
+        process.join()
+        budget.release(60)
+        # 5.
+        process = multiprocessing.Process(target=die_holding_budget, args=[budget])
+        process.start()
+        process.join()
+        self.assertEqual((budget.in_use, budget.active_uploads), (60, 1))
+        self.assertTrue(budget.acquire(20))
+        with self.assertLogs(logger="transfer_budget", level="WARNING"):
+            self.assertEqual(budget.reclaim(), 60)
+        self.assertEqual((budget.in_use, budget.active_uploads, budget.reclaim()), (20, 0, 0))
+        budget.release(20)
+
+    def test_buffer_pool(self):
+        """Test BufferPool.
+
+        1. Test buffers are reused.
+        2. Test allocations are charged to the budget.
+        3. Test buffers beyond the one kept idle and closed pools credit the budget.
+        4. Test the budget is shared between the running uploads.
+        5. Test `waiting` is called while the budget is used up.
+        6. Test the wait for the budget ends once `stop` is set.
+        """
+        budget = TransferBudget(max_bytes=100)
+        pool = BufferPool(budget=budget)
+        # 1.
+        buffer = pool.get(40)
+        pool.put(buffer)
+        self.assertIs(pool.get(40), buffer)
+        # 2.
+        other = pool.get(40)
+        self.assertEqual(budget.in_use, 80)
+        # 3.
+        pool.put(buffer)
+        pool.put(other)
+        self.assertEqual(budget.in_use, 40)
+        pool.close()
+        self.assertEqual(budget.in_use, 0)
+        # 4.
+        self.assertEqual(budget.share(), 100)
+        budget.upload_started()
+        budget.upload_started()
+        self.assertEqual(budget.share(), 50)
+        budget.upload_finished()
+        self.assertEqual(budget.share(), 100)
+        # 5.
+        self.assertTrue(budget.acquire(100))
+        waits = []
+
+        def waiting(seconds):
+            waits.append(seconds >= 0)
+            budget.release(100)
+
+        self.assertEqual(len(BufferPool(budget=budget).get(60, waiting=waiting)), 60)
+        self.assertEqual((waits, budget.in_use), ([True], 60))
+        # 6.
+        stop = threading.Event()
+        stop.set()
+        self.assertIsNone(BufferPool(budget=budget).get(60, stop=stop))
+        self.assertEqual(budget.in_use, 60)
+
+    def test_buffer_reader(self):
+        """Test BufferReader.
+
+        1. Test read.
+        2. Test seek and tell.
+        """
+        reader = BufferReader(memoryview(bytearray(b"0123456789"))[:8])
+        # 1.
+        self.assertEqual(len(reader), 8)
+        self.assertEqual(reader.read(3), b"012")
+        self.assertEqual(reader.read(), b"34567")
+        # 2.
+        self.assertEqual(reader.seek(0), 0)
+        self.assertEqual(reader.read(), b"01234567")
+        self.assertEqual(reader.seek(-2, 2), 6)
+        self.assertEqual(reader.tell(), 6)
+
+    def test_readinto_full(self):
+        """Test readinto_full().
+
+        1. Test short reads are looped over.
+        2. Test end of stream.
+        """
+        source = ShortReads(b"0123456789")
+        buffer = bytearray(8)
+        # 1.
+        self.assertEqual(readinto_full(source, memoryview(buffer)), 8)
+        self.assertEqual(buffer, b"01234567")
+        # 2.
+        self.assertEqual(readinto_full(source, memoryview(buffer)), 2)
+        self.assertEqual(readinto_full(source, memoryview(buffer)), 0)
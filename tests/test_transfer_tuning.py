@@ -0,0 +1,65 @@
+import unittest
+
+from transfer_tuning import MiB, ThroughputTuner, plan_transfer
+
+GiB = 1024 * MiB
+
+
+class TestTransferTuning(unittest.TestCase):
+    def test_plan_transfer(self):
+        """Test plan_transfer().
+
+        1. Test small files use a single request.
+        2. Test medium files use 8MiB parts with one connection per part.
+        3. Test huge files grow the part size.
+        4. Test concurrent uploads split the connections and the budget.
+        5. Test the 10,000 part limit wins over the budget.
+        6. Test the concurrency cap.
+        """
+        # 1.
+        self.assertLess(10 * MiB, plan_transfer(10 * MiB)["multipart_threshold"])
+        # 2.
+        self.assertEqual(
+            plan_transfer(50 * MiB), {"multipart_threshold": 16 * MiB, "part_size": 8 * MiB, "max_concurrency": 7}
+        )
+        # 3.
+        self.assertEqual(plan_transfer(20 * GiB)["part_size"], 21 * MiB)
+        self.assertEqual(plan_transfer(20 * GiB)["max_concurrency"], 20)
+        self.assertEqual(plan_transfer(20 * GiB, budget_bytes=64 * MiB)["max_concurrency"], 3)
+        # 4.
+        self.assertEqual(
+            plan_transfer(20 * GiB, active_uploads=4, budget_bytes=64 * MiB),
+            {"multipart_threshold": 16 * MiB, "part_size": 8 * MiB, "max_concurrency": 2},
+        )
+        # 5.
+        plan = plan_transfer(100 * GiB, active_uploads=4, budget_bytes=64 * MiB)
+        self.assertEqual(plan["part_size"], 11 * MiB)
+        self.assertLessEqual(100 * GiB / plan["part_size"], 10000)
+        # 6.
+        self.assertEqual(plan_transfer(1 * GiB, max_concurrency=3)["max_concurrency"], 3)
+
+    def test_throughput_tuner(self):
+        """Test ThroughputTuner.
+
+        1. Test small uploads are ignored.
+        2. Test the cap grows while connections add throughput.
+        3. Test the cap steps back once a connection stops adding throughput.
+        4. Test the cap probes up again after a while.
+        """
+        tuner = ThroughputTuner(max_concurrency=8, initial=2, explore_every=2)
+        # 1.
+        tuner.observe(1 * MiB, 1, 2)
+        self.assertEqual(tuner.cap, 2)
+        # 2.
+        tuner.observe(200 * MiB, 2, 2)
+        self.assertEqual(tuner.cap, 3)
+        tuner.observe(300 * MiB, 2, 3)
+        self.assertEqual(tuner.cap, 4)
+        # 3.
+        tuner.observe(300 * MiB, 2, 4)
+        self.assertEqual(tuner.cap, 3)
+        tuner.observe(300 * MiB, 2, 3)
+        self.assertEqual(tuner.cap, 3)
+        # 4.
+        tuner.observe(300 * MiB, 2, 3)
+        self.assertEqual(tuner.cap, 4)
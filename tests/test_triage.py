@@ -0,0 +1,191 @@
+import gzip
+import json
+import os
+import shutil
+import threading
+import unittest
+from concurrent.futures import wait
+from unittest.mock import patch
+from moto import mock_aws
+import boto3
+import botocore
+
+from helpers import build_core
+from triage import NotACore, summarize, tags
+from upload_file_2_s3 import EarlySummaries, upload_file
+
+os.environ["REGION"] = "us-east-1"
+
+
+@mock_aws
+class TestTriage(unittest.TestCase):
+    def setUp(self):
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="mybucket")
+        os.mkdir("triage_test_files", 0o777)
+        build_core("triage_test_files/core-myapp-1-4243-11")
+        with open("triage_test_files/core-myapp-1-4243-11", "rb") as core_dump:
+            with gzip.open("triage_test_files/core-myapp-1-4243-11.gz", "wb") as compressed:
+                compressed.write(core_dump.read())
+
+    def tearDown(self):
+        shutil.rmtree("triage_test_files")
+
+    def test_summarize(self):
+        """Test summarize().
+
+        1. Test the notes of a core dump are summarized.
+        2. Test gzip compressed core dumps.
+        3. Test signals sent by another process have no fault address.
+        4. Test files that are not core dumps.
+        """
+        # 1.
+        summary = summarize("triage_test_files/core-myapp-1-4243-11")
+        self.assertEqual(summary["machine"], "x86_64")
+        self.assertEqual(summary["signal"], 11)
+        self.assertEqual(summary["signal_name"], "SIGSEGV")
+        self.assertEqual(summary["fault_address"], "0xdead")
+        self.assertEqual(summary["executable"], "myapp")
+        self.assertEqual(summary["command_line"], "myapp --crash-me")
+        self.assertEqual((summary["pid"], summary["uid"]), (4243, 1000))
+        self.assertEqual(summary["crashing_thread"], 4243)
+        self.assertEqual(
+            summary["threads"],
+            [
+                {"tid": 4243, "signal": 11, "pc": "0x401136", "sp": "0x7ffd0000"},
+                {"tid": 4244, "signal": 0, "pc": "0x0", "sp": "0x0"},
+            ],
+        )
+        self.assertEqual(summary["auxv"], {"AT_PAGESZ": 4096, "AT_ENTRY": "0x401000"})
+        self.assertEqual(summary["mapped_files"], ["/usr/bin/myapp", "/lib/libc.so.6"])
+        self.assertEqual(summary["crash_location"], {"file": "/usr/bin/myapp", "offset": "0x1136"})
+        # 2.
+        compressed = summarize("triage_test_files/core-myapp-1-4243-11.gz")
+        self.assertEqual({**compressed, "dump": None, "size": None}, {**summary, "dump": None, "size": None})
+        # 3.
+        build_core("triage_test_files/core-killed", code=0)
+        self.assertNotIn("fault_address", summarize("triage_test_files/core-killed"))
+        # 4.
+        with open("triage_test_files/core-text", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        with self.assertRaises(NotACore):
+            summarize("triage_test_files/core-text")
+
+    def test_tags(self):
+        """Test tags().
+
+        1. Test the tag set of a summary.
+        2. Test characters S3 does not allow in tags are replaced.
+        """
+        # 1.
+        summary = summarize("triage_test_files/core-myapp-1-4243-11")
+        self.assertEqual(tags(summary), "signal=SIGSEGV&executable=myapp&pid=4243&machine=x86_64")
+        # 2.
+        self.assertEqual(tags({"executable": "my*app"}), "executable=my_app")
+
+    def test_upload_file_summary(self):
+        """Test upload_file() uploads a triage summary.
+
+        1. Test the summary is uploaded next to the dump and both are tagged.
+        2. Test files that are not core dumps are uploaded without a summary.
+        """
+        mock_s3_client = boto3.client("s3", region_name="us-east-1")
+        # 1.
+        with self.assertLogs(logger="upload_file_2_s3", level="INFO"):
+            upload_file(file_name="triage_test_files/core-myapp-1-4243-11.gz", bucket="mybucket")
+        summary = json.loads(
+            mock_s3_client.get_object(Bucket="mybucket", Key="core-myapp-1-4243-11.gz.summary.json")["Body"].read()
+        )
+        self.assertEqual(summary["signal_name"], "SIGSEGV")
+        self.assertEqual(summary["object"], "core-myapp-1-4243-11.gz")
+        for key in ("core-myapp-1-4243-11.gz", "core-myapp-1-4243-11.gz.summary.json"):
+            tag_set = mock_s3_client.get_object_tagging(Bucket="mybucket", Key=key)["TagSet"]
+            self.assertIn({"Key": "signal", "Value": "SIGSEGV"}, tag_set)
+        # 2.
+        with open("triage_test_files/core-text", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        upload_file(file_name="triage_test_files/core-text", bucket="mybucket")
+        keys = [item["Key"] for item in mock_s3_client.list_objects_v2(Bucket="mybucket")["Contents"]]
+        self.assertNotIn("core-text.summary.json", keys)
+
+    def test_early_summaries(self):
+        """Test EarlySummaries.
+
+        1. Test the summary of a dump is uploaded as soon as it is submitted, pointing to the dump's object.
+        2. Test a claimed dump is only tagged by upload_file().
+        3. Test a summary that is not started, still running or failed is left to the upload.
+        4. Test a discarded dump is deleted once its summary is up, and handed to the fallback if none reached S3.
+        """
+        mock_s3_client = boto3.client("s3", region_name="us-east-1")
+        file_name = "triage_test_files/core-myapp-1-4243-11.gz"
+        summaries = EarlySummaries(bucket="mybucket")
+        # 1.
+        with self.assertLogs(logger="upload_file_2_s3", level="INFO"):
+            summaries.submit(file_name)
+            wait(list(summaries._pending.values()))
+        summary = json.loads(
+            mock_s3_client.get_object(Bucket="mybucket", Key="core-myapp-1-4243-11.gz.summary.json")["Body"].read()
+        )
+        self.assertEqual(summary["object"], "core-myapp-1-4243-11.gz")
+        # 2.
+        self.assertTrue(summaries.claim(file_name))
+        self.assertFalse(summaries.claim(file_name))
+        with self.assertLogs(logger="upload_file_2_s3", level="INFO"), patch(
+            "upload_file_2_s3._upload_summary", autospec=True
+        ) as upload_summary:
+            upload_file(file_name=file_name, bucket="mybucket", summarized=True)
+        upload_summary.assert_not_called()
+        tag_set = mock_s3_client.get_object_tagging(Bucket="mybucket", Key="core-myapp-1-4243-11.gz")["TagSet"]
+        self.assertIn({"Key": "signal", "Value": "SIGSEGV"}, tag_set)
+        summaries.close()
+        # 3.
+        summaries = EarlySummaries(bucket="mybucket", threads=1)
+        started, release = threading.Event(), threading.Event()
+
+        def block(*args, **kwargs):
+            started.set()
+            release.wait(10)
+
+        with patch("upload_file_2_s3.upload_summary", side_effect=block):
+            summaries.submit("triage_test_files/core-first")
+            summaries.submit("triage_test_files/core-second")
+            self.assertTrue(started.wait(10))
+            self.assertFalse(summaries.claim("triage_test_files/core-second"))
+            self.assertFalse(summaries.claim("triage_test_files/core-first"))
+            release.set()
+        error = botocore.exceptions.ClientError({"Error": {"Code": "500"}}, "PutObject")
+        with self.assertLogs(logger="upload_file_2_s3", level="WARNING"), patch(
+            "multipart_upload.put_bytes", side_effect=error
+        ):
+            summaries.submit("triage_test_files/core-myapp-1-4243-11")
+            wait(list(summaries._pending.values()))
+        self.assertFalse(summaries.claim("triage_test_files/core-myapp-1-4243-11"))
+        summaries.close()
+        # 4.
+        summaries = EarlySummaries(bucket="mybucket")
+        with self.assertLogs(logger="upload_file_2_s3", level="INFO"):
+            summaries.submit("triage_test_files/core-myapp-1-4243-11")
+            future = summaries._pending["triage_test_files/core-myapp-1-4243-11"]
+            summaries.discard("triage_test_files/core-myapp-1-4243-11")
+            future.result()
+            summaries.close()
+        self.assertFalse(os.path.exists("triage_test_files/core-myapp-1-4243-11"))
+        mock_s3_client.head_object(Bucket="mybucket", Key="core-myapp-1-4243-11.summary.json")
+        build_core("triage_test_files/core-myapp-2-4243-11")
+        with open("triage_test_files/core-text", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        kept = []
+        summaries = EarlySummaries(bucket="mybucket")
+        with self.assertLogs(logger="upload_file_2_s3", level="WARNING"), patch(
+            "multipart_upload.put_bytes", side_effect=error
+        ):
+            for name in ("triage_test_files/core-myapp-2-4243-11", "triage_test_files/core-text"):
+                summaries.submit(name)
+                summaries.discard(name, fallback=kept.append)
+            summaries.close()
+        self.assertEqual(sorted(kept), ["triage_test_files/core-myapp-2-4243-11", "triage_test_files/core-text"])
+        self.assertTrue(os.path.exists("triage_test_files/core-myapp-2-4243-11"))
+        self.assertTrue(os.path.exists("triage_test_files/core-text"))
+
+
+if __name__ == "__main__":
+    unittest.main()
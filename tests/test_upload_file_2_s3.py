@@ -1,12 +1,17 @@
 import sys
 import os
+import shutil
+import signal
 import unittest
 from unittest.mock import patch
 from moto import mock_aws
 import boto3
 import botocore
 
-from upload_file_2_s3 import upload_file, check_if_exists
+import upload_file_2_s3
+from multipart_upload import UploadInterrupted
+from stall_watchdog import ProgressTable
+from upload_file_2_s3 import upload_file, check_if_exists, get_s3_client, init_worker
 
 os.environ["REGION"] = "us-east-1"
 
@@ -29,10 +34,10 @@ class TestCoreUploadFile2S3(unittest.TestCase):
         mock_s3_client.put_object(Bucket="myotherbucket", Body=bytes("test", "utf-8"), Key="core-test-5.gz")
 
     def tearDown(self):
-        for file in os.listdir("core_dumps"):
-            if os.path.exists(f"core_dumps/{file}"):
-                os.remove(f"core_dumps/{file}")
-        os.rmdir("core_dumps")
+        shutil.rmtree("core_dumps")
+        shutil.rmtree(".dump_index", ignore_errors=True)
+        if os.path.exists("core-test.gz"):
+            os.remove("core-test.gz")
 
     def test_upload_file(self):
         """Test upload_file().
@@ -107,6 +112,101 @@ class TestCoreUploadFile2S3(unittest.TestCase):
         )
         mock_s3_client.delete_object(Bucket="mybucket", Key="core-test-4.gz")
 
+    def test_upload_file_verification(self):
+        """Test upload_file() verification modes.
+
+        0. Setup.
+        1. Test checksum mode verifies from the upload response, no extra request to S3.
+        2. Test waiter mode polls S3 after the upload.
+        3. Test multipart upload.
+        4. Test unverifiable uploads fall back to the waiter.
+        """
+        # 0.
+        s3 = upload_file_2_s3.get_s3_client()
+        requests = []
+        s3.meta.events.register("before-call.s3", lambda model, **kwargs: requests.append(model.name))
+        with open("core_dumps/core-test-6", "wb") as core_dump:
+            core_dump.write(os.urandom(11 * 1024 * 1024))
+        # 1.
+        self.assertEqual(
+            upload_file(file_name="core_dumps/core-test-2.gz", bucket="mybucket"), "s3://mybucket/core-test-2.gz"
+        )
+        self.assertEqual(requests, ["PutObject"])
+        self.assertFalse(os.path.exists("core_dumps/core-test-2.gz"))
+        # 2.
+        requests.clear()
+        upload_file(file_name="core_dumps/core-test-3.gz", bucket="mybucket", verify_mode="waiter")
+        self.assertEqual(requests, ["PutObject", "HeadObject"])
+        # 3.
+        requests.clear()
+        self.assertEqual(
+            upload_file(
+                file_name="core_dumps/core-test-6",
+                bucket="mybucket",
+                multipart_threshold=5 * 1024 * 1024,
+                part_size=5 * 1024 * 1024,
+            ),
+            "s3://mybucket/core-test-6",
+        )
+        self.assertEqual(
+            requests, ["CreateMultipartUpload", "UploadPart", "UploadPart", "UploadPart", "CompleteMultipartUpload"]
+        )
+        # 4.
+        requests.clear()
+        with patch("multipart_upload.verify_upload", autospec=True, return_value=False):
+            upload_file(file_name="core_dumps/core-test-4.gz", bucket="mybucket")
+        self.assertEqual(requests, ["PutObject", "HeadObject"])
+
+    def test_upload_file_metrics(self):
+        """Test upload_file() metrics.
+
+        1. Test a successful upload records every stage.
+        2. Test a failed upload.
+        """
+        # 1.
+        with patch("metrics._sink") as sink:
+            upload_file(file_name="core_dumps/core-test-2.gz", bucket="mybucket")
+            updates = [(call.args[0], call.args[1], call.args[3]) for call in sink.call_args_list]
+            self.assertEqual(
+                updates,
+                [
+                    ("inc", "workers_busy", {}),
+                    ("observe", "stage_seconds", {"stage": "upload"}),
+                    ("inc", "uploaded_bytes_total", {}),
+                    ("observe", "upload_throughput_bytes_per_second", {}),
+                    ("observe", "stage_seconds", {"stage": "verify"}),
+                    ("observe", "stage_seconds", {"stage": "delete"}),
+                    ("inc", "uploads_total", {"result": "success"}),
+                    ("inc", "workers_busy", {}),
+                ],
+            )
+            self.assertEqual(sink.call_args_list[-1].args[2], -1)
+        # 2.
+        with patch("metrics._sink") as sink, self.assertRaises(Exception), self.assertLogs(level="ERROR"):
+            upload_file(file_name="core_dumps/core-test-3.gz", bucket="wrongbucket")
+        self.assertIn(("inc", "uploads_total", 1, {"result": "failure"}), [call.args for call in sink.call_args_list])
+
+    def test_upload_file_progress(self):
+        """Test upload_file() with a progress slot.
+
+        1. Test the bytes sent are recorded in the upload's slot.
+        2. Test a cancelled upload stops before sending anything.
+        """
+        progress = ProgressTable(1)
+        upload_file_2_s3.configure(progress=progress)
+        self.addCleanup(upload_file_2_s3.configure)
+        # 1.
+        progress.reset(0)
+        self.assertTrue(upload_file(file_name="core_dumps/core-test-2.gz", bucket="mybucket", progress_slot=0))
+        self.assertEqual(progress.sent(0), 5)
+        # 2.
+        progress.reset(0)
+        progress.cancel(0)
+        with self.assertRaises(UploadInterrupted), self.assertLogs(level="ERROR"):
+            upload_file(file_name="core_dumps/core-test-3.gz", bucket="mybucket", progress_slot=0)
+        self.assertEqual(progress.sent(0), 0)
+        self.assertTrue(os.path.exists("core_dumps/core-test-3.gz"))
+
     def test_check_if_exists(self):
         """Test check_if_exists().
 
@@ -125,3 +225,43 @@ class TestCoreUploadFile2S3(unittest.TestCase):
                 str(cm.exception),
                 "Failed to upload core_dumps/core-test-4.gz to wrongbucket/core-test-4.gz: An error occurred (NoSuchBucket) when calling the PutObject operation: The specified bucket does not exist",
             )
+
+    def test_get_s3_client(self):
+        """Test get_s3_client().
+
+        1. Test the client is cached.
+        2. Test the client is rebuilt when too old.
+        3. Test the client is rebuilt when credentials expire.
+        4. Test init_worker() builds the client, lowers the priority and resets the SIGTERM handler.
+        """
+        # 1.
+        client = get_s3_client()
+        self.assertIs(get_s3_client(), client)
+        # 2.
+        self.assertIsNot(get_s3_client(max_age=-1), client)
+        # 3.
+        client = get_s3_client()
+        with patch("upload_file_2_s3._credentials_expired", autospec=True, return_value=True):
+            self.assertIsNot(get_s3_client(), client)
+        # 4.
+        upload_file_2_s3._s3_client = None
+        # The test process must keep its own priority and signal handlers.
+        with patch("throttle.lower_priority", autospec=True) as lower_priority, patch(
+            "upload_file_2_s3.signal.signal", autospec=True
+        ) as set_handler:
+            self.assertTrue(init_worker())
+        self.assertIsNotNone(upload_file_2_s3._s3_client)
+        lower_priority.assert_called_once_with()
+        set_handler.assert_called_once_with(signal.SIGTERM, signal.SIG_DFL)
+
+    def test_preload(self):
+        """Test preload().
+
+        1. Test clients built after preload() reuse its S3 service model.
+        """
+        self.addCleanup(setattr, upload_file_2_s3, "_data_loader", None)
+        # 1.
+        loader = upload_file_2_s3.preload()
+        upload_file_2_s3._s3_client = None
+        get_s3_client()
+        self.assertIs(upload_file_2_s3._s3_session._session.get_component("data_loader"), loader)
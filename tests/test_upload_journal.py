@@ -0,0 +1,75 @@
+import os
+import unittest
+from moto import mock_aws
+import boto3
+
+from upload_journal import UploadJournal, pending
+
+os.environ["REGION"] = "us-east-1"
+
+
+@mock_aws
+class TestUploadJournal(unittest.TestCase):
+    def setUp(self):
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="mybucket")
+        os.mkdir("journal_test_files", 0o777)
+        with open("journal_test_files/core-test", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        self.part = {"PartNumber": 1, "ETag": '"etag"', "Checksum": b"\x00\x01", "MD5": b"\x02\x03"}
+
+    def tearDown(self):
+        for file in os.listdir("journal_test_files/.upload_journal"):
+            os.remove(f"journal_test_files/.upload_journal/{file}")
+        os.rmdir("journal_test_files/.upload_journal")
+        os.remove("journal_test_files/core-test")
+        os.rmdir("journal_test_files")
+
+    def test_upload_journal(self):
+        """Test UploadJournal.
+
+        1. Test parts round trip through the journal file.
+        2. Test a journal for another object is not loaded.
+        3. Test a journal of a dump that changed is not loaded.
+        4. Test remove().
+        """
+        journal = UploadJournal("journal_test_files/core-test")
+        journal.start("mybucket", "core-test", "upload-id", 5 * 1024 * 1024, "SHA256")
+        journal.record_parts([self.part])
+        # 1.
+        loaded = UploadJournal("journal_test_files/core-test")
+        self.assertEqual(loaded.load("mybucket", "core-test", "SHA256")["UploadId"], "upload-id")
+        self.assertEqual(loaded.parts(), [self.part])
+        # 2.
+        with self.assertLogs(logger="upload_journal", level="WARNING"):
+            self.assertIsNone(loaded.load("mybucket", "other", "SHA256"))
+        # 3.
+        with open("journal_test_files/core-test", "a", encoding="utf-8") as core_dump:
+            core_dump.write("more\n")
+        with self.assertLogs(logger="upload_journal", level="WARNING"):
+            self.assertIsNone(loaded.load("mybucket", "core-test", "SHA256"))
+        # 4.
+        journal.remove()
+        self.assertIsNone(journal.load("mybucket", "core-test", "SHA256"))
+
+    def test_pending(self):
+        """Test pending().
+
+        1. Test dumps with a journal are returned.
+        2. Test journals of vanished dumps are removed and their upload aborted.
+        3. Test a directory without journals.
+        """
+        upload_id = self.s3.create_multipart_upload(Bucket="mybucket", Key="core-gone")["UploadId"]
+        with open("journal_test_files/core-gone", "w", encoding="utf-8") as core_dump:
+            core_dump.write("test\n")
+        UploadJournal("journal_test_files/core-gone").start("mybucket", "core-gone", upload_id, 5, "SHA256")
+        os.remove("journal_test_files/core-gone")
+        UploadJournal("journal_test_files/core-test").start("mybucket", "core-test", "upload-id", 5, "SHA256")
+        # 1.
+        with self.assertLogs(logger="upload_journal", level="INFO"):
+            self.assertEqual(pending("journal_test_files"), ["core-test"])
+        # 2.
+        self.assertEqual(os.listdir("journal_test_files/.upload_journal"), ["core-test.json"])
+        self.assertNotIn("Uploads", self.s3.list_multipart_uploads(Bucket="mybucket"))
+        # 3.
+        self.assertEqual(pending("journal_test_files/.upload_journal"), [])
@@ -0,0 +1,71 @@
+import os
+import unittest
+
+from upload_pool import UploadPool
+
+
+def get_pid(value):
+    return os.getpid()
+
+
+class TestUploadPool(unittest.TestCase):
+    def test_apply_async(self):
+        """Test apply_async().
+
+        1. Test result and callback.
+        2. Test error callback.
+        """
+        pool = UploadPool(processes=1)
+        try:
+            # 1.
+            results = []
+            result = pool.apply_async(func=abs, args=[-1], callback=results.append)
+            self.assertEqual(result.get(timeout=10), 1)
+            self.assertEqual(results, [1])
+            # 2.
+            errors = []
+            result = pool.apply_async(func=abs, args=["a"], error_callback=errors.append)
+            with self.assertRaises(TypeError):
+                result.get(timeout=10)
+            self.assertIsInstance(errors[0], TypeError)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_recycle_bytes(self):
+        """Test workers are reused until the byte budget is reached.
+
+        1. Test workers are reused below the budget.
+        2. Test a new generation is spawned once the budget is reached.
+        """
+        pool = UploadPool(processes=1, recycle_bytes=100)
+        try:
+            # 1.
+            first = pool.apply_async(func=get_pid, args=[1], size=60).get(timeout=10)
+            self.assertEqual(pool.apply_async(func=get_pid, args=[1], size=60).get(timeout=10), first)
+            self.assertEqual(pool.generation, 1)
+            # 2.
+            self.assertNotEqual(pool.apply_async(func=get_pid, args=[1]).get(timeout=10), first)
+            self.assertEqual(pool.generation, 2)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_recycle_seconds(self):
+        """Test workers are recycled by age.
+
+        1. Test young workers are not recycled.
+        2. Test old workers are recycled.
+        """
+        pool = UploadPool(processes=1, recycle_seconds=60)
+        try:
+            # 1.
+            self.assertFalse(pool.needs_recycle())
+            # 2.
+            pool._started -= 61
+            self.assertTrue(pool.needs_recycle())
+            pool.apply_async(func=get_pid, args=[1]).get(timeout=10)
+            self.assertEqual(pool.generation, 2)
+        finally:
+            pool.close()
+            pool.join()